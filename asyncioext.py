@@ -1,10 +1,55 @@
-from asyncio import Lock
+import asyncio
+import time
+from collections import deque
 from contextlib import asynccontextmanager
+from stats import Samples
+
+async def gather_or_cancel(*aws):
+    """ Like asyncio.gather, except that the first exception cancels the
+        awaitables still running and is raised once they all stopped, so
+        none of them keeps going after the caller gave up.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return []
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        # retrieved even when cancelled, or asyncio reports them as lost
+        errors = [task.exception() for task in tasks if not task.cancelled()]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [task.result() for task in tasks]
+
+class LockMetrics(object):
+    """ How long the holders of a lock waited for it and held it, and how
+        many were queued when they asked for it.
+    """
+
+    def __init__(self):
+        self.wait = Samples()
+        self.hold = Samples()
+        self.queue = Samples()
+        self.timeouts = 0
+
+    def __str__(self):
+        queue = ', '.join(f'p{p} {v:.0f}' for p, v in self.queue.percentiles().items())
+        return f'wait {self.wait}; hold {self.hold}; queue {queue}; ' \
+            f'{self.timeouts} timeouts'
 
 class RWLock(object):
     """ RWLock class; this is meant to allow an object to be read from by
         multiple threads, but only written to by a single thread at a time. See:
         https://en.wikipedia.org/wiki/Readers%E2%80%93writer_lock
+        The lock is fair: it's granted in arrival order, every reader at the
+        head of the queue entering together. A reader coming while a writer
+        waits queues behind it, so a stream of readers can't starve writers.
         Usage:
             from rwlock import RWLock
             my_obj_rwlock = RWLock()
@@ -14,46 +59,119 @@ class RWLock(object):
             # When writing to my_obj:
             async with my_obj_rwlock.w_locked():
                 await mutate(my_obj)
+        Both take an optional label, the metrics being kept per label, and
+        an optional timeout in seconds, raising asyncio.TimeoutError.
+        Without instrumented, no metrics are kept.
     """
 
-    def __init__(self):
-        self.w_lock = Lock()
-        self.num_r_lock = Lock()
+    def __init__(self, instrumented=True):
         self.num_r = 0
+        self.writing = False
+        self.waiters = deque() # (is writer, future), in arrival order
+        self.metrics = {} if instrumented else None # label -> LockMetrics
 
-    async def r_acquire(self):
-        await self.num_r_lock.acquire()
-        self.num_r += 1
-        if self.num_r == 1:
-            await self.w_lock.acquire()
-        self.num_r_lock.release()
+    def get_metrics(self, label):
+        if self.metrics is None:
+            return None
+        if label not in self.metrics:
+            self.metrics[label] = LockMetrics()
+        return self.metrics[label]
+
+    def is_idle(self):
+        return not self.num_r and not self.writing and not self.waiters
+
+    async def acquire(self, writer, label=None, timeout=None):
+        metrics = self.get_metrics(label)
+        if metrics:
+            metrics.queue.add(len(self.waiters))
+        t0 = time.perf_counter()
+        if not self.waiters and not self.writing and not (writer and self.num_r):
+            self.grant(writer)
+        else:
+            waiter = (writer, asyncio.get_event_loop().create_future())
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter[1], timeout)
+            except BaseException as e:
+                if waiter[1].done() and not waiter[1].cancelled():
+                    # granted just before being given up
+                    self.release(writer)
+                else:
+                    if waiter in self.waiters:
+                        self.waiters.remove(waiter)
+                    self.wake()
+                if metrics and isinstance(e, asyncio.TimeoutError):
+                    metrics.timeouts += 1
+                raise
+        if metrics:
+            metrics.wait.add(time.perf_counter() - t0)
+
+    def grant(self, writer):
+        if writer:
+            self.writing = True
+        else:
+            self.num_r += 1
+
+    def release(self, writer):
+        if writer:
+            assert self.writing
+            self.writing = False
+        else:
+            assert self.num_r > 0
+            self.num_r -= 1
+        self.wake()
+
+    def wake(self):
+        # Grants the lock to the head of the queue: a writer alone, or every
+        # reader before the next writer
+        while self.waiters and not self.writing:
+            writer, future = self.waiters[0]
+            if future.done():
+                # given up, about to leave the queue
+                self.waiters.popleft()
+                continue
+            if writer and self.num_r:
+                break
+            self.waiters.popleft()
+            self.grant(writer)
+            future.set_result(None)
+            if writer:
+                break
+
+    async def r_acquire(self, label=None, timeout=None):
+        await self.acquire(False, label, timeout)
 
     async def r_release(self):
-        assert self.num_r > 0
-        await self.num_r_lock.acquire()
-        self.num_r -= 1
-        if self.num_r == 0:
-            self.w_lock.release()
-        self.num_r_lock.release()
-    
+        self.release(False)
+
     @asynccontextmanager
-    async def r_locked(self):
+    async def r_locked(self, label=None, timeout=None):
+        await self.r_acquire(label, timeout)
+        t0 = time.perf_counter()
         try:
-            await self.r_acquire()
             yield
         finally:
+            if self.metrics is not None:
+                self.get_metrics(label).hold.add(time.perf_counter() - t0)
             await self.r_release()
 
-    async def w_acquire(self):
-        await self.w_lock.acquire()
+    async def w_acquire(self, label=None, timeout=None):
+        await self.acquire(True, label, timeout)
 
     async def w_release(self):
-        self.w_lock.release()
+        self.release(True)
 
     @asynccontextmanager
-    async def w_locked(self):
+    async def w_locked(self, label=None, timeout=None):
+        await self.w_acquire(label, timeout)
+        t0 = time.perf_counter()
         try:
-            await self.w_acquire()
             yield
         finally:
-            await self.w_release()
\ No newline at end of file
+            if self.metrics is not None:
+                self.get_metrics(label).hold.add(time.perf_counter() - t0)
+            await self.w_release()
+
+    def stats(self):
+        return '\n'.join(f'{label}: {metrics}'
+            for label, metrics in (self.metrics or {}).items())
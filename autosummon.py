@@ -0,0 +1,89 @@
+import asyncio
+import sys
+from constants import AUTO_SUMMON_MINUTES
+from locks import STRUCTURE, member_key
+from presence import ELSEWHERE, MOVABLE
+from strings import AUTO_SUMMON_ENDED
+
+class AutoSummoner:
+  """ SUMMON kept going: once armed, every participant the presence index
+      sees becoming movable is moved to the waiting room, until the
+      deadline or disarm(). Only the members that changed are looked at.
+      Usage:
+          n_movable = summoner.arm(minutes)
+          ...
+          summoner.disarm()
+  """
+
+  def __init__(self, client):
+    self.client = client
+    self.deadline = None # timer handle while armed
+    self.pending = set() # ids of the members being moved
+    self.tasks = set()
+    self.n_moved = 0
+    self.n_failed = 0
+
+  def is_armed(self):
+    return self.deadline is not None
+
+  def arm(self, minutes=AUTO_SUMMON_MINUTES):
+    # Returns how many participants were movable already
+    if self.deadline:
+      self.deadline.cancel()
+    else:
+      self.n_moved = self.n_failed = 0
+      self.client.presence.build()
+      self.client.presence.listeners.append(self.on_change)
+    self.deadline = asyncio.get_event_loop().call_later(minutes * 60, self.disarm)
+    movable = self.client.presence.members([ELSEWHERE], [MOVABLE])
+    for member in movable:
+      self.summon(member)
+    return len(movable)
+
+  def disarm(self):
+    if not self.deadline:
+      return False
+    self.deadline.cancel()
+    self.deadline = None
+    self.client.presence.listeners.remove(self.on_change)
+    self.spawn(self.report())
+    return True
+
+  async def report(self):
+    # Once the moves under way are over
+    await asyncio.gather(*[task for task in self.tasks
+      if task is not asyncio.current_task()])
+    await self.client.publish(AUTO_SUMMON_ENDED.format(
+      n_moved=self.n_moved, n_failed=self.n_failed))
+
+  def on_change(self, member, key):
+    if key == (ELSEWHERE, MOVABLE):
+      self.summon(member)
+
+  def summon(self, member):
+    if member.id not in self.pending:
+      self.pending.add(member.id)
+      self.spawn(self.move(member))
+
+  def spawn(self, coro):
+    task = asyncio.ensure_future(coro)
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+
+  async def move(self, member):
+    try:
+      async with self.client.locks.locked('AUTOSUMMON', reads=[STRUCTURE],
+          writes=[member_key(member.id)]):
+        # they could have moved or switched device while waiting
+        if self.client.presence.key(member) != (ELSEWHERE, MOVABLE):
+          return
+        if await self.client.mover.move(member, self.client.get_waiting_room()):
+          self.n_failed += 1
+        else:
+          self.n_moved += 1
+    except Exception as e:
+      print(f"Couldn't summon {member}", file=sys.stderr)
+      print(e)
+      self.n_failed += 1
+    finally:
+      self.pending.discard(member.id)
@@ -1,6 +1,63 @@
 import re
+import asyncio
 import discord
 import sys
+from constants import ROUTE_MEMBER, ROUTE_MEMBER_ROLE, ROUTE_ROLES, ROUTE_CHANNELS, \
+  ROUTE_CHANNEL, ROUTE_PERMISSIONS, ROUTE_REACTION
+from constants import HYDRATION_CHUNK_SIZE, HYDRATION_CONCURRENCY
+from broadcast import Broadcaster
+from mover import Mover
+from move_tracker import MoveTracker
+from mute import MuteEngine
+from ratelimit import RateLimiter
+from metrics import Metrics
+
+class RoleEdit:
+  """ Accumulates role changes for a member and applies them all with a
+      single member.edit, refreshing the mute at most once.
+      Usage:
+          edit = client.edit_roles(member)
+          edit.add(banned_role)
+          edit.remove(participant_role)
+          if await edit.commit():
+            ...
+      added and removed only hold the roles that actually change.
+  """
+
+  def __init__(self, client, member):
+    self.client = client
+    self.member = member
+    self.added = []
+    self.removed = []
+
+  def add(self, role):
+    if role is not None and role not in self.member.roles \
+        and role not in self.added:
+      self.added.append(role)
+    if role in self.removed:
+      self.removed.remove(role)
+
+  def remove(self, role):
+    if role is not None and role in self.member.roles \
+        and role not in self.removed:
+      self.removed.append(role)
+    if role in self.added:
+      self.added.remove(role)
+
+  def has(self, role):
+    # Whether the member has role once the edit is committed
+    return role in self.added or \
+      (role in self.member.roles and role not in self.removed)
+
+  async def commit(self):
+    if not self.added and not self.removed:
+      return False
+    roles = [r for r in self.member.roles
+        if not r.is_default() and r not in self.removed] + self.added
+    async with self.client.limiter.request(ROUTE_MEMBER, self.member.guild.id, 'edit_roles'):
+      await self.member.edit(roles=roles)
+    await self.client.refresh_mute_roles(self.member, self.added + self.removed)
+    return True
 
 class BaseClient(discord.Client):
   
@@ -8,12 +65,22 @@ class BaseClient(discord.Client):
     super().__init__(intents=intents)
     self.guild_name = guild_name
     self.guild = None
+    self.metrics = Metrics()
+    self.limiter = RateLimiter(metrics=self.metrics)
+    self.move_tracker = MoveTracker()
+    self.mover = Mover(self.limiter, tracker=self.move_tracker)
+    self.mute_engine = MuteEngine(self.limiter)
+    self.broadcaster = Broadcaster(self.limiter)
   
   async def on_guild_available(self, guild):
     if guild.name == self.guild_name:
       self.guild = discord.utils.get(self.guilds, name=self.guild_name)
       print(f'{self.user} linked to {self.guild.name}')
   
+  async def on_voice_state_update(self, member, voice_state1, voice_state2):
+    self.move_tracker.on_voice_state_update(member, voice_state1, voice_state2)
+    await self.mute_engine.on_voice_state_update(member, voice_state1, voice_state2)
+
   async def connect_to(self, channel):
     if channel.guild.voice_client:
       # can happen that guild.voice_client is not None and guild.me.voice is None
@@ -36,38 +103,43 @@ class BaseClient(discord.Client):
               (member.is_on_mobile() or self.is_offline_or_invisible(member)):
             # Usually we don't move members on mobile as they'd get bugged
             # and invisible ones could be on mobile
-            await member.move_to(to)
+            async with self.limiter.request(ROUTE_MEMBER, member.guild.id, 'move'):
+              await member.move_to(to)
             return True
     return False
   
   async def check_valid_name(self, named_deletable_obj, name):
     if named_deletable_obj.name != name:
-      await named_deletable_obj.delete()
+      await self.delete_if_exists(named_deletable_obj)
       raise ValueError(
         f'{name} is not a valid name for a {named_deletable_obj.__class__.__name__}. What about {named_deletable_obj.name}?')
   
   async def create_role(self, name):
-    role = await self.guild.create_role(name=name)
+    async with self.limiter.request(ROUTE_ROLES, self.guild.id, 'create_role'):
+      role = await self.guild.create_role(name=name)
     await self.check_valid_name(role, name)
     #TODO color and category
     return role
   
   async def create_category_channel(self, name, overwrites=None):
-    channel = await self.guild.create_category_channel(
-        name=name, overwrites=overwrites)
+    async with self.limiter.request(ROUTE_CHANNELS, self.guild.id, 'create_channel'):
+      channel = await self.guild.create_category_channel(
+          name=name, overwrites=overwrites)
     await self.check_valid_name(channel, name)
     return channel
   
   async def create_voice_channel(self, name, category=None, overwrites=None):
-    channel = await self.guild.create_voice_channel(
-        name=name, overwrites=overwrites, category=category)
+    async with self.limiter.request(ROUTE_CHANNELS, self.guild.id, 'create_channel'):
+      channel = await self.guild.create_voice_channel(
+          name=name, overwrites=overwrites, category=category)
     await self.check_valid_name(channel, name)
     return channel
 
   async def create_text_channel(self, name, *,
       overwrites=None, category=None, reason=None, **options):
-    channel = await self.guild.create_text_channel(name,
-        overwrites=overwrites, category=category, reason=reason, **options)
+    async with self.limiter.request(ROUTE_CHANNELS, self.guild.id, 'create_channel'):
+      channel = await self.guild.create_text_channel(name,
+          overwrites=overwrites, category=category, reason=reason, **options)
     await self.check_valid_name(channel, name)
     return channel
   '''
@@ -78,8 +150,13 @@ class BaseClient(discord.Client):
     return channel
   '''
   async def delete_if_exists(self, deletable):
+    if isinstance(deletable, discord.Role):
+      route, major, operation = ROUTE_ROLES, deletable.guild.id, 'delete_role'
+    else:
+      route, major, operation = ROUTE_CHANNEL, deletable.id, 'delete_channel'
     try:
-      await deletable.delete()
+      async with self.limiter.request(route, major, operation):
+        await deletable.delete()
       return True
     except discord.errors.NotFound:
       return False
@@ -91,22 +168,23 @@ class BaseClient(discord.Client):
     await self.delete_if_exists(channel)
   
   mention_re = re.compile("<@!?([0-9]{18})>")
-  async def get_member(self, member_user_id_mention): #TODO test user not in guild
-    if isinstance(member_user_id_mention, discord.Member):
-      return member_user_id_mention
-    if isinstance(member_user_id_mention, discord.User):
-      member_user_id_mention = member_user_id_mention.id
-    elif isinstance(member_user_id_mention, str):
+  def get_member_id(self, member_user_id_mention):
+    if isinstance(member_user_id_mention, (discord.Member, discord.User)):
+      return member_user_id_mention.id
+    if isinstance(member_user_id_mention, str):
       try:
-        member_user_id_mention = int(member_user_id_mention)
+        return int(member_user_id_mention)
       except ValueError:
           match = self.__class__.mention_re.match(member_user_id_mention)
           if match:
-            member_user_id_mention = int(match.group(1))
-          else:
-            raise ValueError(f"{member_user_id_mention} isn't a valid member ID or mention")
-    else:
-      raise ValueError(f"member_user_id_mention should be a User or str")
+            return int(match.group(1))
+          raise ValueError(f"{member_user_id_mention} isn't a valid member ID or mention")
+    raise ValueError(f"member_user_id_mention should be a User or str")
+
+  async def get_member(self, member_user_id_mention): #TODO test user not in guild
+    if isinstance(member_user_id_mention, discord.Member):
+      return member_user_id_mention
+    member_user_id_mention = self.get_member_id(member_user_id_mention)
     member = self.guild.get_member(member_user_id_mention)
     if not member: # member not cached
       try:
@@ -117,12 +195,36 @@ class BaseClient(discord.Client):
         print(e)
     return member
   
+  async def hydrate_members(self, ids, chunk_size=HYDRATION_CHUNK_SIZE,
+      concurrency=HYDRATION_CONCURRENCY):
+    # Caches the members among ids that aren't, asking the gateway for
+    # them chunk_size at a time instead of fetching them one by one
+    ids = [int(id) for id in ids]
+    missing = [id for id in ids if not self.guild.get_member(id)]
+    chunks = [missing[i:i+chunk_size] for i in range(0, len(missing), chunk_size)]
+    semaphore = asyncio.Semaphore(concurrency)
+    async def query(chunk):
+      async with semaphore:
+        try:
+          await self.guild.query_members(user_ids=chunk, limit=len(chunk),
+            presences=self.intents.presences)
+        except asyncio.TimeoutError:
+          print(f"Timed out querying {len(chunk)} members", file=sys.stderr)
+    await asyncio.gather(*(query(chunk) for chunk in chunks))
+    members = [self.guild.get_member(id) for id in ids]
+    print(f'{len(missing)} uncached members queried in {len(chunks)} chunks')
+    return [m for m in members if m]
+
   async def refresh_mute(self, member):
-    await member.move_to(member.voice.channel)
-    #print(f'Forcing mute refresh of {member} in {member.voice.channel.name}')
+    await self.mute_engine.refresh(member)
 
   async def refresh_mute_role(self, member, role):
-    if member.voice and not member.voice.channel.overwrites_for(role).is_empty():
+    await self.refresh_mute_roles(member, [role])
+
+  async def refresh_mute_roles(self, member, roles):
+    if member.voice and any(
+        not member.voice.channel.overwrites_for(role).is_empty()
+        for role in roles):
       await self.refresh_mute(member)
   
   def get_role(self, name):
@@ -135,37 +237,45 @@ class BaseClient(discord.Client):
         del permissions[perm]
     if len(permissions) == 0:
       return False
-    await channel.set_permissions(member_role, **permissions)
-    #tasks = []
-    for member in channel.members:
-      if isinstance(member_role, discord.Member):
-        if member_role == member:
-          #tasks.append(asyncio.create_task(self.refresh_mute(member)))
-          #tasks.append(self.refresh_mute(member))
-          await self.refresh_mute(member)
-      elif isinstance(member_role, discord.Role):
-        if member_role in member.roles:
-          #tasks.append(asyncio.create_task(self.refresh_mute(member)))
-          #tasks.append(self.refresh_mute(member))
-          await self.refresh_mute(member)
-    #await asyncio.wait(tasks)
-    #await asyncio.gather(*tasks)
+    async with self.limiter.request(ROUTE_PERMISSIONS, channel.id, 'set_permissions'):
+      await channel.set_permissions(member_role, **permissions)
+    if isinstance(member_role, discord.Role):
+      affected = [m for m in channel.members if member_role in m.roles]
+    else:
+      affected = [m for m in channel.members if m == member_role]
+    await self.mute_engine.refresh_all(affected)
+    return True
+
+  async def clear_channel_permissions(self, channel, member_role):
+    if member_role not in channel.overwrites:
+      return False
+    async with self.limiter.request(ROUTE_PERMISSIONS, channel.id, 'set_permissions'):
+      await channel.set_permissions(member_role, overwrite=None)
     return True
 
+  def edit_roles(self, member):
+    return RoleEdit(self, member)
+
   async def give_role(self, member, role):
     if role is not None and role not in member.roles:
-      await member.add_roles(role)
+      async with self.limiter.request(ROUTE_MEMBER_ROLE, member.guild.id, 'add_role'):
+        await member.add_roles(role)
       await self.refresh_mute_role(member, role)
       return True
     return False
   
   async def revoke_role(self, member, role):
     if role in member.roles:
-      await member.remove_roles(role)
+      async with self.limiter.request(ROUTE_MEMBER_ROLE, member.guild.id, 'remove_role'):
+        await member.remove_roles(role)
       await self.refresh_mute_role(member, role)
       return True
     return False
 
+  async def react(self, msg, emoji):
+    async with self.limiter.request(ROUTE_REACTION, msg.channel.id, 'react'):
+      await msg.add_reaction(emoji)
+
   def is_faraway(self, member):
     return member.voice is None \
         or member.voice.channel is None \
@@ -0,0 +1,1149 @@
+import asyncio
+import json
+import random
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import asynccontextmanager, redirect_stdout, redirect_stderr
+import discord
+from rules import RuleProcessor, CmdRule, JoinCmdRule, QuitCmdRule
+from mover import Mover
+from ratelimit import RateLimiter
+from mute import MuteEngine
+from broadcast import Broadcaster
+from move_tracker import MoveTracker
+from tournament_client import TournamentClient
+from constants import *
+from strings import *
+import simulation
+import database
+from stats import percentile
+from asyncioext import RWLock
+from locks import LockManager
+from metrics import Metrics
+from coalescer import Coalescer
+import matchmaking
+import permissions
+from presence import FARAWAY, WAITING, BUSY, MOBILE, INVISIBLE, MOVABLE
+
+def report(name, n, seconds, unit='messages'):
+  print(f'{name}: {n} {unit} in {seconds:.2f} seconds ({n/seconds:.0f} {unit}/s)')
+
+async def linear_scan(rules, msg):
+  # How RuleProcessor used to dispatch: every rule parses the message again
+  for rule in rules:
+    if await rule.process(msg): return True
+  return False
+
+async def bench_dispatch(n_messages=100000, command_ratio=0.05):
+  random.seed(0)
+  client = simulation.SimulatedClient()
+  rules = [rule(client) for rule in TournamentClient.rules]
+  processor = RuleProcessor(*rules)
+  commands = [r.cmd for r in rules if isinstance(r, CmdRule)]
+  messages = simulation.message_stream(client, n_messages, command_ratio, commands)
+  t0 = time.perf_counter()
+  for msg in messages:
+    await linear_scan(rules, msg)
+  report('linear scan', n_messages, time.perf_counter() - t0)
+  t0 = time.perf_counter()
+  for msg in messages:
+    await processor.run(msg)
+  report('dispatch table', n_messages, time.perf_counter() - t0)
+
+async def bench_mover(n_players=100, latency=0.05):
+  # Wall time of the START moves, each move being a REST round trip
+  guild = simulation.Guild(GUILD_NAME, simulation.Backend(latency))
+  players = [guild.add_member() for _ in range(n_players)]
+  lobby = simulation.VoiceChannel(1, 'Lobby 1', guild)
+  t0 = time.perf_counter()
+  for member in players:
+    await member.move_to(lobby)
+  print(f'sequential: {n_players} moves in {time.perf_counter() - t0:.2f} seconds')
+  for concurrency in (1, 5, 10, 20):
+    mover = Mover(RateLimiter({}), concurrency)
+    t0 = time.perf_counter()
+    await mover.move_all([(member, lobby) for member in players])
+    print(f'mover concurrency {concurrency}: {n_players} moves in {time.perf_counter() - t0:.2f} seconds')
+
+class LandingWatcher:
+  # Gateway side of a simulated guild, timing when members enter a lobby
+  def __init__(self):
+    self.t0 = time.perf_counter()
+    self.landed = {} # member id -> seconds
+  async def on_voice_state_update(self, member, before, after):
+    if after.channel and after.channel.name.startswith(LOBBY_NAME_PREFIX):
+      self.landed.setdefault(member.id, time.perf_counter() - self.t0)
+
+async def bench_ratelimit(n_players=200, latency=0.1):
+  # START against a backend enforcing Discord's buckets, relying on 429
+  # retries as before or pacing the requests with the client side limiter.
+  # Each player's latency runs from the command to their landing.
+  database.store = database.MemoryStore()
+  devnull = open(os.devnull, 'w')
+  for name, limits in (('reactive 429', {}), ('limiter', RATE_LIMITS)):
+    backend = simulation.Backend(latency, DISCORD_RATE_LIMITS)
+    client = await simulated_tournament(n_players, backend, limits)
+    client.matchmaker = matchmaking.Matchmaker(processes=0)
+    manager = client.guild.add_member(channel=client.waiting_room)
+    manager.roles.append(client.manager_role)
+    watcher = LandingWatcher()
+    client.guild.clients.append(watcher)
+    msg = client.get_waiting_chat().post(manager, CMD_START)
+    with redirect_stdout(devnull), redirect_stderr(devnull):
+      await client.on_message(msg)
+      await client.publisher.flush()
+    seconds = time.perf_counter() - watcher.t0
+    landed = list(watcher.landed.values())
+    print(f'{name}: START of {n_players} in {seconds:.2f} seconds, '
+      f'{n_players - len(landed)} not moved, '
+      f'{sum(backend.rate_limited.values())} 429s, '
+      f'{sum(backend.calls.values())} requests, '
+      f'landed p50 {percentile(landed, 50):.2f}s p95 {percentile(landed, 95):.2f}s '
+      f'p99 {percentile(landed, 99):.2f}s')
+  devnull.close()
+
+async def simulated_tournament(n_participants, backend=None, limits={}):
+  # A TournamentClient linked to a simulated guild where every participant
+  # waits in the Waiting Room, with Discord's rate limits left to the backend
+  guild = simulation.Guild(GUILD_NAME, backend)
+  client = TournamentClient(guild_name=GUILD_NAME)
+  client.guild = guild
+  client._connection.user = guild.me
+  client.limiter = RateLimiter(limits)
+  client.mover = Mover(client.limiter)
+  client.mute_engine = MuteEngine(client.limiter)
+  client.broadcaster = Broadcaster(client.limiter)
+  client.manager_role = await guild.create_role(MANAGER_ROLE_NAME)
+  client.participant_role = await guild.create_role(PARTICIPANT_ROLE_NAME)
+  client.banned_role = await guild.create_role(BANNED_ROLE_NAME)
+  client.category_channel = await guild.create_category_channel(CATEGORY_CHANNEL_NAME)
+  client.waiting_room = await guild.create_voice_channel(WAITING_ROOM_NAME,
+    category=client.category_channel)
+  client.waiting_chat = await guild.create_text_channel(WAITING_CHAT_NAME,
+    category=client.category_channel)
+  for _ in range(n_participants):
+    member = guild.add_member(channel=client.waiting_room)
+    member.roles.append(client.participant_role)
+  guild.backend.calls.clear()
+  guild.backend.windows.clear() # the setup doesn't count against the buckets
+  return client
+
+async def play_round(client):
+  # START then END, the way StartCmdRule and EndCmdRule drive the client
+  players = list(client.get_waiting_room().members)
+  n_lobbies = (len(players) + LOBBY_CAPACITY - 1) // LOBBY_CAPACITY
+  moves = []
+  for l in range(n_lobbies):
+    lobby_players = players[l::n_lobbies]
+    lobby = await client.create_lobby(l+1, lobby_players)
+    moves.extend((member, lobby) for member in lobby_players)
+  await client.mover.move_all(moves)
+  await client.delete_lobbies()
+
+async def bench_lobby_calls(sizes=(10, 100, 500)):
+  # REST calls spent on lobby access in a round, moves apart as they don't
+  # depend on the strategy
+  for n_players in sizes:
+    for strategy in (LOBBY_STRATEGY_ROLE, LOBBY_STRATEGY_OVERWRITES):
+      client = await simulated_tournament(n_players)
+      client.lobby_strategy = strategy
+      await play_round(client)
+      calls = client.guild.backend.calls
+      role_calls = calls[ROUTE_ROLES] + calls[ROUTE_MEMBER_ROLE]
+      channel_calls = calls[ROUTE_CHANNELS] + calls[ROUTE_CHANNEL] + calls[ROUTE_PERMISSIONS]
+      print(f'{n_players} players, {strategy}: '
+        f'{role_calls + channel_calls} calls '
+        f'({role_calls} role, {channel_calls} channel) '
+        f'+ {calls[ROUTE_MEMBER]} moves')
+
+async def bench_mute(n_participants=99, latency=0.05):
+  # MUTE in a full Waiting Room, until every participant got the change
+  for name, strategy, concurrency in (
+      ('serial moves', MUTE_STRATEGY_MOVE, 1),
+      ('concurrent moves', MUTE_STRATEGY_MOVE, MUTE_CONCURRENCY),
+      ('server mute', MUTE_STRATEGY_SERVER, MUTE_CONCURRENCY)):
+    client = await simulated_tournament(n_participants, simulation.Backend(latency))
+    client.mute_engine = MuteEngine(client.limiter, strategy, concurrency)
+    room = client.get_waiting_room()
+    t0 = time.perf_counter()
+    await client.set_channel_permissions(room, client.get_participant_role(), speak=False)
+    print(f'{name}: {n_participants} muted in {time.perf_counter() - t0:.2f} seconds')
+  # Overlapping requests for the same members are served once
+  engine = client.mute_engine
+  await asyncio.gather(*(engine.refresh_all(room.members) for _ in range(3)))
+  print(f'overlapping refreshes: {engine.n_requested} requested, {engine.n_refreshed} done')
+
+async def bench_broadcast(n_participants=300, latency=0.05, closed_ratio=0.05):
+  # BROADCAST when some participants don't accept Direct Messages
+  random.seed(0)
+  client = await simulated_tournament(n_participants, simulation.Backend(latency))
+  participants = client.get_participants()
+  for member in random.sample(participants, int(n_participants * closed_ratio)):
+    member.dms_closed = True
+  delivered = 0
+  t0 = time.perf_counter()
+  try:
+    for member in participants:
+      dm_channel = await member.create_dm()
+      await dm_channel.send('ad')
+      delivered += 1
+  except discord.errors.HTTPException:
+    pass
+  print(f'serial: {delivered} delivered before the first failure, '
+    f'in {time.perf_counter() - t0:.2f} seconds')
+  for attempt in ('pipeline', 'pipeline, cached channels'):
+    client.guild.backend.calls.clear()
+    t0 = time.perf_counter()
+    outcomes = await client.broadcaster.send_all([(m, 'ad') for m in participants])
+    failed = len([e for e in outcomes if e])
+    print(f'{attempt}: {len(participants) - failed} delivered, {failed} failed, '
+      f'{client.guild.backend.calls[ROUTE_DM] + client.guild.backend.calls[ROUTE_MESSAGE]} requests, '
+      f'in {time.perf_counter() - t0:.2f} seconds')
+
+async def bench_move_tracker(n_players=100, latency=0.05, lost_moves=0.03):
+  # START moves confirmed by voice state updates, some of them getting lost
+  random.seed(0)
+  client = await simulated_tournament(n_players, simulation.Backend(latency))
+  client.guild.clients.append(client)
+  client.guild.gateway_latency = (0.02, 0.3)
+  client.guild.lost_moves = lost_moves
+  client.move_tracker = MoveTracker(timeout=1)
+  client.mover = Mover(client.limiter, tracker=client.move_tracker)
+  lobby = await client.guild.create_voice_channel('Lobby 1')
+  t0 = time.perf_counter()
+  outcomes = await client.mover.move_all(
+    [(member, lobby) for member in client.get_waiting_room().members])
+  print(f'{n_players} moves in {time.perf_counter() - t0:.2f} seconds, '
+    f'{len([e for e in outcomes if e])} stragglers, {len(lobby.members)} in the lobby')
+  print(f'tracker: {client.move_tracker.stats()}')
+
+class BlockingStore(database.MemoryStore):
+  # How the replit db was used: an HTTP round trip per write, blocking the
+  # event loop under a global lock
+  def __init__(self, latency):
+    super().__init__()
+    self.latency = latency
+    self.lock = asyncio.Lock()
+  async def put_participant_id(self, guild_name, id):
+    async with self.lock:
+      time.sleep(self.latency)
+      await super().put_participant_id(guild_name, id)
+
+async def bench_store(n_joins=2000, latency=0.005):
+  # Concurrent JOINs down to the participant store
+  directory = tempfile.mkdtemp()
+  for name, store in (
+      ('blocking replit-like', BlockingStore(latency)),
+      ('memory', database.MemoryStore()),
+      ('sqlite', database.SqliteStore(os.path.join(directory, 'sqlite.db')))):
+    database.store = store
+    client = await simulated_tournament(0)
+    members = [client.guild.add_member() for _ in range(n_joins)]
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client.give_participant_role(m) for m in members))
+    joined = time.perf_counter() - t0
+    await database.flush()
+    ids = await database.get_participants_ids(client.guild.name)
+    assert len(ids) == n_joins
+    report(f'{name} (flushed after {time.perf_counter() - t0:.2f}s)',
+      n_joins, joined, 'joins')
+
+async def bench_hydration(n_participants=2000, latency=0.005):
+  # Startup caching of the stored participants discord.py hasn't cached
+  for name in ('fetch one by one', 'chunked queries'):
+    client = await simulated_tournament(0, simulation.Backend(latency))
+    ids = [client.guild.add_uncached_member().id for _ in range(n_participants)]
+    t0 = time.perf_counter()
+    if name == 'fetch one by one':
+      members = [await client.guild.fetch_member(id) for id in ids]
+    else:
+      members = await client.hydrate_members(ids)
+    print(f'{name}: {len(members)} members in {time.perf_counter() - t0:.2f} seconds, '
+      f'{client.guild.backend.calls[simulation.ROUTE_MEMBERS]} round trips')
+
+async def replay_one_by_one(client):
+  # How execute_old_commands used to replay the backlog
+  already_done = set()
+  async for msg in client.get_waiting_chat().history(limit=10000):
+    if msg.author.id == client.user.id:
+      break
+    if discord.utils.get(msg.reactions, me=True):
+      break
+    if not msg.author in already_done:
+      if await RuleProcessor(JoinCmdRule(client), QuitCmdRule(client)).run(msg):
+        already_done.add(msg.author)
+
+async def bench_backlog(n_messages=5000, n_authors=1000, latency=0.005):
+  # Startup after downtime during the signup rush
+  results = []
+  for name, replay in (('one by one', replay_one_by_one),
+      ('reduced', TournamentClient.execute_old_commands)):
+    random.seed(0)
+    database.store = database.MemoryStore()
+    client = await simulated_tournament(0, simulation.Backend(latency))
+    members = [client.guild.add_member() for _ in range(n_authors)]
+    chat = client.get_waiting_chat()
+    for _ in range(n_messages):
+      chat.post(random.choice(members),
+        random.choice(('join', 'JOIN', 'quit', 'gg', 'who is hosting?')))
+    client.guild.backend.calls.clear()
+    t0 = time.perf_counter()
+    await replay(client)
+    await client.publisher.flush()
+    calls = client.guild.backend.calls
+    print(f'{name}: {n_messages} messages replayed in {time.perf_counter() - t0:.2f} seconds, '
+      f'{sum(calls.values())} requests ({calls[simulation.ROUTE_HISTORY] + calls[ROUTE_MESSAGE]} history/publish, '
+      f'{calls[ROUTE_MEMBER_ROLE]} role, {calls[ROUTE_REACTION]} reactions)')
+    # Both replays must end with the same participants
+    positions = {m.id: i for i, m in enumerate(members)}
+    results.append(sorted(positions[int(id)]
+      for id in await database.get_participants_ids(client.guild.name)))
+  assert results[0] == results[1]
+
+async def bench_checkpoint(n_old=20000, n_new=200, latency=0.005):
+  # Startup after a short downtime in a chat with a long history the bot
+  # already went through, its last answer being far behind
+  results = []
+  for name, checkpointed in (('scan', False), ('checkpoint', True)):
+    random.seed(0)
+    database.store = database.MemoryStore()
+    client = await simulated_tournament(0, simulation.Backend(latency))
+    members = [client.guild.add_member() for _ in range(n_new)]
+    chat = client.get_waiting_chat()
+    await chat.send('Welcome!')
+    for _ in range(n_old):
+      msg = chat.post(random.choice(members), random.choice(('gg', 'who is hosting?')))
+    if checkpointed:
+      await database.put_checkpoint(client.guild.name, msg.id)
+    for member in members:
+      chat.post(member, random.choice(('join', 'gg')))
+    client.guild.backend.calls.clear()
+    t0 = time.perf_counter()
+    await client.execute_old_commands()
+    await client.publisher.flush()
+    calls = client.guild.backend.calls
+    print(f'{name}: backlog of {n_new} messages after {n_old} read in '
+      f'{time.perf_counter() - t0:.2f} seconds, '
+      f'{calls[simulation.ROUTE_HISTORY] + calls[ROUTE_MESSAGE]} history/publish requests')
+    positions = {m.id: i for i, m in enumerate(members)}
+    results.append(sorted(positions[int(id)]
+      for id in await database.get_participants_ids(client.guild.name)))
+  assert results[0] == results[1]
+
+async def crowded_tournament(n_roles, n_channels, n_lobbies, devnull):
+  # A TournamentClient prepared by on_ready in a guild with many other
+  # roles and channels, during the lobby phase
+  database.store = database.MemoryStore()
+  guild = simulation.Guild(GUILD_NAME, simulation.Backend(0))
+  for i in range(n_roles):
+    guild.add_role(f'role {i}')
+  categories = [await guild.create_category_channel(f'category {i}') for i in range(10)]
+  for i in range(n_channels):
+    await guild.create_voice_channel(f'channel {i}', category=categories[i % 10])
+  client = TournamentClient(guild_name=GUILD_NAME)
+  client.guild = guild
+  client._connection.user = guild.me
+  client.limiter = RateLimiter({})
+  client.metrics.port = None
+  with redirect_stdout(devnull):
+    await client.on_ready()
+    for i in range(n_lobbies):
+      await client.create_lobby(i+1, [])
+  return client
+
+async def bench_snapshot(n_roles=500, n_channels=3000, n_lobbies=20, n_starts=20):
+  # on_ready in a big guild during the lobby phase, searching the
+  # tournament's roles and channels by name or looking them up by ID
+  devnull = open(os.devnull, 'w')
+  client = await crowded_tournament(n_roles, n_channels, n_lobbies, devnull)
+  for warm_start in (False, True):
+    client.warm_start = warm_start
+    seconds = 0
+    for _ in range(n_starts):
+      client.reset()
+      with redirect_stdout(devnull):
+        t0 = time.perf_counter()
+        await client.on_ready()
+        seconds += time.perf_counter() - t0
+      assert len(client.get_lobbies()) == n_lobbies
+    print(f'snapshot {"on" if warm_start else "off"}: {n_starts} starts in {seconds:.3f} seconds '
+      f'({1000*seconds/n_starts:.2f} ms/start)')
+  devnull.close()
+
+def lookups_by_name(client, member):
+  # How the getters searched on every call for what doesn't exist, and how
+  # lobby roles were found
+  discord.utils.get(client.guild.channels, name=CHILL_ROOM_NAME)
+  discord.utils.get(client.guild.roles, name=VERIFIED_ROLE_NAME)
+  discord.utils.find(lambda r: LOBBY_ROLE_PREFIX in r.name, member.roles)
+  [r for r in client.guild.roles if LOBBY_ROLE_PREFIX in r.name]
+
+def indexed_lookups(client, member):
+  client.get_chill_room()
+  client.get_verified_role()
+  client.get_lobby_role_of(member)
+  client.get_lobby_roles()
+
+async def bench_index(n_roles=500, n_channels=3000, n_lobbies=20, n_calls=1000):
+  # The lookups commands make in a big guild without a chill room nor a
+  # verified role
+  devnull = open(os.devnull, 'w')
+  client = await crowded_tournament(n_roles, n_channels, n_lobbies, devnull)
+  client.guild.clients.append(client)
+  member = client.guild.add_member()
+  member.roles.extend(random.sample(client.guild.roles, 10))
+  member.roles.append(client.get_lobby_roles()['7'])
+  for name, lookups in (('by name', lookups_by_name), ('indexed', indexed_lookups)):
+    t0 = time.perf_counter()
+    for _ in range(n_calls):
+      lookups(client, member)
+    report(name, n_calls, time.perf_counter() - t0, unit='lookups')
+  # The index follows what's created, renamed and deleted by hand
+  chill_room = await client.guild.create_voice_channel(CHILL_ROOM_NAME)
+  lobby_role = client.get_lobby_roles()['3']
+  await lobby_role.delete()
+  await client.get_lobby_channels()['5'].edit(name=LOBBY_NAME_PREFIX + '50')
+  await asyncio.sleep(0.01)
+  assert client.get_chill_room() is chill_room
+  assert lobby_role not in client.get_lobby_roles().values()
+  assert '50' in client.get_lobby_channels() and '5' not in client.get_lobby_channels()
+  devnull.close()
+
+class OldRWLock:
+  # How asyncioext.RWLock used to work: the first reader takes the writers'
+  # lock and the last one gives it back, so overlapping readers keep it
+  def __init__(self):
+    self.w_lock = asyncio.Lock()
+    self.num_r_lock = asyncio.Lock()
+    self.num_r = 0
+  @asynccontextmanager
+  async def r_locked(self, label=None):
+    async with self.num_r_lock:
+      self.num_r += 1
+      if self.num_r == 1:
+        await self.w_lock.acquire()
+    try:
+      yield
+    finally:
+      async with self.num_r_lock:
+        self.num_r -= 1
+        if self.num_r == 0:
+          self.w_lock.release()
+  @asynccontextmanager
+  async def w_locked(self, label=None):
+    async with self.w_lock:
+      yield
+
+async def bench_rwlock(seconds=2, reader_every=0.002, reader_hold=0.01,
+    writer_every=0.2, writer_hold=0.02):
+  # Signup rush: JOINs keep coming while managers START and END
+  for name, lock in (('old', OldRWLock()), ('fair', RWLock())):
+    holders = {'r': 0, 'w': 0}
+    waits = {'r': [], 'w': []}
+    async def hold(kind, duration):
+      t0 = time.perf_counter()
+      locked = lock.w_locked('START') if kind == 'w' else lock.r_locked('JOIN')
+      async with locked:
+        waits[kind].append(time.perf_counter() - t0)
+        holders[kind] += 1
+        assert holders['w'] == 1 and holders['r'] == 0 if kind == 'w' else holders['w'] == 0
+        await asyncio.sleep(duration)
+        holders[kind] -= 1
+    async def arrivals(kind, every, duration):
+      tasks = []
+      t_end = time.perf_counter() + seconds
+      while time.perf_counter() < t_end:
+        tasks.append(asyncio.ensure_future(hold(kind, duration)))
+        await asyncio.sleep(every)
+      await asyncio.gather(*tasks)
+    await asyncio.gather(arrivals('r', reader_every, reader_hold),
+      arrivals('w', writer_every, writer_hold))
+    print(f'{name}: {len(waits["w"])} writers waited p50 {percentile(waits["w"], 50):.3f}s, '
+      f'max {max(waits["w"]):.3f}s; {len(waits["r"])} readers waited '
+      f'p50 {percentile(waits["r"], 50):.3f}s, max {max(waits["r"]):.3f}s')
+  print(lock.stats())
+  # A writer giving up leaves the lock usable
+  async with lock.w_locked('END'):
+    try:
+      await lock.r_acquire('LIST', timeout=0.01)
+      assert False
+    except asyncio.TimeoutError:
+      pass
+  async with lock.r_locked('LIST', timeout=0.01):
+    pass
+  assert lock.metrics['LIST'].timeouts == 1
+
+class GlobalLock:
+  # How commands used to lock: a single RWLock held for their whole run,
+  # written by the commands below and read by every other
+  writers = {CMD_PREPARE, CMD_CLEAN, CMD_SUMMON, CMD_MUTE, CMD_UNMUTE,
+    CMD_START, CMD_END}
+  def __init__(self):
+    self.lock = RWLock()
+  def locked(self, label=None, reads=(), writes=()):
+    if label in self.writers:
+      return self.lock.w_locked(label)
+    return self.lock.r_locked(label)
+  def stats(self):
+    return self.lock.stats()
+
+async def bench_locks(n_lobbies=10, lobby_size=10, n_joins=50, n_quits=20,
+    latency=0.02):
+  # A BROADCAST, every manager muting their lobby and some unmuting it
+  # again, while people JOIN and QUIT
+  for name, locks in (('global lock', GlobalLock), ('resource locks', LockManager)):
+    random.seed(0)
+    database.store = database.MemoryStore()
+    client = await simulated_tournament(0, simulation.Backend(latency))
+    client.locks = locks()
+    guild = client.guild
+    managers, participants = [], []
+    for i in range(n_lobbies):
+      lobby = await client.create_lobby(i+1, [])
+      manager = guild.add_member(channel=lobby)
+      manager.roles.append(client.manager_role)
+      managers.append(manager)
+      for _ in range(lobby_size):
+        member = guild.add_member(channel=lobby)
+        member.roles.append(client.participant_role)
+        participants.append(member)
+    joiners = [guild.add_member() for _ in range(n_joins)]
+    quitters = random.sample(participants, n_quits)
+    chat = client.get_waiting_chat()
+    msgs = [chat.post(managers[0], f'{CMD_BROADCAST} good luck!')]
+    msgs += [chat.post(m, CMD_MUTE) for m in managers]
+    stream = [chat.post(m, CMD_JOIN) for m in joiners] + \
+      [chat.post(m, CMD_QUIT) for m in quitters]
+    random.shuffle(stream)
+    msgs += stream
+    msgs += [chat.post(m, CMD_UNMUTE) for m in managers[:n_lobbies//2]]
+    latencies = {}
+    async def handle(msg):
+      t0 = time.perf_counter()
+      await client.on_message(msg)
+      latencies.setdefault(msg.content.split()[0], []).append(time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+      await asyncio.gather(*(handle(msg) for msg in msgs))
+    print(f'{name}: {len(msgs)} commands in {time.perf_counter() - t0:.2f} seconds; ' +
+      ', '.join(f'{cmd} p50 {percentile(ls, 50):.2f}s max {max(ls):.2f}s'
+        for cmd, ls in latencies.items()))
+    # Same outcome whatever the locking
+    assert all(r.emoji == OK_REACTION for msg in msgs for r in msg.reactions)
+    assert set(client.get_participants()) == \
+      set(participants).difference(quitters).union(joiners)
+    for i, manager in enumerate(managers):
+      speak = manager.voice.channel.overwrites_for(client.participant_role).speak
+      assert speak == (i < n_lobbies//2)
+
+class RunEverything:
+  # How JOIN and QUIT used to run: every single one of them
+  async def submit(self, user_id, run):
+    await run()
+    return True
+  def stats(self):
+    return 'all run'
+
+async def bench_coalesce(n_users=100, n_commands=10, latency=0.02):
+  # Users spamming JOIN and QUIT as fast as they can
+  outcomes = []
+  for name, coalescer in (('every command', RunEverything()),
+      ('coalesced', Coalescer(rate=n_commands)), ('coalesced and shed', Coalescer())):
+    random.seed(0)
+    database.store = database.MemoryStore()
+    client = await simulated_tournament(0, simulation.Backend(latency))
+    client.coalescer = coalescer
+    users = [client.guild.add_member() for _ in range(n_users)]
+    chat = client.get_waiting_chat()
+    msgs = [chat.post(user, random.choice((CMD_JOIN, CMD_QUIT)))
+      for _ in range(n_commands) for user in users]
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client.on_message(msg) for msg in msgs))
+    await client.publisher.flush()
+    calls = client.guild.backend.calls
+    print(f'{name}: {len(msgs)} commands in {time.perf_counter() - t0:.2f} seconds, '
+      f'{calls[ROUTE_MEMBER] + calls[ROUTE_MEMBER_ROLE]} role edits, {calls[ROUTE_REACTION]} reactions, '
+      f'{calls[ROUTE_MESSAGE]} publishes; {coalescer.stats()}')
+    outcomes.append([client.participant_role in user.roles for user in users])
+  # Coalescing keeps everyone's last word
+  assert outcomes[0] == outcomes[1]
+
+def lobby_quality(lobbies, ratings, history):
+  # Pairs that already played together, and spread of the lobbies' mean ratings
+  met = set()
+  for past_lobbies in history:
+    for lobby in past_lobbies:
+      met.update((a, b) for a in lobby for b in lobby if a < b)
+  repeats = sum((a, b) in met for lobby in lobbies for a in lobby for b in lobby if a < b)
+  means = [sum(ratings[str(id)] for id in lobby) / len(lobby) for lobby in lobbies]
+  mean = sum(means) / len(means)
+  return repeats, (sum((m - mean) ** 2 for m in means) / len(means)) ** 0.5
+
+async def loop_lag(task):
+  # Longest the event loop was blocked while task ran
+  lag = 0
+  done = asyncio.ensure_future(task)
+  while not done.done():
+    t0 = time.perf_counter()
+    await asyncio.sleep(0.001)
+    lag = max(lag, time.perf_counter() - t0 - 0.001)
+  return done.result(), lag
+
+async def bench_matchmaking(sizes=(100, 1000, 10000), n_rounds=MATCHMAKING_HISTORY):
+  # START in tournaments of every size, after a few rounds played
+  for n in sizes:
+    random.seed(0)
+    ids = list(range(1, n+1))
+    ratings = {str(id): random.gauss(DEFAULT_RATING, 200) for id in ids}
+    n_lobbies = (n + LOBBY_CAPACITY - 1) // LOBBY_CAPACITY
+    history = [matchmaking.make_lobbies(random.sample(ids, n * 4 // 5),
+      n_lobbies, 'random', seed=r) for r in range(n_rounds)]
+    for strategy in matchmaking.STRATEGIES:
+      t0 = time.perf_counter()
+      lobbies = matchmaking.make_lobbies(ids, n_lobbies, strategy, ratings, history, seed=0)
+      seconds = time.perf_counter() - t0
+      assert sorted(id for lobby in lobbies for id in lobby) == ids
+      assert max(map(len, lobbies)) <= LOBBY_CAPACITY
+      repeats, spread = lobby_quality(lobbies, ratings, history)
+      print(f'{n} players, {strategy}: {seconds:.3f} seconds, {repeats} repeated pairs, '
+        f'lobby mean ratings spread {spread:.1f}')
+  # The biggest one inside and outside of the event loop
+  players = [simulation.User(id, str(id)) for id in ids]
+  for processes in (0, 1):
+    matchmaker = matchmaking.Matchmaker(processes=processes)
+    lobbies, lag = await loop_lag(matchmaker.make_lobbies(players, ratings, history))
+    matchmaker.close()
+    print(f'{n} players, {processes} processes: event loop blocked up to {lag:.3f} seconds')
+
+async def sequential_start(client, lobbies):
+  # How START used to run: each lobby's role, grants and channel one after
+  # the other, then every move
+  moves = []
+  for l, players in enumerate(lobbies):
+    index = str(l+1)
+    role = await client.create_role(LOBBY_ROLE_PREFIX + index)
+    for member in players:
+      await client.give_lobby_role(member, role)
+    lobby = await client.create_voice_channel(name=LOBBY_NAME_PREFIX + index,
+      category=client.get_tournament_category(),
+      overwrites=permissions.get_lobby_overwrites(client, lobby_role=role))
+    client.get_lobby_channels()[index] = lobby
+    client.get_lobby_roles()[index] = role
+    moves.extend((member, lobby) for member in players)
+  await client.mover.move_all(moves)
+
+async def bench_start(n_players=100, latency=0.05):
+  # Wall time of START, with Discord's latency alone and with its rate
+  # limits paced by the client
+  database.store = database.MemoryStore()
+  devnull = open(os.devnull, 'w')
+  for name, limits in (('latency', {}), ('rate limits', RATE_LIMITS)):
+    client = await simulated_tournament(n_players, simulation.Backend(latency), limits)
+    client.matchmaker = matchmaking.Matchmaker(processes=0)
+    lobbies = await client.make_lobbies(list(client.get_waiting_room().members))
+    t0 = time.perf_counter()
+    with redirect_stdout(devnull):
+      await sequential_start(client, lobbies)
+    print(f'{name}, sequential: {time.perf_counter() - t0:.2f} seconds')
+    client = await simulated_tournament(n_players, simulation.Backend(latency), limits)
+    client.matchmaker = matchmaking.Matchmaker(processes=0)
+    manager = client.guild.add_member(channel=client.waiting_room)
+    manager.roles.append(client.manager_role)
+    msg = client.get_waiting_chat().post(manager, CMD_START)
+    t0 = time.perf_counter()
+    with redirect_stdout(devnull):
+      await client.on_message(msg)
+      await client.publisher.flush()
+    seconds = time.perf_counter() - t0
+    assert [r.emoji for r in msg.reactions] == [OK_REACTION]
+    assert all(m.voice.channel.name.startswith(LOBBY_NAME_PREFIX)
+      for m in client.get_participants())
+    report_timings = client.get_waiting_chat().messages[-1].content.split('\n')[-1]
+    print(f'{name}, pipelined: {seconds:.2f} seconds, {report_timings}')
+  devnull.close()
+
+def classify_all(client):
+  # How SUMMON used to sort the participants, checking each one
+  counts = Counter()
+  for member in client.get_participants():
+    if client.is_faraway(member):
+      counts[FARAWAY] += 1
+    elif client.is_waiting(member):
+      counts[WAITING] += 1
+    elif member.is_on_mobile():
+      counts[MOBILE] += 1
+    elif client.is_offline_or_invisible(member):
+      counts[INVISIBLE] += 1
+    elif client.is_busy(member):
+      counts[BUSY] += 1
+    else:
+      counts[MOVABLE] += 1
+  return counts
+
+async def bench_presence(n_participants=5000, n_spectators=15000, n_events=5000,
+    n_queries=20):
+  # Participants spread between the waiting room, gaming channels and the
+  # rest of the guild, switching channel, device and status all along
+  random.seed(0)
+  client = await simulated_tournament(n_participants)
+  guild = client.guild
+  guild.clients.append(client)
+  for _ in range(n_spectators):
+    guild.add_member()
+  gaming = await guild.create_category_channel(
+    next(iter(MOVE_PROTECTED_CATEGORIES - {CATEGORY_CHANNEL_NAME})))
+  rooms = [None, client.waiting_room, await guild.create_voice_channel(
+    'Among Us 1', category=gaming), await guild.create_voice_channel('General')]
+  participants = client.get_participants()
+  devnull = open(os.devnull, 'w')
+  async def churn(n):
+    # quiet, the client printing who enters and exits the waiting room
+    with redirect_stdout(devnull):
+      await move_around(n)
+      await asyncio.sleep(0.01) # for the gateway events to land
+  async def move_around(n):
+    for _ in range(n):
+      member = random.choice(participants)
+      if random.random() < 0.5:
+        await member.move_to(random.choice(rooms))
+      else:
+        member.set_presence(random.choice([discord.Status.online,
+          discord.Status.offline]), random.random() < 0.2)
+  await churn(n_participants)
+  t0 = time.perf_counter()
+  for _ in range(n_queries):
+    expected = classify_all(client)
+  print(f'checking every participant: {(time.perf_counter() - t0) / n_queries * 1000:.2f} ms')
+  t0 = time.perf_counter()
+  client.presence.counts()
+  print(f'building the index: {(time.perf_counter() - t0) * 1000:.2f} ms')
+  t0 = time.perf_counter()
+  await churn(n_events)
+  seconds = time.perf_counter() - t0
+  t0 = time.perf_counter()
+  for _ in range(n_queries):
+    counts = client.presence.counts()
+  print(f'indexed counts: {(time.perf_counter() - t0) / n_queries * 1000:.4f} ms, '
+    f'{n_events} events in {seconds:.2f} seconds')
+  expected = classify_all(client)
+  assert counts == {bucket: expected[bucket] for bucket in counts}, (counts, expected)
+  print(f'counts: {counts}')
+  manager = guild.add_member(channel=client.waiting_room)
+  manager.roles.append(client.manager_role)
+  msg = client.get_waiting_chat().post(manager, CMD_STATUS)
+  t0 = time.perf_counter()
+  await client.on_message(msg)
+  await client.publisher.flush()
+  print(f'STATUS in {(time.perf_counter() - t0) * 1000:.2f} ms: '
+    f'{client.get_waiting_chat().messages[-1].content}')
+  msg = client.get_waiting_chat().post(manager, CMD_SUMMON)
+  t0 = time.perf_counter()
+  with redirect_stdout(devnull):
+    await client.on_message(msg)
+    await asyncio.sleep(0.01)
+  print(f'SUMMON in {time.perf_counter() - t0:.2f} seconds, '
+    f'{client.presence.counts()[WAITING]} waiting now')
+  assert client.presence.counts()[WAITING] == counts[WAITING] + counts[MOVABLE]
+  devnull.close()
+
+async def bench_autosummon(n_participants=1000, n_switching=200, seconds=3,
+    summon_every=1, latency=0.02):
+  # Participants on mobile around the guild, some switching to desktop over
+  # a few seconds: SUMMON sent again and again or armed once as AUTOSUMMON
+  devnull = open(os.devnull, 'w')
+  for name in ('repeated SUMMON', 'AUTOSUMMON'):
+    random.seed(0)
+    client = await simulated_tournament(0, simulation.Backend(latency))
+    guild = client.guild
+    guild.clients.append(client)
+    guild.gateway_latency = (0.01, 0.05)
+    general = await guild.create_voice_channel('General')
+    for _ in range(n_participants):
+      member = guild.add_member(channel=general)
+      member.roles.append(client.participant_role)
+      member.mobile = True
+    manager = guild.add_member(channel=client.waiting_room)
+    manager.roles.append(client.manager_role)
+    switched = {} # member id -> when they left mobile
+    arrived = {} # member id -> seconds from switching to the waiting room
+    def on_change(member, key):
+      if key[0] == WAITING and member.id in switched:
+        arrived[member.id] = time.perf_counter() - switched[member.id]
+    client.presence.listeners.append(on_change)
+    async def switch(member):
+      await asyncio.sleep(random.uniform(0, seconds))
+      switched[member.id] = time.perf_counter()
+      member.set_presence(mobile=False)
+    async def command(content):
+      await client.on_message(client.get_waiting_chat().post(manager, content))
+    guild.backend.calls.clear()
+    t0 = time.perf_counter()
+    with redirect_stdout(devnull):
+      switching = asyncio.gather(*(switch(member)
+        for member in random.sample(client.get_participants(), n_switching)))
+      if name == 'AUTOSUMMON':
+        await command(CMD_AUTOSUMMON)
+        await switching
+        await asyncio.sleep(summon_every)
+        await command(f'{CMD_AUTOSUMMON} {CMD_STOP}')
+      else:
+        while not switching.done():
+          await command(CMD_SUMMON)
+          await asyncio.sleep(summon_every)
+        await command(CMD_SUMMON)
+      await asyncio.sleep(0.5)
+      await client.publisher.flush()
+    if name == 'AUTOSUMMON':
+      assert client.get_waiting_chat().messages[-1].content == AUTO_SUMMON_ENDED.format(
+        n_moved=n_switching, n_failed=0)
+    waits = list(arrived.values())
+    print(f'{name}: {len(arrived)}/{n_switching} summoned in {time.perf_counter() - t0:.2f} seconds, '
+      f'waited p50 {percentile(waits, 50):.2f}s p99 {percentile(waits, 99):.2f}s, '
+      f'{guild.backend.calls[ROUTE_MEMBER]} moves, {guild.backend.calls[ROUTE_DM]} DM channels opened')
+  devnull.close()
+
+class DirectPublisher:
+  # How the client used to publish: a message per call, however long
+  def __init__(self, client):
+    self.client = client
+  async def publish(self, embed):
+    if isinstance(embed, str):
+      embed = discord.Embed(description=embed)
+    await self.client.get_waiting_chat().send(embed=embed)
+  async def flush(self):
+    pass
+
+async def bring_one_by_one(client, members):
+  # How BRING used to announce each member it brought
+  for member in members:
+    if await client.give_participant_role(member):
+      await client.publish(MEMBER_JOINS.format(member=member.mention))
+
+async def bench_publish(n_brought=200, n_listed=1000, latency=0.02):
+  # Announcements of a big BRING and a LIST of a big roster
+  database.store = database.MemoryStore()
+  devnull = open(os.devnull, 'w')
+  for name in ('direct', 'publisher'):
+    client = await simulated_tournament(n_listed, simulation.Backend(latency))
+    if name == 'direct':
+      client.publisher = DirectPublisher(client)
+    manager = client.guild.add_member(channel=client.waiting_room)
+    manager.roles.append(client.manager_role)
+    chat = client.get_waiting_chat()
+    members = [client.guild.add_member() for _ in range(n_brought)]
+    for command, content in (
+        (CMD_BRING, ' '.join([CMD_BRING] + [m.mention for m in members])),
+        (CMD_LIST, CMD_LIST)):
+      n_messages = len(chat.messages)
+      msg = chat.post(manager, content)
+      t0 = time.perf_counter()
+      with redirect_stdout(devnull), redirect_stderr(devnull):
+        if command == CMD_BRING and name == 'direct':
+          await bring_one_by_one(client, members)
+          await client.react(msg, OK_REACTION)
+        else:
+          await client.on_message(msg)
+        await client.publisher.flush()
+      sent = chat.messages[n_messages + 1:]
+      print(f'{name}, {command} of {len(client.get_participants())}: '
+        f'{time.perf_counter() - t0:.2f} seconds, {len(sent)} messages, '
+        f'{"".join(r.emoji for r in msg.reactions)}, '
+        f'longest {max((len(m.content) for m in sent), default=0)} characters')
+  devnull.close()
+
+async def scenario_guild(n_participants, latency=0.05, failures={}, lost_moves=0.0,
+    gateway_latency=(0.01, 0.1), seed=0):
+  # A TournamentClient, unmodified, with its own rate limiter, in a guild
+  # enforcing Discord's limits, n_participants members spread across its
+  # voice channels and devices, and a manager in the waiting room.
+  random.seed(seed)
+  database.store = database.MemoryStore()
+  guild = simulation.Guild(GUILD_NAME,
+    simulation.Backend(latency, DISCORD_RATE_LIMITS, failures))
+  guild.gateway_latency = gateway_latency
+  guild.lost_moves = lost_moves
+  client = TournamentClient(guild_name=GUILD_NAME)
+  client.matchmaker = matchmaking.Matchmaker(processes=0)
+  client.metrics.port = 0 # any free port
+  guild.link(client)
+  general = await guild.create_voice_channel('General')
+  gaming = await guild.create_category_channel(
+    next(iter(MOVE_PROTECTED_CATEGORIES - {CATEGORY_CHANNEL_NAME})))
+  busy_room = await guild.create_voice_channel('Among Us 1', category=gaming)
+  members = [guild.add_member() for _ in range(n_participants)]
+  await client.on_ready()
+  manager = guild.add_member(channel=client.get_waiting_room())
+  manager.roles.append(client.get_manager_role())
+  for member in members:
+    member.join_voice(random.choices([client.get_waiting_room(), general,
+      busy_room, None], [40, 20, 10, 30])[0])
+    member.set_presence(random.choices([discord.Status.online,
+      discord.Status.offline], [95, 5])[0], random.random() < 0.1)
+    member.dms_closed = random.random() < 0.02
+  await asyncio.sleep(gateway_latency[1])
+  return guild, client, manager, members
+
+async def run_scenario(n_participants, latency=0.05, failures={ROUTE_DM: 0.02},
+    lost_moves=0.01, gateway_latency=(0.01, 0.1), seed=0):
+  # The participants JOIN, then a manager runs a round. Returns each
+  # command's wall time and requests.
+  guild, client, manager, members = await scenario_guild(n_participants,
+    latency, failures, lost_moves, gateway_latency, seed)
+  chat = client.get_waiting_chat()
+  rows = []
+  async def run(name, msgs):
+    calls = Counter(guild.backend.calls)
+    rate_limited = Counter(guild.backend.rate_limited)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client.on_message(msg) for msg in msgs))
+    await client.publisher.flush()
+    seconds = time.perf_counter() - t0
+    await asyncio.sleep(gateway_latency[1])
+    rows.append({
+      'command': name,
+      'messages': len(msgs),
+      'seconds': seconds,
+      'requests': dict(guild.backend.calls - calls),
+      'rate_limited': sum((guild.backend.rate_limited - rate_limited).values()),
+      'failed': sum(1 for msg in msgs for r in msg.reactions if r.emoji == KO_REACTION),
+    })
+  await run(CMD_JOIN, [chat.post(member, CMD_JOIN) for member in members])
+  for command in (CMD_LIST, CMD_STATUS, f'{CMD_BROADCAST} gl hf',
+      CMD_SUMMON, CMD_START, CMD_END):
+    await run(command.split()[0], [chat.post(manager, command)])
+  client.matchmaker.close()
+  return rows
+
+async def bench_scenarios(sizes=(10, 100, 1000)):
+  # Wall time and requests of each command, Discord's latency, rate limits
+  # and some failures included
+  devnull = open(os.devnull, 'w')
+  for n in sizes:
+    with redirect_stdout(devnull), redirect_stderr(devnull):
+      rows = await run_scenario(n)
+    print(f'{n} participants:')
+    for row in rows:
+      requests = ', '.join(f'{n} {bucket}'
+        for bucket, n in sorted(row['requests'].items()))
+      print(f"  {row['command']} x{row['messages']}: {row['seconds']:.2f} seconds, "
+        f"{sum(row['requests'].values())} requests ({requests}), "
+        f"{row['rate_limited']} 429s, {row['failed']} failed")
+  devnull.close()
+
+# Mixes of messages replayed by the storm benchmark: how many users, how
+# many messages per second for how long, the share sent in DMs and the
+# weight of each command, None standing for chatter
+STORMS = {
+  'signup': dict(n_users=500, rate=100, seconds=5, dm_ratio=0.1,
+    mix={CMD_JOIN: 60, CMD_QUIT: 5, CMD_LIST: 5, None: 30}),
+  'chatter': dict(n_users=200, rate=200, seconds=5, dm_ratio=0.05,
+    mix={CMD_JOIN: 2, CMD_STATUS: 1, None: 97}),
+}
+STORM_RESULTS = 'storm_results.json'
+
+def summarize(values, ps=(50, 90, 99)):
+  summary = {f'p{p}': percentile(values, p) for p in ps}
+  summary['max'] = max(values, default=0.0)
+  summary['count'] = len(values)
+  return summary
+
+async def run_storm(n_users, rate, seconds, dm_ratio, mix, latency=0.05, seed=0):
+  # Messages arriving as a Poisson process of `rate` per second, from
+  # random users, in the waiting chat or in DMs, each handed to
+  # on_message as the gateway would. Latencies run from the arrival to
+  # the end of on_message, so they include the time the loop was late.
+  guild, client, manager, members = await scenario_guild(n_users, latency, seed=seed)
+  chat = client.get_waiting_chat()
+  loop = asyncio.get_event_loop()
+  client.locks.metrics = {}
+  calls = Counter(guild.backend.calls)
+  rate_limited = Counter(guild.backend.rate_limited)
+  kinds, weights = list(mix), list(mix.values())
+  latencies = {} # command, or 'chatter', -> seconds
+  lags = []
+  msgs = []
+  tasks = []
+  async def deliver(kind, msg, arrival):
+    await client.on_message(msg)
+    latencies.setdefault(kind or 'chatter', []).append(loop.time() - arrival)
+  def arrive(kind, msg, arrival):
+    tasks.append(asyncio.ensure_future(deliver(kind, msg, arrival)))
+  start = arrival = loop.time()
+  while True:
+    arrival += random.expovariate(rate)
+    if arrival - start > seconds:
+      break
+    kind = random.choices(kinds, weights)[0]
+    author = random.choice(members)
+    content = kind or random.choice(simulation.CHATTER)
+    if random.random() < dm_ratio:
+      msg = simulation.Message(author, simulation.DMChannel(author), content)
+    else:
+      msg = chat.post(author, content)
+    msgs.append(msg)
+    loop.call_at(arrival, arrive, kind, msg, arrival)
+  async def sample_lag(period=0.01):
+    # how late the loop wakes up a task sleeping for period
+    while True:
+      t0 = loop.time()
+      await asyncio.sleep(period)
+      lags.append(loop.time() - t0 - period)
+  sampler = asyncio.ensure_future(sample_lag())
+  while len(tasks) < len(msgs):
+    await asyncio.sleep(0.01)
+  await asyncio.gather(*tasks)
+  elapsed = loop.time() - start
+  sampler.cancel()
+  await client.publisher.flush()
+  client.matchmaker.close()
+  return {
+    'users': n_users,
+    'offered_rate': rate,
+    'messages': len(msgs),
+    'dms': sum(1 for msg in msgs if isinstance(msg.channel, simulation.DMChannel)),
+    'seconds': elapsed,
+    'throughput': len(msgs) / elapsed,
+    'latency': {kind: summarize(values) for kind, values in latencies.items()},
+    'locks': {label: {
+        'wait': summarize(metrics.wait.values),
+        'hold': summarize(metrics.hold.values),
+        'timeouts': metrics.timeouts,
+      } for label, metrics in client.locks.metrics.items()},
+    'loop_lag': summarize(lags),
+    'requests': dict(guild.backend.calls - calls),
+    'rate_limited': sum((guild.backend.rate_limited - rate_limited).values()),
+    'failed': sum(1 for msg in msgs for r in msg.reactions if r.emoji == KO_REACTION),
+    'coalescer': {'run': client.coalescer.n_run,
+      'coalesced': client.coalescer.n_coalesced,
+      'dropped': client.coalescer.n_dropped},
+  }
+
+async def bench_storm(storms=STORMS, path=STORM_RESULTS):
+  # Throughput and latencies of on_message under bursts of commands and
+  # chatter, written to path as JSON to compare runs
+  results = {}
+  devnull = open(os.devnull, 'w')
+  for name, storm in storms.items():
+    with redirect_stdout(devnull), redirect_stderr(devnull):
+      results[name] = result = await run_storm(**storm)
+    print(f"{name}: {result['messages']} messages ({result['dms']} DMs) "
+      f"from {result['users']} users in {result['seconds']:.2f} seconds, "
+      f"{result['throughput']:.0f}/s for {result['offered_rate']}/s offered, "
+      f"{sum(result['requests'].values())} requests, "
+      f"{result['rate_limited']} 429s, {result['failed']} failed")
+    for kind, s in result['latency'].items():
+      print(f"  {kind} x{s['count']}: p50 {s['p50']*1000:.1f} ms, "
+        f"p90 {s['p90']*1000:.1f} ms, p99 {s['p99']*1000:.1f} ms")
+    for label, metrics in result['locks'].items():
+      wait, hold = metrics['wait'], metrics['hold']
+      print(f"  lock {label}: wait p50 {wait['p50']*1000:.1f} ms, "
+        f"p99 {wait['p99']*1000:.1f} ms; hold p50 {hold['p50']*1000:.1f} ms, "
+        f"p99 {hold['p99']*1000:.1f} ms; {metrics['timeouts']} timeouts")
+    lag = result['loop_lag']
+    print(f"  loop lag: p50 {lag['p50']*1000:.1f} ms, p99 {lag['p99']*1000:.1f} ms, "
+      f"max {lag['max']*1000:.1f} ms")
+    coalescer = result['coalescer']
+    print(f"  JOIN and QUIT: {coalescer['run']} run, "
+      f"{coalescer['coalesced']} coalesced, {coalescer['dropped']} dropped")
+  devnull.close()
+  with open(path, 'w') as f:
+    json.dump(results, f, indent=2)
+  print(f'Results written to {path}')
+
+def per_call(fn, n):
+  t0 = time.perf_counter()
+  for _ in range(n):
+    fn()
+  return (time.perf_counter() - t0) / n
+
+async def bench_metrics(n_calls=100000, n_participants=100):
+  # What recording costs per call, then a tournament's metrics as scraped
+  # from its endpoint and as STATS publishes them
+  metrics = Metrics(port=None)
+  histogram = metrics.histogram('command_execute_seconds', command=CMD_JOIN)
+  observe = per_call(lambda: histogram.observe(0.01), n_calls)
+  count = per_call(lambda: metrics.count('commands_total', command=CMD_JOIN,
+    outcome='ok'), n_calls)
+  print(f'observe: {1e9*observe:.0f} ns, count: {1e9*count:.0f} ns')
+  requests = {}
+  for name, limiter in (('without metrics', RateLimiter({})),
+      ('with metrics', RateLimiter({}, metrics))):
+    t0 = time.perf_counter()
+    for _ in range(n_calls):
+      async with limiter.request(ROUTE_MEMBER, 0, 'move'):
+        pass
+    requests[name] = (time.perf_counter() - t0) / n_calls
+    print(f'limiter.request {name}: {1e9*requests[name]:.0f} ns')
+  devnull = open(os.devnull, 'w')
+  with redirect_stdout(devnull), redirect_stderr(devnull):
+    guild, client, manager, members = await scenario_guild(n_participants, latency=0.01)
+    chat = client.get_waiting_chat()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client.on_message(chat.post(member, CMD_JOIN))
+      for member in members))
+    await client.on_message(chat.post(manager, CMD_SUMMON))
+    await client.publisher.flush()
+    seconds = time.perf_counter() - t0
+    await client.on_message(chat.post(manager, CMD_STATS))
+    await client.publisher.flush()
+  devnull.close()
+  metrics = client.metrics
+  n_observed = sum(h.count for h in metrics.histograms.values())
+  n_requests = metrics.get_count('rest_requests_total')
+  n_counted = metrics.get_count('commands_total') + n_requests
+  overhead = n_observed * observe + n_counted * count \
+    + n_requests * (requests['with metrics'] - requests['without metrics'])
+  print(f'JOIN x{n_participants} and SUMMON: {seconds:.2f} seconds, {n_observed} '
+    f'observations and {n_counted} counts costing {1000*overhead:.2f} ms '
+    f'({100*overhead/seconds:.3f}%)')
+  host, port = metrics.server.sockets[0].getsockname()[:2]
+  t0 = time.perf_counter()
+  reader, writer = await asyncio.open_connection(host, port)
+  writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+  response = await reader.read()
+  writer.close()
+  scrape = time.perf_counter() - t0
+  head, body = response.split(b'\r\n\r\n', 1)
+  lines = body.decode().splitlines()
+  print(f'scrape: {head.splitlines()[0].decode()}, {len(body)} bytes, '
+    f'{sum(1 for line in lines if not line.startswith("#"))} samples '
+    f'in {1000*scrape:.2f} ms')
+  print(f'STATS:\n{chat.messages[-1].content}')
+  metrics.close()
+  client.matchmaker.close()
+
+BENCHMARKS = {
+  'dispatch': bench_dispatch,
+  'mover': bench_mover,
+  'ratelimit': bench_ratelimit,
+  'lobby_calls': bench_lobby_calls,
+  'mute': bench_mute,
+  'broadcast': bench_broadcast,
+  'move_tracker': bench_move_tracker,
+  'store': bench_store,
+  'hydration': bench_hydration,
+  'backlog': bench_backlog,
+  'checkpoint': bench_checkpoint,
+  'snapshot': bench_snapshot,
+  'index': bench_index,
+  'rwlock': bench_rwlock,
+  'locks': bench_locks,
+  'coalesce': bench_coalesce,
+  'matchmaking': bench_matchmaking,
+  'start': bench_start,
+  'presence': bench_presence,
+  'autosummon': bench_autosummon,
+  'publish': bench_publish,
+  'scenarios': bench_scenarios,
+  'storm': bench_storm,
+  'metrics': bench_metrics,
+}
+
+if __name__ == "__main__":
+  names = sys.argv[1:] or BENCHMARKS.keys()
+  for name in names:
+    print(f'### {name}')
+    asyncio.get_event_loop().run_until_complete(BENCHMARKS[name]())
@@ -0,0 +1,39 @@
+import asyncio
+import sys
+import discord
+from constants import DM_CONCURRENCY, ROUTE_DM, ROUTE_MESSAGE
+
+class Broadcaster:
+  """ Sends Direct Messages to many users at once, keeping at most
+      `concurrency` of them in flight and each user's DM channel cached.
+      A user who can't be reached doesn't stop the others: outcomes are
+      returned in the same order as the messages, None for a delivered one
+      or the HTTPException that made it fail.
+      Usage:
+          outcomes = await broadcaster.send_all([(user, text), ...])
+  """
+
+  def __init__(self, limiter, concurrency=DM_CONCURRENCY):
+    self.limiter = limiter
+    self.semaphore = asyncio.Semaphore(concurrency)
+    self.dm_channels = {} # user id -> DMChannel
+
+  async def get_dm_channel(self, user):
+    if user.id not in self.dm_channels:
+      async with self.limiter.request(ROUTE_DM, None, 'create_dm'):
+        self.dm_channels[user.id] = await user.create_dm()
+    return self.dm_channels[user.id]
+
+  async def send(self, user, txt):
+    async with self.semaphore:
+      try:
+        dm_channel = await self.get_dm_channel(user)
+        async with self.limiter.request(ROUTE_MESSAGE, dm_channel.id, 'send_dm'):
+          await dm_channel.send(txt)
+      except discord.errors.HTTPException as e:
+        print(f"Couldn't send a Direct Message to {user}", file=sys.stderr)
+        print(e)
+        return e
+
+  async def send_all(self, messages):
+    return await asyncio.gather(*(self.send(user, txt) for user, txt in messages))
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from collections import deque
+from constants import USER_COMMANDS_RATE, USER_COMMANDS_PER
+
+class Coalescer:
+  """ Runs one command at a time per user. The commands a user sends while
+      one of theirs runs wait for it, and only the last of them runs, as
+      it decides the outcome anyway: JOIN, QUIT, JOIN while a JOIN runs
+      comes down to a single JOIN. Users sending more than `rate` commands
+      within `per` seconds have the extra ones dropped.
+      Usage:
+          if await coalescer.submit(user.id, lambda: execute(...)):
+            ... # it ran, otherwise it was coalesced or dropped
+  """
+
+  def __init__(self, rate=USER_COMMANDS_RATE, per=USER_COMMANDS_PER):
+    self.rate = rate
+    self.per = per
+    self.running = set() # users with a command running
+    self.pending = {} # user -> future of their last command waiting
+    self.recent = {} # user -> times of their last commands
+    self.swept = time.monotonic()
+    # stats
+    self.n_run = 0
+    self.n_coalesced = 0
+    self.n_dropped = 0
+
+  def allow(self, user_id):
+    now = time.monotonic()
+    if now - self.swept >= self.per:
+      # forget the users who have been quiet for a while
+      self.recent = {user: times for user, times in self.recent.items()
+        if now - times[-1] < self.per}
+      self.swept = now
+    times = self.recent.setdefault(user_id, deque())
+    while times and now - times[0] >= self.per:
+      times.popleft()
+    if len(times) >= self.rate:
+      return False
+    times.append(now)
+    return True
+
+  async def submit(self, user_id, run):
+    if not self.allow(user_id):
+      self.n_dropped += 1
+      return False
+    if user_id in self.running:
+      if user_id in self.pending:
+        # superseded by this one
+        self.pending[user_id].set_result(False)
+        self.n_coalesced += 1
+      future = asyncio.get_event_loop().create_future()
+      self.pending[user_id] = future
+      try:
+        if not await future:
+          return False
+      except asyncio.CancelledError:
+        if self.pending.get(user_id) is future:
+          del self.pending[user_id]
+        elif future.done() and not future.cancelled() and future.result():
+          # its turn came, pass it on
+          self.next(user_id)
+        raise
+    else:
+      self.running.add(user_id)
+    try:
+      self.n_run += 1
+      await run()
+      return True
+    finally:
+      self.next(user_id)
+
+  def next(self, user_id):
+    if user_id in self.pending:
+      self.pending.pop(user_id).set_result(True)
+    else:
+      self.running.discard(user_id)
+
+  def stats(self):
+    return f'{self.n_run} run, {self.n_coalesced} coalesced, {self.n_dropped} dropped'
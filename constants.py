@@ -27,3 +27,118 @@ MOVE_PROTECTED_CATEGORIES = set([
   CATEGORY_CHANNEL_NAME,
 ])
 
+
+# Moves performed at the same time by START and SUMMON
+MOVER_CONCURRENCY = 10
+# How long AUTOSUMMON keeps moving participants once armed, by default
+AUTO_SUMMON_MINUTES = 10
+
+# Discord rate limits each route on its own for every guild or channel in
+# its path, its major parameter, and only tells the limits in the
+# X-RateLimit headers of its responses, which discord.py follows once a
+# bucket runs out. These are the limits assumed per route, as (requests,
+# seconds), that the client spreads its bursts under for each major
+# parameter. Moves, server mutes and role edits are all the same member
+# route, while every DM is sent in a channel of its own, so only opening
+# DM channels is limited across users.
+ROUTE_MEMBER = "PATCH /guilds/{guild_id}/members/{user_id}"
+ROUTE_MEMBER_ROLE = "/guilds/{guild_id}/members/{user_id}/roles/{role_id}"
+ROUTE_ROLES = "/guilds/{guild_id}/roles"
+ROUTE_CHANNELS = "POST /guilds/{guild_id}/channels"
+ROUTE_CHANNEL = "/channels/{channel_id}"
+ROUTE_PERMISSIONS = "PUT /channels/{channel_id}/permissions/{overwrite_id}"
+ROUTE_DM = "POST /users/@me/channels"
+ROUTE_MESSAGE = "POST /channels/{channel_id}/messages"
+ROUTE_REACTION = "PUT /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me"
+DISCORD_RATE_LIMITS = {
+  ROUTE_MEMBER: (10, 1),
+  ROUTE_MEMBER_ROLE: (10, 1),
+  ROUTE_ROLES: (10, 1),
+  ROUTE_CHANNELS: (5, 5),
+  ROUTE_CHANNEL: (5, 5),
+  ROUTE_PERMISSIONS: (5, 5),
+  ROUTE_DM: (5, 1),
+  ROUTE_MESSAGE: (5, 5),
+  ROUTE_REACTION: (1, 0.25),
+}
+# Client side rate limits, just below Discord's: the same number of
+# requests, in windows RATE_LIMIT_MARGIN seconds longer so that requests
+# slowed down on their way still land in their own window, and wait here
+# instead of getting a 429
+RATE_LIMIT_MARGIN = 0.1
+RATE_LIMITS = {route: (rate, per + RATE_LIMIT_MARGIN)
+  for route, (rate, per) in DISCORD_RATE_LIMITS.items()}
+
+# How players are let into their lobby: a "Tournament Lobby N" role given
+# to each of them, or overwrites for each of them on the lobby channel,
+# which are all sent with the channel creation
+LOBBY_STRATEGY_ROLE = "role"
+LOBBY_STRATEGY_OVERWRITES = "overwrites"
+LOBBY_STRATEGY = LOBBY_STRATEGY_ROLE
+
+# How members get a changed speak permission applied while they're in a
+# voice channel: moving them into the same channel, or server muting them
+# (undone as soon as they leave the channel)
+MUTE_STRATEGY_MOVE = "move"
+MUTE_STRATEGY_SERVER = "server"
+MUTE_STRATEGY = MUTE_STRATEGY_MOVE
+MUTE_CONCURRENCY = 10
+
+# Direct Messages sent at the same time by BROADCAST, SUMMON and START
+DM_CONCURRENCY = 5
+
+# Announcements published within this window are merged into one message,
+# split in pages of at most Discord's embed description length
+PUBLISH_WINDOW_SECONDS = 0.5
+PUBLISH_PAGE_SIZE = 4096
+
+# Seconds to wait for the gateway to confirm a move, and how many times a
+# move that isn't confirmed is tried again
+MOVE_ACK_TIMEOUT = 5
+MOVE_RETRIES = 1
+
+# Where participants are remembered: "sqlite", "memory" or "replit". A new
+# sqlite database imports what the replit one held, once.
+DATABASE_BACKEND = "sqlite"
+DATABASE_PATH = "tournament.db"
+# Writes are coalesced and committed together at most this often
+DATABASE_FLUSH_SECONDS = 1
+# The waiting chat checkpoint is saved at most this often
+CHECKPOINT_SECONDS = 1
+
+# Members requested in each gateway member chunk, and chunks requested at once
+HYDRATION_CHUNK_SIZE = 100
+HYDRATION_CONCURRENCY = 5
+
+# Commands sent while the bot was offline replayed at the same time
+REPLAY_CONCURRENCY = 10
+
+# Whether the roles and channels found by the last run are looked up by ID
+# on startup instead of being searched by name
+WARM_START = True
+
+# JOIN and QUIT a user can send within USER_COMMANDS_PER seconds, the
+# following ones being dropped. DMs aren't slowed down by the chat cooldown.
+USER_COMMANDS_RATE = 5
+USER_COMMANDS_PER = 30
+
+# How START deals players into lobbies: "random", "rating" to balance the
+# lobbies' ratings, set with RATE, or "repeats" to also keep apart who
+# played together in the last MATCHMAKING_HISTORY rounds
+MATCHMAKING_STRATEGY = "repeats"
+MATCHMAKING_HISTORY = 5
+# Rating of the players who have none
+DEFAULT_RATING = 1000
+# Batches of swaps "repeats" tries, and how much a lobby whose mean rating
+# is one standard deviation off costs compared to one repeated pair
+MATCHMAKING_ITERATIONS = 200
+MATCHMAKING_BALANCE_WEIGHT = 10
+# Processes computing the lobbies, 0 to do it in the event loop
+MATCHMAKING_PROCESSES = 1
+
+# Where the Prometheus metrics are served, port None to not serve them,
+# and the upper bounds in seconds of their latency histograms' buckets
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+METRICS_NAMESPACE = "tournament"
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
@@ -1,31 +1,349 @@
-from replit import db
 import asyncio
+import json
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from constants import DATABASE_BACKEND, DATABASE_PATH, DATABASE_FLUSH_SECONDS
 
-lock = asyncio.Lock()
+class Store:
+  """ Where participants are remembered between restarts.
+      Writes return as soon as they're recorded in memory: backends that
+      persist them somewhere slower coalesce them and flush them in the
+      background, so callers never wait for durable writes. Call flush()
+      before shutting down.
+  """
 
-async def put_participant_id(guild_name, id):
-  async with lock:
+  async def put_participant_id(self, guild_name, id):
+    raise NotImplementedError
+
+  async def del_participant_id(self, guild_name, id):
+    raise NotImplementedError
+
+  async def get_participants_ids(self, guild_name):
+    raise NotImplementedError
+
+  async def get_value(self, guild_name, key):
+    # Any JSON serializable value about the guild, None when missing
+    raise NotImplementedError
+
+  async def put_value(self, guild_name, key, value):
+    raise NotImplementedError
+
+  async def reset(self, guild_name):
+    raise NotImplementedError
+
+  async def flush(self):
+    pass
+
+class MemoryStore(Store):
+  """ Forgets everything on restart, meant for tests and benchmarks """
+
+  def __init__(self):
+    self.participants = {} # guild name -> set of ids
+    self.values = {} # (guild name, key) -> value
+
+  async def put_participant_id(self, guild_name, id):
+    self.participants.setdefault(guild_name, set()).add(str(id))
+
+  async def del_participant_id(self, guild_name, id):
+    self.participants.get(guild_name, set()).discard(str(id))
+
+  async def get_participants_ids(self, guild_name):
+    return list(self.participants.get(guild_name, ()))
+
+  async def get_value(self, guild_name, key):
+    return self.values.get((guild_name, key))
+
+  async def put_value(self, guild_name, key, value):
+    self.values[(guild_name, key)] = value
+
+  async def reset(self, guild_name):
+    self.participants.pop(guild_name, None)
+    for key in [key for key in self.values if key[0] == guild_name]:
+      del self.values[key]
+
+class SqliteStore(Store):
+  """ SQLite database in WAL mode. All the blocking work runs on a single
+      worker thread owning the connection, and the writes recorded within
+      DATABASE_FLUSH_SECONDS are committed in one transaction, keeping
+      only the last write for each participant.
+      When the database is created, it imports whatever the replit database
+      the bot used before holds, so upgrading keeps the tournaments.
+  """
+
+  def __init__(self, path=DATABASE_PATH, flush_seconds=DATABASE_FLUSH_SECONDS):
+    self.path = path
+    self.flush_seconds = flush_seconds
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    self.connection = None
+    self.pending = {} # (guild name, id) -> True to put, False to delete
+    self.pending_values = {} # (guild name, key) -> value
+    self.flushing = None
+    self.n_flushes = 0
+
+  async def run(self, fn, *args):
+    return await asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+
+  def connect(self):
+    # Runs on the worker thread
+    if self.connection is None:
+      connection = sqlite3.connect(self.path, check_same_thread=False)
+      connection.execute("PRAGMA journal_mode=WAL")
+      connection.execute("PRAGMA synchronous=NORMAL")
+      created = connection.execute("""SELECT name FROM sqlite_master
+        WHERE type = 'table' AND name = 'participants'""").fetchone() is None
+      # The tables are committed with the import, so a failed import is
+      # tried again by the next connection
+      connection.execute("BEGIN")
+      try:
+        connection.execute("""CREATE TABLE IF NOT EXISTS participants (
+          guild TEXT NOT NULL, id TEXT NOT NULL, PRIMARY KEY (guild, id))""")
+        connection.execute("""CREATE TABLE IF NOT EXISTS state (
+          guild TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+          PRIMARY KEY (guild, key))""")
+        if created:
+          self.import_replit(connection)
+        connection.commit()
+      except BaseException:
+        connection.rollback()
+        connection.close()
+        raise
+      self.connection = connection
+    return self.connection
+
+  def import_replit(self, connection):
+    # What the replit database holds, when the tables are created
     try:
-      db[guild_name]["participants"][str(id)] = True
+      from replit import db
+    except ImportError:
+      return
+    if db is None: # not running on replit
+      return
+    participants, values = [], []
+    for guild_name in db.keys():
+      data = json.loads(db.get_raw(guild_name))
+      if not isinstance(data, dict):
+        continue
+      for key, value in data.items():
+        if key == "participants":
+          participants.extend((guild_name, str(id)) for id in value)
+        else:
+          values.append((guild_name, key, json.dumps(value)))
+    connection.executemany(
+      "INSERT OR IGNORE INTO participants VALUES (?, ?)", participants)
+    connection.executemany(
+      "INSERT OR REPLACE INTO state VALUES (?, ?, ?)", values)
+    print(f'Imported {len(participants)} participants and {len(values)} values '
+      'from the replit database')
+
+  def write(self, guild_name, id, present):
+    self.pending[(guild_name, str(id))] = present
+    self.schedule_flush()
+
+  def schedule_flush(self):
+    if self.flushing is None:
+      self.flushing = asyncio.ensure_future(self.flush_later())
+
+  async def flush_later(self):
+    await asyncio.sleep(self.flush_seconds)
+    await self.flush()
+
+  async def flush(self):
+    if self.flushing and self.flushing is not asyncio.current_task():
+      self.flushing.cancel()
+    self.flushing = None
+    batch, self.pending = self.pending, {}
+    values, self.pending_values = self.pending_values, {}
+    if batch or values:
+      try:
+        await self.run(self.commit, batch, values)
+        self.n_flushes += 1
+      except sqlite3.Error as e:
+        print(f"Couldn't save {len(batch) + len(values)} changes", file=sys.stderr)
+        print(e)
+        # keep them for the next flush, unless written again meanwhile
+        for key, present in batch.items():
+          self.pending.setdefault(key, present)
+        for key, value in values.items():
+          self.pending_values.setdefault(key, value)
+        self.schedule_flush()
+
+  def commit(self, batch, values):
+    connection = self.connect()
+    with connection:
+      connection.executemany(
+        "INSERT OR IGNORE INTO participants VALUES (?, ?)",
+        [key for key, present in batch.items() if present])
+      connection.executemany(
+        "DELETE FROM participants WHERE guild = ? AND id = ?",
+        [key for key, present in batch.items() if not present])
+      connection.executemany(
+        "INSERT OR REPLACE INTO state VALUES (?, ?, ?)",
+        [(guild, key, json.dumps(value)) for (guild, key), value in values.items()])
+
+  def select(self, guild_name):
+    return [row[0] for row in self.connect().execute(
+      "SELECT id FROM participants WHERE guild = ?", (guild_name,))]
+
+  def select_value(self, guild_name, key):
+    row = self.connect().execute(
+      "SELECT value FROM state WHERE guild = ? AND key = ?", (guild_name, key)).fetchone()
+    return json.loads(row[0]) if row else None
+
+  def delete_guild(self, guild_name):
+    connection = self.connect()
+    with connection:
+      connection.execute("DELETE FROM participants WHERE guild = ?", (guild_name,))
+      connection.execute("DELETE FROM state WHERE guild = ?", (guild_name,))
+
+  async def put_participant_id(self, guild_name, id):
+    self.write(guild_name, id, True)
+
+  async def del_participant_id(self, guild_name, id):
+    self.write(guild_name, id, False)
+
+  async def get_participants_ids(self, guild_name):
+    ids = set(await self.run(self.select, guild_name))
+    # writes not flushed yet override what's on disk
+    for (guild, id), present in list(self.pending.items()):
+      if guild == guild_name:
+        if present:
+          ids.add(id)
+        else:
+          ids.discard(id)
+    return list(ids)
+
+  async def get_value(self, guild_name, key):
+    if (guild_name, key) in self.pending_values:
+      return self.pending_values[(guild_name, key)]
+    return await self.run(self.select_value, guild_name, key)
+
+  async def put_value(self, guild_name, key, value):
+    self.pending_values[(guild_name, key)] = value
+    self.schedule_flush()
+
+  async def reset(self, guild_name):
+    for key in [key for key in self.pending if key[0] == guild_name]:
+      del self.pending[key]
+    for key in [key for key in self.pending_values if key[0] == guild_name]:
+      del self.pending_values[key]
+    await self.run(self.delete_guild, guild_name)
+
+class ReplitStore(Store):
+  """ The replit database the bot used to rely on, each access being an
+      HTTP request. They run on a worker thread so they don't block the
+      event loop.
+  """
+
+  def __init__(self):
+    from replit import db
+    self.db = db
+    self.executor = ThreadPoolExecutor(max_workers=1)
+
+  async def run(self, fn, *args):
+    return await asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+
+  def put(self, guild_name, id):
+    try:
+      self.db[guild_name]["participants"][str(id)] = True
     except:
-      db[guild_name] = {"participants": { str(id): True } }
+      self.db[guild_name] = {"participants": { str(id): True } }
 
-async def del_participant_id(guild_name, id):
-  async with lock:
+  def delete(self, guild_name, id):
     try:
-      del db[guild_name]["participants"][str(id)]
+      del self.db[guild_name]["participants"][str(id)]
     except:
       return
 
-async def get_participants_ids(guild_name):
-  async with lock:
+  def keys(self, guild_name):
     try:
-      return db[guild_name]["participants"].keys()
+      return list(self.db[guild_name]["participants"].keys())
     except:
       return []
 
-def reset_db(guild_name):
-  try:
-    del db[guild_name]
-  except:
-    pass
\ No newline at end of file
+  def get(self, guild_name, key):
+    try:
+      return self.db[guild_name][key]
+    except:
+      return None
+
+  def set(self, guild_name, key, value):
+    try:
+      self.db[guild_name][key] = value
+    except:
+      self.db[guild_name] = {"participants": {}, key: value}
+
+  def delete_guild(self, guild_name):
+    try:
+      del self.db[guild_name]
+    except:
+      pass
+
+  async def put_participant_id(self, guild_name, id):
+    await self.run(self.put, guild_name, id)
+
+  async def del_participant_id(self, guild_name, id):
+    await self.run(self.delete, guild_name, id)
+
+  async def get_participants_ids(self, guild_name):
+    return await self.run(self.keys, guild_name)
+
+  async def get_value(self, guild_name, key):
+    return await self.run(self.get, guild_name, key)
+
+  async def put_value(self, guild_name, key, value):
+    await self.run(self.set, guild_name, key, value)
+
+  async def reset(self, guild_name):
+    await self.run(self.delete_guild, guild_name)
+
+STORES = {
+  "memory": MemoryStore,
+  "sqlite": SqliteStore,
+  "replit": ReplitStore,
+}
+
+store = STORES[DATABASE_BACKEND]()
+
+async def put_participant_id(guild_name, id):
+  await store.put_participant_id(guild_name, id)
+
+async def del_participant_id(guild_name, id):
+  await store.del_participant_id(guild_name, id)
+
+async def get_participants_ids(guild_name):
+  return await store.get_participants_ids(guild_name)
+
+async def get_checkpoint(guild_name):
+  # ID of the last waiting chat message handled
+  return await store.get_value(guild_name, "checkpoint")
+
+async def put_checkpoint(guild_name, message_id):
+  await store.put_value(guild_name, "checkpoint", message_id)
+
+async def get_snapshot(guild_name):
+  # IDs of the roles and channels found by the last run
+  return await store.get_value(guild_name, "snapshot")
+
+async def put_snapshot(guild_name, snapshot):
+  await store.put_value(guild_name, "snapshot", snapshot)
+
+async def get_ratings(guild_name):
+  # Participant ID, as a string, -> rating
+  return await store.get_value(guild_name, "ratings") or {}
+
+async def put_ratings(guild_name, ratings):
+  await store.put_value(guild_name, "ratings", ratings)
+
+async def get_lobby_history(guild_name):
+  # Lobbies of the last rounds, oldest first, each a list of lists of IDs
+  return await store.get_value(guild_name, "lobby_history") or []
+
+async def put_lobby_history(guild_name, history):
+  await store.put_value(guild_name, "lobby_history", history)
+
+async def reset_db(guild_name):
+  await store.reset(guild_name)
+
+async def flush():
+  await store.flush()
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from asyncioext import RWLock, LockMetrics
+
+# The tournament's category, channels, roles and lobbies: commands creating
+# or deleting them write it, every other command reads it
+STRUCTURE = ('structure', 0)
+
+# The players' ratings, kept as a single value of the database
+RATINGS = ('ratings', 0)
+
+def member_key(id):
+  return ('member', int(id))
+
+def channel_key(id):
+  return ('channel', int(id))
+
+class LockManager:
+  """ A fair RWLock per resource, so that commands touching different
+      members or channels run at the same time. A command takes all its
+      locks at once, always in the order of their keys, so two commands
+      can't wait for each other.
+      Usage:
+          async with locks.locked('MUTE', reads=[STRUCTURE],
+              writes=[channel_key(channel.id)]):
+            ...
+      Metrics are kept per label for the whole set of locks.
+  """
+
+  def __init__(self):
+    self.locks = {} # key -> RWLock, dropped once idle
+    self.metrics = {} # label -> LockMetrics
+
+  def get_metrics(self, label):
+    if label not in self.metrics:
+      self.metrics[label] = LockMetrics()
+    return self.metrics[label]
+
+  @asynccontextmanager
+  async def locked(self, label=None, reads=(), writes=(), timeout=None):
+    writes = set(writes)
+    keys = sorted(writes.union(reads))
+    metrics = self.get_metrics(label)
+    metrics.queue.add(sum(len(self.locks[key].waiters)
+      for key in keys if key in self.locks))
+    acquired = []
+    t0 = time.perf_counter()
+    try:
+      for key in keys:
+        if key not in self.locks:
+          self.locks[key] = RWLock(instrumented=False)
+        lock = self.locks[key]
+        await lock.acquire(key in writes, timeout=timeout)
+        acquired.append((key, lock, key in writes))
+    except BaseException as e:
+      if isinstance(e, asyncio.TimeoutError):
+        metrics.timeouts += 1
+      self.release(acquired)
+      self.drop_if_idle(key)
+      raise
+    metrics.wait.add(time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    try:
+      yield
+    finally:
+      metrics.hold.add(time.perf_counter() - t0)
+      self.release(acquired)
+
+  def release(self, acquired):
+    for key, lock, writer in reversed(acquired):
+      lock.release(writer)
+      self.drop_if_idle(key)
+
+  def drop_if_idle(self, key):
+    if key in self.locks and self.locks[key].is_idle():
+      del self.locks[key]
+
+  def stats(self):
+    return '\n'.join(f'{label}: {metrics}'
+      for label, metrics in self.metrics.items())
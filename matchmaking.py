@@ -0,0 +1,152 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from constants import LOBBY_CAPACITY, DEFAULT_RATING, MATCHMAKING_STRATEGY
+from constants import MATCHMAKING_PROCESSES, MATCHMAKING_ITERATIONS
+from constants import MATCHMAKING_BALANCE_WEIGHT
+
+# Each strategy takes the players' standardized ratings, their past lobbies
+# (players x rounds, -1 when they didn't play) and returns the lobby of
+# each player
+
+def deal(order, n_lobbies, snake=False):
+  # Players in order go round the lobbies, back and forth with snake
+  positions = np.arange(len(order))
+  lobbies = positions % n_lobbies
+  if snake:
+    backwards = (positions // n_lobbies) % 2 == 1
+    lobbies[backwards] = n_lobbies - 1 - lobbies[backwards]
+  assignment = np.empty(len(order), dtype=np.int64)
+  assignment[order] = lobbies
+  return assignment
+
+def random_lobbies(ratings, past, n_lobbies, rng):
+  return deal(rng.permutation(len(ratings)), n_lobbies)
+
+def rating_lobbies(ratings, past, n_lobbies, rng):
+  # Snake draft from the best rated, ties in random order, so that every
+  # lobby gets about the same total
+  shuffled = rng.permutation(len(ratings))
+  order = shuffled[np.argsort(-ratings[shuffled], kind='stable')]
+  return deal(order, n_lobbies, snake=True)
+
+def repeat_lobbies(ratings, past, n_lobbies, rng,
+    iterations=MATCHMAKING_ITERATIONS, weight=MATCHMAKING_BALANCE_WEIGHT):
+  # Starts from the rating draft and swaps players between lobbies while
+  # it lowers the number of pairs that already played together plus
+  # weight times the squared lobby rating means
+  lobbies = rating_lobbies(ratings, past, n_lobbies, rng)
+  n = len(ratings)
+  if n_lobbies < 2:
+    return lobbies
+  sizes = np.bincount(lobbies, minlength=n_lobbies)
+  sums = np.bincount(lobbies, weights=ratings, minlength=n_lobbies)
+  played = past >= 0
+  seen = np.where(played, past, 0)
+  # counts[r][l, k]: players of lobby l who were in lobby k in round r
+  counts = []
+  for r in range(past.shape[1]):
+    c = np.zeros((n_lobbies, seen[:, r].max() + 1), dtype=np.int32)
+    np.add.at(c, (lobbies[played[:, r]], past[played[:, r], r]), 1)
+    counts.append(c)
+  def met(l, p):
+    # How many times each p already played with the players in lobby l,
+    # themselves included
+    total = np.zeros(len(p), dtype=np.int64)
+    for r, c in enumerate(counts):
+      total += np.where(played[p, r], c[l, seen[p, r]], 0)
+    return total
+  batch = max(1, n // 2)
+  for _ in range(iterations):
+    a = rng.integers(n, size=batch)
+    b = rng.integers(n, size=batch)
+    la, lb = lobbies[a], lobbies[b]
+    shared = (played[a] & (past[a] == past[b])).sum(axis=1)
+    repeats = (met(lb, a) - shared) + (met(la, b) - shared) \
+      - (met(la, a) - played[a].sum(axis=1)) - (met(lb, b) - played[b].sum(axis=1))
+    sa, sb, na, nb = sums[la], sums[lb], sizes[la], sizes[lb]
+    balance = ((sa - ratings[a] + ratings[b]) / na) ** 2 \
+      + ((sb - ratings[b] + ratings[a]) / nb) ** 2 - (sa / na) ** 2 - (sb / nb) ** 2
+    delta = repeats + weight * balance
+    candidates = np.flatnonzero((la != lb) & (delta < -1e-9))
+    if len(candidates) == 0:
+      continue
+    # The best swaps first, each lobby swapping once per batch so that
+    # the deltas stay exact
+    used = np.zeros(n_lobbies, dtype=bool)
+    chosen = []
+    for i in candidates[np.argsort(delta[candidates])]:
+      if not used[la[i]] and not used[lb[i]]:
+        used[la[i]] = used[lb[i]] = True
+        chosen.append(i)
+    chosen = np.array(chosen)
+    a, b, la, lb = a[chosen], b[chosen], la[chosen], lb[chosen]
+    for r, c in enumerate(counts):
+      pa, pb = played[a, r], played[b, r]
+      np.add.at(c, (la[pa], past[a[pa], r]), -1)
+      np.add.at(c, (lb[pa], past[a[pa], r]), 1)
+      np.add.at(c, (lb[pb], past[b[pb], r]), -1)
+      np.add.at(c, (la[pb], past[b[pb], r]), 1)
+    sums[la] += ratings[b] - ratings[a]
+    sums[lb] += ratings[a] - ratings[b]
+    lobbies[a], lobbies[b] = lb, la
+  return lobbies
+
+STRATEGIES = {
+  "random": random_lobbies,
+  "rating": rating_lobbies,
+  "repeats": repeat_lobbies,
+}
+
+def make_lobbies(ids, n_lobbies, strategy=MATCHMAKING_STRATEGY, ratings={},
+    history=(), seed=None):
+  # Splits ids into n_lobbies lobbies of sizes differing by one at most.
+  # ratings maps ids, as strings, to ratings. history holds the past
+  # rounds, each a list of lobbies of ids.
+  # Only takes and returns plain data, to run in another process.
+  if not ids:
+    return []
+  rng = np.random.default_rng(seed)
+  rows = {int(id): i for i, id in enumerate(ids)}
+  values = np.array([float(ratings.get(str(id), DEFAULT_RATING)) for id in ids])
+  std = values.std()
+  values = (values - values.mean()) / std if std else np.zeros(len(ids))
+  past = np.full((len(ids), len(history)), -1, dtype=np.int64)
+  for r, lobbies in enumerate(history):
+    for k, lobby in enumerate(lobbies):
+      for id in lobby:
+        if int(id) in rows:
+          past[rows[int(id)], r] = k
+  assignment = STRATEGIES[strategy](values, past, n_lobbies, rng)
+  order = np.argsort(assignment, kind='stable')
+  bounds = np.cumsum(np.bincount(assignment, minlength=n_lobbies))[:-1]
+  return [[ids[i] for i in lobby] for lobby in np.split(order, bounds)]
+
+class Matchmaker:
+  """ Deals players into lobbies of at most `capacity` with a strategy
+      from STRATEGIES. With processes, the work happens in a process pool
+      so that big tournaments don't block the event loop.
+      Usage:
+          lobbies = await matchmaker.make_lobbies(players, ratings, history)
+  """
+
+  def __init__(self, strategy=MATCHMAKING_STRATEGY, capacity=LOBBY_CAPACITY,
+      processes=MATCHMAKING_PROCESSES):
+    self.strategy = strategy
+    self.capacity = capacity
+    self.executor = ProcessPoolExecutor(processes) if processes else None
+
+  async def make_lobbies(self, players, ratings={}, history=()):
+    n_lobbies = (len(players) + self.capacity - 1) // self.capacity
+    args = ([p.id for p in players], n_lobbies, self.strategy, ratings, history)
+    if self.executor:
+      lobbies = await asyncio.get_event_loop().run_in_executor(
+        self.executor, make_lobbies, *args)
+    else:
+      lobbies = make_lobbies(*args)
+    by_id = {p.id: p for p in players}
+    return [[by_id[id] for id in lobby] for lobby in lobbies]
+
+  def close(self):
+    if self.executor:
+      self.executor.shutdown(wait=False)
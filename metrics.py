@@ -0,0 +1,186 @@
+import asyncio
+import bisect
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from constants import METRICS_HOST, METRICS_PORT, METRICS_NAMESPACE, METRICS_BUCKETS
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Histogram:
+  """ How many observations fell under each bound, Prometheus style """
+
+  def __init__(self, bounds=METRICS_BUCKETS):
+    self.bounds = tuple(bounds)
+    self.counts = [0] * (len(self.bounds) + 1) # the last one above every bound
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def quantile(self, q):
+    # Bound of the bucket holding the q quantile, inf past the last one
+    rank = q * self.count
+    seen = 0
+    for bound, n in zip(self.bounds + (float('inf'),), self.counts):
+      seen += n
+      if seen and seen >= rank:
+        return bound
+    return 0.0
+
+class Metrics:
+  """ Counters and latency histograms, each kept per name and labels, and
+      rendered in Prometheus' text format, which serve() exposes over HTTP
+      at /metrics.
+      Usage:
+          metrics.count('commands_total', command='JOIN', outcome='ok')
+          with metrics.timed('command_execute_seconds', command='JOIN'):
+            ...
+  """
+
+  def __init__(self, host=METRICS_HOST, port=METRICS_PORT, namespace=METRICS_NAMESPACE):
+    self.host = host
+    self.port = port
+    self.namespace = namespace
+    self.counters = {} # (name, labels) -> value
+    self.histograms = {} # (name, labels) -> Histogram
+    self.server = None
+
+  def count(self, name, n=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    self.counters[key] = self.counters.get(key, 0) + n
+
+  def histogram(self, name, **labels):
+    # Hot paths keep it to observe() without looking it up every time
+    key = (name, tuple(sorted(labels.items())))
+    histogram = self.histograms.get(key)
+    if histogram is None:
+      histogram = self.histograms[key] = Histogram()
+    return histogram
+
+  def observe(self, name, seconds, **labels):
+    self.histogram(name, **labels).observe(seconds)
+
+  @contextmanager
+  def timed(self, name, **labels):
+    t0 = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - t0, **labels)
+
+  def get_count(self, name, **labels):
+    # Sum of the counters of that name having at least these labels
+    return sum(value for (n, ls), value in self.counters.items()
+      if n == name and labels.items() <= dict(ls).items())
+
+  def get_histogram(self, name, **labels):
+    return self.histograms.get((name, tuple(sorted(labels.items())))) or Histogram()
+
+  def label_values(self, name, label):
+    return sorted({dict(ls)[label]
+      for n, ls in list(self.counters) + list(self.histograms)
+      if n == name and label in dict(ls)})
+
+  def render(self):
+    lines = []
+    for kind, series in (('counter', self.counters), ('histogram', self.histograms)):
+      last = None
+      for (name, labels), value in sorted(series.items()):
+        name = f'{self.namespace}_{name}'
+        if name != last:
+          lines.append(f'# TYPE {name} {kind}')
+          last = name
+        if kind == 'counter':
+          lines.append(f'{name}{render_labels(labels)} {value}')
+          continue
+        seen = 0
+        for bound, n in zip(value.bounds + ('+Inf',), value.counts):
+          seen += n
+          lines.append(f'{name}_bucket{render_labels(labels + (("le", bound),))} {seen}')
+        lines.append(f'{name}_sum{render_labels(labels)} {value.sum}')
+        lines.append(f'{name}_count{render_labels(labels)} {value.count}')
+    return '\n'.join(lines) + '\n'
+
+  async def serve(self):
+    if self.server is None and self.port is not None:
+      try:
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        host, port = self.server.sockets[0].getsockname()[:2]
+        print(f'Metrics served on http://{host}:{port}/metrics')
+      except OSError as e:
+        print(f"Couldn't serve metrics on {self.host}:{self.port}", file=sys.stderr)
+        print(e)
+
+  async def handle(self, reader, writer):
+    try:
+      request = await asyncio.wait_for(reader.readline(), 5)
+      while await asyncio.wait_for(reader.readline(), 5) not in (b'\r\n', b'\n', b''):
+        pass # headers
+      words = request.split()
+      if words[:1] == [b'GET'] and words[1:2] and words[1].split(b'?')[0] == b'/metrics':
+        status, body = '200 OK', self.render().encode()
+      else:
+        status, body = '404 Not Found', b'Not Found\n'
+      writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n'
+        f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+      await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+      pass
+    finally:
+      writer.close()
+
+  def close(self):
+    if self.server:
+      self.server.close()
+      self.server = None
+
+def render_labels(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+def escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class RateLimitCounter(logging.Handler):
+  """ Counts the 429s discord.py retries on its own, which it only logs,
+      in the metrics registered for the guild of the bucket logged.
+      Buckets of no guild, like DMs', count for the only guild registered.
+      Usage:
+          rate_limit_counter.register(guild.id, metrics)
+          ...
+          rate_limit_counter.unregister(guild.id)
+  """
+
+  def __init__(self):
+    super().__init__(logging.WARNING)
+    self.metrics = {} # guild id, as a string, -> Metrics
+
+  def register(self, guild_id, metrics):
+    self.metrics[str(guild_id)] = metrics
+
+  def unregister(self, guild_id):
+    self.metrics.pop(str(guild_id), None)
+
+  def emit(self, record):
+    if not isinstance(record.msg, str) or \
+        not record.msg.startswith('We are being rate limited'):
+      return
+    retry_after, bucket = record.args[:2]
+    # discord.py's buckets are channel_id:guild_id:path
+    parts = str(bucket).split(':')
+    metrics = self.metrics.get(parts[1]) if len(parts) > 2 else None
+    if metrics is None and len(self.metrics) == 1:
+      metrics, = self.metrics.values()
+    if metrics:
+      metrics.count('rest_rate_limited_total')
+      metrics.count('rest_retry_after_seconds_total', retry_after)
+
+# A single handler for the whole process, as discord.py's logger is
+rate_limit_counter = RateLimitCounter()
+logging.getLogger('discord.http').addHandler(rate_limit_counter)
@@ -0,0 +1,69 @@
+import asyncio
+import time
+from constants import MOVE_ACK_TIMEOUT
+from stats import Samples
+
+class MoveNotConfirmed(Exception):
+  def __init__(self, member, channel):
+    super().__init__(f'{member} never showed up in {channel}')
+
+class MoveTracker:
+  """ Matches the moves we ask for with the voice state updates the
+      gateway sends once they happen, and measures how long that takes.
+      Expect the move before asking for it, as the update can arrive
+      before the REST response.
+      Moves of a member to the same channel wait for the same update,
+      while moves to different channels each wait for their own.
+      Usage:
+          expected = tracker.expect(member, channel)
+          await member.move_to(channel)
+          if not await tracker.confirmed(member, channel, expected):
+            ...
+  """
+
+  def __init__(self, timeout=MOVE_ACK_TIMEOUT):
+    self.timeout = timeout
+    # (member id, channel id) -> [future, request time, moves waiting]
+    self.expected = {}
+    self.latencies = Samples()
+    self.n_confirmed = 0
+    self.n_timed_out = 0
+
+  def expect(self, member, channel):
+    key = (member.id, channel.id)
+    if key not in self.expected:
+      future = asyncio.get_event_loop().create_future()
+      self.expected[key] = [future, time.monotonic(), 0]
+    self.expected[key][2] += 1
+    return self.expected[key][0]
+
+  def forget(self, member, channel, expected):
+    # One of the moves waiting gives up, the others keep waiting
+    key = (member.id, channel.id)
+    entry = self.expected.get(key)
+    if entry and entry[0] is expected:
+      entry[2] -= 1
+      if entry[2] == 0:
+        del self.expected[key]
+
+  async def confirmed(self, member, channel, expected):
+    try:
+      await asyncio.wait_for(asyncio.shield(expected), self.timeout)
+      return True
+    except asyncio.TimeoutError:
+      self.n_timed_out += 1
+      self.forget(member, channel, expected)
+      return False
+
+  def on_voice_state_update(self, member, before, after):
+    if after.channel:
+      entry = self.expected.pop((member.id, after.channel.id), None)
+      if entry:
+        future, t0, _ = entry
+        self.latencies.add(time.monotonic() - t0)
+        self.n_confirmed += 1
+        future.set_result(True)
+
+  def stats(self):
+    return f'{self.n_confirmed} confirmed, {self.n_timed_out} timed out, ' \
+      f'{len(self.expected)} pending, latency {self.latencies}'
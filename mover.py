@@ -0,0 +1,47 @@
+import asyncio
+import sys
+import discord
+from constants import MOVER_CONCURRENCY, MOVE_RETRIES, ROUTE_MEMBER
+from move_tracker import MoveNotConfirmed
+
+class Mover:
+  """ Moves many members at once, keeping at most `concurrency` moves in
+      flight. Outcomes are returned in the same order as the moves, None
+      for a landed move or the HTTPException that made it fail.
+      Every move waits for its turn in the limiter's move bucket.
+      With a tracker, a move only counts as landed once the gateway
+      confirms it, otherwise it's tried again up to MOVE_RETRIES times and
+      then fails with MoveNotConfirmed.
+      Usage:
+          outcomes = await mover.move_all([(member, channel), ...])
+  """
+
+  def __init__(self, limiter, concurrency=MOVER_CONCURRENCY, tracker=None):
+    self.limiter = limiter
+    self.semaphore = asyncio.Semaphore(concurrency)
+    self.tracker = tracker
+
+  async def move(self, member, channel):
+    for tries in range(1 + MOVE_RETRIES):
+      # The confirmation is awaited outside of the semaphore, so waiting
+      # for the gateway doesn't hold back the following moves
+      async with self.semaphore:
+        try:
+          if self.tracker:
+            expected = self.tracker.expect(member, channel)
+          async with self.limiter.request(ROUTE_MEMBER, member.guild.id, 'move'):
+            await member.move_to(channel)
+        except discord.errors.HTTPException as e:
+          if self.tracker:
+            self.tracker.forget(member, channel, expected)
+          print(f"Couldn't move {member} to {channel}", file=sys.stderr)
+          print(e)
+          return e
+      if not self.tracker or await self.tracker.confirmed(member, channel, expected):
+        return None
+    print(f"Move of {member} to {channel} never confirmed", file=sys.stderr)
+    return MoveNotConfirmed(member, channel)
+
+  async def move_all(self, moves):
+    return await asyncio.gather(
+      *(self.move(member, channel) for member, channel in moves))
@@ -0,0 +1,68 @@
+import asyncio
+import sys
+import discord
+from constants import MUTE_STRATEGY, MUTE_STRATEGY_SERVER, MUTE_CONCURRENCY, ROUTE_MEMBER
+
+class MuteEngine:
+  """ Applies changed speak permissions to members already in a voice
+      channel, at most `concurrency` at a time.
+      A refresh requested for a member who is still waiting for one joins
+      it, so overlapping role and channel changes cost a single request.
+      Usage:
+          await mute_engine.refresh_all(channel.members)
+  """
+
+  def __init__(self, limiter, strategy=MUTE_STRATEGY, concurrency=MUTE_CONCURRENCY):
+    self.limiter = limiter
+    self.strategy = strategy
+    self.semaphore = asyncio.Semaphore(concurrency)
+    self.queued = {} # member id -> refresh not started yet
+    self.server_muted = set() # ids of the members we server muted
+    self.n_requested = 0
+    self.n_refreshed = 0
+
+  def refresh(self, member):
+    self.n_requested += 1
+    if member.id not in self.queued:
+      self.queued[member.id] = asyncio.ensure_future(self._refresh(member))
+    return self.queued[member.id]
+
+  async def refresh_all(self, members):
+    await asyncio.gather(*(self.refresh(member) for member in members))
+
+  async def _refresh(self, member):
+    async with self.semaphore:
+      # From now on the refresh reads the current permissions, so a new
+      # request must wait for the next one
+      del self.queued[member.id]
+      if not member.voice or not member.voice.channel:
+        return
+      try:
+        async with self.limiter.request(ROUTE_MEMBER, member.guild.id, 'mute'):
+          if self.strategy == MUTE_STRATEGY_SERVER:
+            await self.server_mute(member)
+          else:
+            await member.move_to(member.voice.channel)
+        self.n_refreshed += 1
+      except discord.errors.HTTPException as e:
+        print(f"Couldn't refresh mute of {member}", file=sys.stderr)
+        print(e)
+
+  async def server_mute(self, member):
+    # Only the mutes set here are lifted here: someone a moderator muted
+    # by hand stays muted, whatever the channel allows
+    mute = not member.voice.channel.permissions_for(member).speak
+    if mute:
+      if not member.voice.mute:
+        await member.edit(mute=True)
+        self.server_muted.add(member.id)
+    elif member.id in self.server_muted:
+      if member.voice.mute:
+        await member.edit(mute=False)
+      self.server_muted.discard(member.id)
+
+  async def on_voice_state_update(self, member, before, after):
+    # A server mute follows the member everywhere, lift it when they leave
+    if member.id in self.server_muted and before.channel != after.channel:
+      if after.channel:
+        await self.refresh(member)
@@ -57,15 +57,22 @@ def get_room_overwrites(tournament):
         connect=False ),
   }
 
-def get_lobby_overwrites(tournament, lobby_role):
+def get_lobby_overwrites(tournament, lobby_role=None, players=()):
   base_overwrite = discord.PermissionOverwrite(
      view_channel=False)
-  return {
+  overwrites = {
     default(tournament): diff(verified(tournament), base_overwrite),
     manager(tournament): discord.PermissionOverwrite(
         view_channel=True, speak=True ),
-    lobby_role: discord.PermissionOverwrite(
-        view_channel=True ),
   }
+  if lobby_role:
+    overwrites[lobby_role] = get_lobby_player_overwrite()
+  for member in players:
+    overwrites[member] = get_lobby_player_overwrite()
+  return overwrites
+
+def get_lobby_player_overwrite():
+  return discord.PermissionOverwrite(
+      view_channel=True )
 
   
\ No newline at end of file
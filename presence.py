@@ -0,0 +1,124 @@
+import discord
+from constants import PARTICIPANT_ROLE_NAME, WAITING_ROOM_NAME
+
+# Where a participant is
+FARAWAY = 'faraway' # not connected to the guild's voice channels
+WAITING = 'waiting' # in the waiting room
+BUSY = 'busy' # in a channel of MOVE_PROTECTED_CATEGORIES
+ELSEWHERE = 'elsewhere'
+# Whether they can be moved
+MOBILE = 'mobile'
+INVISIBLE = 'invisible'
+MOVABLE = 'movable'
+
+class PresenceIndex:
+  """ Keeps the participants sorted by where they are and whether they can
+      be moved, from the gateway events, so commands don't need to check
+      every participant again.
+      It's built from the participant role on first use, and built again
+      once the participant role, the waiting room or a category changes.
+      Usage:
+          for member in presence.members(places=[ELSEWHERE], devices=[MOVABLE]):
+            ...
+          presence.counts()
+  """
+
+  def __init__(self, client):
+    self.client = client
+    self.keys = None # member id -> (place, device), None until built
+    self.buckets = {} # (place, device) -> {member id: member}
+    # Called with (member, key) whenever a participant's key changes,
+    # keeping the index built while there's any
+    self.listeners = []
+
+  def invalidate(self):
+    self.keys = None
+    self.buckets = {}
+
+  def build(self):
+    if self.keys is None:
+      self.keys = {}
+      role = self.client.get_participant_role()
+      for member in (role.members if role else ()):
+        self.add(member)
+
+  def place(self, member):
+    if self.client.is_faraway(member):
+      return FARAWAY
+    if self.client.is_waiting(member):
+      return WAITING
+    if self.client.is_busy(member):
+      return BUSY
+    return ELSEWHERE
+
+  def device(self, member):
+    if member.is_on_mobile():
+      return MOBILE
+    if self.client.is_offline_or_invisible(member):
+      return INVISIBLE
+    return MOVABLE
+
+  def add(self, member):
+    old_key = self.discard(member)
+    key = (self.place(member), self.device(member))
+    self.keys[member.id] = key
+    self.buckets.setdefault(key, {})[member.id] = member
+    if key != old_key:
+      for listener in self.listeners:
+        listener(member, key)
+
+  def discard(self, member):
+    if self.keys is None:
+      return None
+    key = self.keys.pop(member.id, None)
+    if key:
+      del self.buckets[key][member.id]
+    return key
+
+  def update(self, member):
+    # To call whenever member's roles, status or voice state change
+    if self.keys is None:
+      if not self.listeners:
+        return
+      self.build()
+    if self.client.get_participant_role() in member.roles:
+      self.add(member)
+    else:
+      self.discard(member)
+
+  def on_structure_change(self, obj):
+    # To call for every role or channel created, deleted or updated
+    if isinstance(obj, discord.CategoryChannel) or \
+        obj.name in (PARTICIPANT_ROLE_NAME, WAITING_ROOM_NAME):
+      self.invalidate()
+
+  def key(self, member):
+    # (place, device) of a participant, None for others
+    self.build()
+    return self.keys.get(member.id)
+
+  def members(self, places=None, devices=None):
+    self.build()
+    return [member for (place, device), bucket in self.buckets.items()
+      if (places is None or place in places)
+      and (devices is None or device in devices)
+      for member in bucket.values()]
+
+  def count(self, places=None, devices=None):
+    self.build()
+    return sum(len(bucket) for (place, device), bucket in self.buckets.items()
+      if (places is None or place in places)
+      and (devices is None or device in devices))
+
+  def counts(self):
+    # Participants per bucket, the way SUMMON sees them: the ones neither
+    # far away nor waiting being mobile, invisible, busy or movable
+    around = (BUSY, ELSEWHERE)
+    return {
+      FARAWAY: self.count([FARAWAY]),
+      WAITING: self.count([WAITING]),
+      MOBILE: self.count(around, [MOBILE]),
+      INVISIBLE: self.count(around, [INVISIBLE]),
+      BUSY: self.count([BUSY], [MOVABLE]),
+      MOVABLE: self.count([ELSEWHERE], [MOVABLE]),
+    }
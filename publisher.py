@@ -0,0 +1,109 @@
+import asyncio
+import sys
+from traceback import print_exc
+import discord
+from constants import PUBLISH_WINDOW_SECONDS, PUBLISH_PAGE_SIZE, ROUTE_MESSAGE
+
+class Publisher:
+  """ Posts the announcements of the waiting chat as embeds. The texts
+      published within `window` seconds of each other, or while earlier
+      messages wait for the rate limiter, are merged into one message, and
+      messages longer than Discord's `page_size` characters are split
+      between lines into pages sent in order.
+      publish() returns at once, failures being only printed: call flush()
+      to wait for everything published to be sent.
+      Usage:
+          await publisher.publish("text")
+          await publisher.publish(discord.Embed(...)) # sent as it is
+  """
+
+  def __init__(self, client, window=PUBLISH_WINDOW_SECONDS, page_size=PUBLISH_PAGE_SIZE):
+    self.client = client
+    self.window = window
+    self.page_size = page_size
+    self.pending = [] # texts and embeds, in publishing order
+    self.flushing = None
+    self.due = None # future cutting the window short
+    self.n_published = 0
+    self.n_sent = 0
+
+  async def publish(self, embed): # embed can be a string
+    self.pending.append(embed)
+    self.n_published += 1
+    self.schedule()
+
+  def schedule(self):
+    if self.flushing is None:
+      self.due = asyncio.get_event_loop().create_future()
+      self.flushing = asyncio.ensure_future(self.flush_later())
+
+  async def flush_later(self):
+    try:
+      await asyncio.wait_for(self.due, self.window)
+    except asyncio.TimeoutError:
+      pass
+    try:
+      while self.pending:
+        batch, self.pending = self.pending, []
+        for embed in self.paginate(batch):
+          try:
+            await self.send(embed)
+          except Exception:
+            # the following pages are still sent
+            print("Error while publishing", file=sys.stderr)
+            print_exc(file=sys.stdout)
+    finally:
+      self.flushing = None
+      if self.pending:
+        # published while the flush was being cancelled
+        self.schedule()
+
+  async def flush(self):
+    while self.flushing:
+      flushing = self.flushing
+      if not self.due.done():
+        self.due.set_result(None)
+      await flushing
+
+  def paginate(self, batch):
+    # Consecutive texts are joined, then cut into pages
+    lines = []
+    for embed in batch + [None]:
+      if isinstance(embed, str):
+        lines.extend(embed.split('\n'))
+        continue
+      page = []
+      size = 0
+      for line in lines:
+        while len(line) > self.page_size:
+          # a single line too long for a page
+          if page:
+            yield discord.Embed(description='\n'.join(page))
+            page, size = [], 0
+          yield discord.Embed(description=line[:self.page_size])
+          line = line[self.page_size:]
+        if page and size + 1 + len(line) > self.page_size:
+          yield discord.Embed(description='\n'.join(page))
+          page, size = [], 0
+        size += len(line) + (1 if page else 0)
+        page.append(line)
+      if page:
+        yield discord.Embed(description='\n'.join(page))
+      lines = []
+      if embed is not None:
+        yield embed
+
+  async def send(self, embed):
+    channel = self.client.get_waiting_chat()
+    if not channel:
+      return
+    try:
+      async with self.client.limiter.request(ROUTE_MESSAGE, channel.id, 'send_message'):
+        await channel.send(embed=embed)
+      self.n_sent += 1
+    except discord.errors.HTTPException as e:
+      print(f"Couldn't publish in {channel}", file=sys.stderr)
+      print(e)
+
+  def stats(self):
+    return f'{self.n_published} published in {self.n_sent} messages'
@@ -0,0 +1,116 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+import discord
+from constants import RATE_LIMITS
+
+class TokenBucket:
+  """ Holds `rate` tokens like Discord's bucket, each one coming back `per`
+      seconds after it was spent: `rate` requests can go at once, the
+      bucket refills at rate/per, and no window of `per` seconds ever
+      sees more than `rate` requests, wherever Discord starts its own.
+      Waiters are served first come first served.
+  """
+
+  def __init__(self, rate, per):
+    self.rate = rate
+    self.per = per
+    self.spent = deque() # when the tokens out were spent, oldest first
+    self.lock = asyncio.Lock()
+    # stats
+    self.queue_depth = 0
+    self.max_queue_depth = 0
+    self.n_requests = 0
+    self.n_waited = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+
+  def refill(self):
+    now = time.monotonic()
+    while self.spent and self.spent[0] + self.per <= now:
+      self.spent.popleft()
+
+  async def acquire(self):
+    t0 = time.monotonic()
+    waited = self.lock.locked()
+    self.queue_depth += 1
+    self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+    try:
+      async with self.lock:
+        self.refill()
+        if len(self.spent) >= self.rate:
+          waited = True
+          await asyncio.sleep(self.spent[0] + self.per - time.monotonic())
+          self.refill()
+        self.spent.append(time.monotonic())
+    finally:
+      self.queue_depth -= 1
+    wait = time.monotonic() - t0
+    self.n_requests += 1
+    if waited:
+      self.n_waited += 1
+    self.total_wait += wait
+    self.max_wait = max(self.max_wait, wait)
+
+  def stats(self):
+    return {
+      "requests": self.n_requests,
+      "waited": self.n_waited,
+      "queue_depth": self.queue_depth,
+      "max_queue_depth": self.max_queue_depth,
+      "avg_wait": self.total_wait / self.n_requests if self.n_requests else 0.0,
+      "max_wait": self.max_wait,
+    }
+
+class RateLimiter:
+  """ A token bucket per route and major parameter, like Discord keeps
+      them. Every REST call goes through request() first, so bursts are
+      spread out on our side instead of stalling on Discord's 429
+      responses. Routes without a configured limit never wait.
+      Usage:
+          async with limiter.request(ROUTE_MEMBER, member.guild.id, 'move'):
+            await member.move_to(channel)
+      With metrics, the time waited and the request's latency and status
+      are recorded for its operation.
+  """
+
+  def __init__(self, limits=RATE_LIMITS, metrics=None):
+    self.limits = limits
+    self.buckets = {} # (route, major parameter) -> TokenBucket
+    self.metrics = metrics
+
+  async def wait(self, route, major):
+    if route in self.limits:
+      key = (route, major)
+      if key not in self.buckets:
+        self.buckets[key] = TokenBucket(*self.limits[route])
+      await self.buckets[key].acquire()
+
+  @asynccontextmanager
+  async def request(self, route, major, operation):
+    if not self.metrics:
+      await self.wait(route, major)
+      yield
+      return
+    t0 = time.perf_counter()
+    await self.wait(route, major)
+    t1 = time.perf_counter()
+    self.metrics.observe('rest_limiter_wait_seconds', t1 - t0, operation=operation)
+    status = 'ok'
+    try:
+      yield
+    except discord.errors.HTTPException as e:
+      status = str(e.status)
+      raise
+    except Exception:
+      status = 'error'
+      raise
+    finally:
+      self.metrics.observe('rest_request_seconds', time.perf_counter() - t1,
+        operation=operation)
+      self.metrics.count('rest_requests_total', operation=operation, status=status)
+
+  def stats(self):
+    return {f'{route} {major}': bucket.stats()
+      for (route, major), bucket in self.buckets.items()}
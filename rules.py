@@ -1,18 +1,49 @@
 import sys
+import time
 from traceback import print_exc
-import random
 import math
 import discord
-from constants import OK_REACTION, KO_REACTION, LOBBY_CAPACITY
+from contextlib import asynccontextmanager
+from constants import OK_REACTION, KO_REACTION, AUTO_SUMMON_MINUTES, METRICS_BUCKETS
+from locks import STRUCTURE, RATINGS, member_key, channel_key
+from asyncioext import gather_or_cancel
+from presence import FARAWAY, WAITING, BUSY, ELSEWHERE, MOBILE, INVISIBLE, MOVABLE
 from strings import *
 
 
+def parse_command(content):
+  # Returns (cmd, args) or None when the message has no words at all
+  words = content.upper().split()
+  if words:
+    return words[0], words[1:]
+  return None
+
 class RuleProcessor:
   def __init__(self, *rules):
     self.rules = rules
+    # Rules not bound to a command see every message, so they are merged
+    # into every route keeping the registration order of the rules
+    self.generic_rules = [r for r in rules if not isinstance(r, CmdRule)]
+    self.routes = {}
+    for rule in rules:
+      if isinstance(rule, CmdRule) and rule.cmd not in self.routes:
+        self.routes[rule.cmd] = [r for r in rules
+            if not isinstance(r, CmdRule) or r.cmd == rule.cmd]
   async def run(self, msg):
-    for rule in self.rules:
-      if await rule.process(msg): return True
+    # Only the first word is needed to route, the rest of the message is
+    # parsed just for the rules registered to its command
+    words = msg.content.split(None, 1)
+    route = self.routes.get(words[0].upper()) if words else None
+    if route is None:
+      for rule in self.generic_rules:
+        await rule.process(msg)
+      return False
+    cmd, args = parse_command(msg.content)
+    for rule in route:
+      if isinstance(rule, CmdRule):
+        if await rule.process_command(cmd, args, msg): return True
+      else:
+        await rule.process(msg)
     return False
 
 ########### Generic/Abstract/Common Rules ###########
@@ -41,25 +72,43 @@ class LogDirectMessageRule(DirectMessageRule):
     return False
 
 class CmdRule(MessageRule):
+  # Whether the command creates or deletes the tournament's roles and channels
+  structural = False
   def __init__(self, client, cmd, min_args=0, max_args=0):
     super().__init__(client)
     self.cmd = cmd.upper()
     self.min_args = min_args
     self.max_args = max_args
+    self.evaluate_seconds = client.metrics.histogram(
+      'command_evaluate_seconds', command=self.cmd)
+    self.execute_seconds = client.metrics.histogram(
+      'command_execute_seconds', command=self.cmd)
+    self.lock_wait_seconds = client.metrics.histogram(
+      'command_lock_wait_seconds', command=self.cmd)
   async def process(self, msg):
+    command = parse_command(msg.content)
+    if command:
+      cmd, args = command
+      return await self.process_command(cmd, args, msg)
+    return False
+  async def process_command(self, cmd, args, msg):
     #if not msg.author.bot:
     if msg.author != self.client.user:
-      if msg.content != "":
-        args = msg.content.upper().split()
-        cmd = args[0]
-        args = args[1:]
-        if await self.evaluate(cmd, args, msg):
-          try:
-            async with msg.channel.typing():
-              await self.execute(args, msg)
-          except Exception as e:
-            await self.on_execute_error(msg, e)
-          return True
+      t0 = time.perf_counter()
+      accepted = await self.evaluate(cmd, args, msg)
+      self.evaluate_seconds.observe(time.perf_counter() - t0)
+      if accepted:
+        outcome = 'ok'
+        t0 = time.perf_counter()
+        try:
+          async with msg.channel.typing():
+            await self.execute(args, msg)
+        except Exception as e:
+          outcome = 'error'
+          await self.on_execute_error(msg, e)
+        self.execute_seconds.observe(time.perf_counter() - t0)
+        self.client.metrics.count('commands_total', command=self.cmd, outcome=outcome)
+        return True
     return False
   async def evaluate(self, cmd, args, msg):
     if await super().evaluate(msg):
@@ -67,30 +116,50 @@ class CmdRule(MessageRule):
         return self.min_args <= len(args) <= self.max_args
     return False
   async def execute(self, args, msg):
-      await msg.add_reaction(OK_REACTION)
+      await self.client.react(msg, OK_REACTION)
       await super().execute(msg)
+  async def resources(self, args, msg):
+    # Keys of client.locks the command reads and the ones it writes
+    if self.structural:
+      return [], [STRUCTURE]
+    return [STRUCTURE], []
+  @asynccontextmanager
+  async def locked(self, args, msg):
+    reads, writes = await self.resources(args, msg)
+    t0 = time.perf_counter()
+    async with self.client.locks.locked(self.cmd, reads, writes):
+      self.lock_wait_seconds.observe(time.perf_counter() - t0)
+      yield
+  def member_keys(self, ids_or_mentions):
+    return [member_key(self.client.get_member_id(id_or_mention))
+      for id_or_mention in ids_or_mentions]
   async def on_execute_error(self, msg, e):
     print(f"Error while executing command {self.cmd}", file=sys.stderr)
     print_exc(file=sys.stdout)
-    await msg.add_reaction(KO_REACTION)
+    await self.client.react(msg, KO_REACTION)
   async def publish(self, embed): # embed can be a string
-    if self.client.get_waiting_chat():
-      if isinstance(embed, str):
-        embed = discord.Embed(description = embed)
-      await self.client.get_waiting_chat().send(embed=embed)
+    await self.client.publish(embed)
   async def whisper(self, user, txt):
-    dm_channel = await user.create_dm()
-    await dm_channel.send(txt)
-  async def try_summon(self, member, channel, buffer):
-    try:
-      await member.move_to(channel)
-    except discord.errors.HTTPException as e:
-      buffer[-1] = MEMBER_ERROR.format(member=buffer[-1])
-      await self.whisper(member,
-        COULDNT_SUMMON_IN_CHANNEL_BECAUSE_FARWAY.format(
-          channel=channel, guild=self.client.guild.name))
-      print(f"Member {member} not connected to voice", file=sys.stderr)
-      print(e)
+    return not await self.client.broadcaster.send(user, txt)
+  async def whisper_all(self, whispers):
+    # whispers are (user, text), returns the users the text didn't reach
+    outcomes = await self.client.broadcaster.send_all(whispers)
+    return [user for (user, _), error in zip(whispers, outcomes) if error]
+  async def summon_all(self, summons, buffer, whispers):
+    # summons are (member, channel, index of the member's line in buffer),
+    # the index is None for members that have no line yet.
+    # Members that couldn't be moved are added to whispers.
+    outcomes = await self.client.mover.move_all(
+      [(member, channel) for member, channel, _ in summons])
+    for (member, channel, line), error in zip(summons, outcomes):
+      if error:
+        if line is None:
+          buffer.append(MEMBER_ERROR.format(member=member.mention))
+        else:
+          buffer[line] = MEMBER_ERROR.format(member=buffer[line])
+        whispers.append((member,
+          COULDNT_SUMMON_IN_CHANNEL_BECAUSE_FARWAY.format(
+            channel=channel, guild=self.client.guild.name)))
 
 class ProtectedCmdRule(CmdRule):
   async def evaluate(self, cmd, args, msg):
@@ -126,19 +195,21 @@ class ProtectedWaitingChatCmdRule(ProtectedCmdRule):
 ########### Concrete Commands Rules ###########
 
 class PrepareCmdRule(ProtectedCmdRule):
+  structural = True
   def __init__(self, client):
     super().__init__(client, CMD_PREPARE)
   async def execute(self, args, msg):
-    async with self.client.env_lock.w_locked():
+    async with self.locked(args, msg):
       await self.client.prepare()
     await self.client.execute_old_commands()
     await super().execute(args, msg)
 
 class CleanCmdRule(ProtectedWaitingChatCmdRule):
+  structural = True
   def __init__(self, client):
     super().__init__(client, CMD_CLEAN)
   async def execute(self, args, msg):
-    async with self.client.env_lock.w_locked():
+    async with self.locked(args, msg):
       waiting_room = self.client.get_waiting_chat()
       await self.client.clean()
       if msg.channel != waiting_room:
@@ -148,8 +219,10 @@ class CleanCmdRule(ProtectedWaitingChatCmdRule):
 class PromoteCmdRule(ProtectedWaitingChatCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_PROMOTE, 1, math.inf)
+  async def resources(self, args, msg):
+    return [STRUCTURE], self.member_keys(args)
   async def execute(self, args, msg):
-    async with self.client.env_lock.r_locked():
+    async with self.locked(args, msg):
       for id_or_mention in args:
         member = await self.client.get_member(id_or_mention)
         await self.client.give_manager_role(member)
@@ -158,8 +231,10 @@ class PromoteCmdRule(ProtectedWaitingChatCmdRule):
 class DemoteCmdRule(ProtectedWaitingChatCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_DEMOTE, 1, math.inf)
+  async def resources(self, args, msg):
+    return [STRUCTURE], self.member_keys(args)
   async def execute(self, args, msg):
-    async with self.client.env_lock.r_locked():
+    async with self.locked(args, msg):
       for id_or_mention in args:
         member = await self.client.get_member(id_or_mention)
         await self.client.revoke_manager_role(member)
@@ -168,30 +243,42 @@ class DemoteCmdRule(ProtectedWaitingChatCmdRule):
 class BringCmdRule(ProtectedWaitingChatCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_BRING, 1, math.inf)
+  async def resources(self, args, msg):
+    return [STRUCTURE], self.member_keys(args)
   async def execute(self, args, msg):
-    async with self.client.env_lock.r_locked():
+    async with self.locked(args, msg):
+      buffer = []
       for id_or_mention in args:
         member = await self.client.get_member(id_or_mention)
         if await self.client.give_participant_role(member):
-          await self.publish(MEMBER_JOINS.format(member=member.mention))
+          buffer.append(MEMBER_JOINS.format(member=member.mention))
+      if buffer:
+        await self.publish("\n".join(buffer))
       await super().execute(args, msg)
 
 class KickCmdRule(ProtectedWaitingChatCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_KICK, 1, math.inf)
+  async def resources(self, args, msg):
+    return [STRUCTURE], self.member_keys(args)
   async def execute(self, args, msg):
-    async with self.client.env_lock.r_locked():
+    async with self.locked(args, msg):
+      buffer = []
       for id_or_mention in args:
         member = await self.client.get_member(id_or_mention)
         if await self.client.revoke_participant_role(member):
-          await self.publish(MEMBER_QUITS.format(member=member.mention))
+          buffer.append(MEMBER_QUITS.format(member=member.mention))
+      if buffer:
+        await self.publish("\n".join(buffer))
       await super().execute(args, msg)
 
 class AssignCmdRule(ProtectedWaitingChatCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_ASSIGN, 2, 2)
+  async def resources(self, args, msg):
+    return [STRUCTURE], self.member_keys(args[:1])
   async def execute(self, args, msg):
-    async with self.client.env_lock.r_locked():
+    async with self.locked(args, msg):
       id_or_mention = args[0]
       lobby_index = args[1]
       member = await self.client.get_member(id_or_mention)
@@ -201,37 +288,76 @@ class AssignCmdRule(ProtectedWaitingChatCmdRule):
         await self.client.give_lobby_role(member, lobby_index)
       await super().execute(args, msg)
 
+class RateCmdRule(ProtectedWaitingChatCmdRule):
+  # RATE [id/mention] [rating] sets the rating START balances the lobbies on
+  def __init__(self, client):
+    super().__init__(client, CMD_RATE, 2, 2)
+  async def evaluate(self, cmd, args, msg):
+    return await super().evaluate(cmd, args, msg) and is_rating(args[1])
+  async def resources(self, args, msg):
+    return [STRUCTURE], [RATINGS]
+  async def execute(self, args, msg):
+    async with self.locked(args, msg):
+      member = await self.client.get_member(args[0])
+      rating = float(args[1])
+      await self.client.rate(member, rating)
+      await self.publish(MEMBER_RATED.format(member=member.mention, rating=rating))
+      await super().execute(args, msg)
+
+def is_rating(arg):
+  try:
+    return math.isfinite(float(arg))
+  except ValueError:
+    return False
+
 class BanCmdRule(ProtectedWaitingChatCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_BAN, 1, math.inf)
+  async def resources(self, args, msg):
+    return [STRUCTURE], self.member_keys(args)
   async def execute(self, args, msg):
-    async with self.client.env_lock.r_locked():
+    async with self.locked(args, msg):
+      buffer = []
       for id_or_mention in args:
         member = await self.client.get_member(id_or_mention)
         if await self.client.give_banned_role(member):
-          await self.publish(MEMBER_BANNED.format(member=member.mention))
+          buffer.append(MEMBER_BANNED.format(member=member.mention))
+      if buffer:
+        await self.publish("\n".join(buffer))
       await super().execute(args, msg)
 
 class UnbanCmdRule(ProtectedWaitingChatCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_UNBAN, 1, math.inf)
+  async def resources(self, args, msg):
+    return [STRUCTURE], self.member_keys(args)
   async def execute(self, args, msg):
-    async with self.client.env_lock.r_locked():
+    async with self.locked(args, msg):
+      buffer = []
       for id_or_mention in args:
         member = await self.client.get_member(id_or_mention)
         if await self.client.revoke_banned_role(member):
-          await self.publish(MEMBER_UNBANNED.format(member=member.mention))
+          buffer.append(MEMBER_UNBANNED.format(member=member.mention))
+      if buffer:
+        await self.publish("\n".join(buffer))
       await super().execute(args, msg)
 
 class BroadcastCmdRule(ProtectedWaitingChatCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_BROADCAST, 1, math.inf)
   async def execute(self, args, msg):
-    async with self.client.env_lock.r_locked():
+    # The DMs go out once the lock is released, as they can take minutes
+    # and would hold back every command waiting behind a structural one
+    async with self.locked(args, msg):
       ad = msg.content[len(self.cmd)+1:]
-      for member in self.client.get_participants():
-        await self.whisper(member, ad)
-      await super().execute(args, msg)
+      participants = self.client.get_participants()
+    failed = await self.whisper_all([(member, ad) for member in participants])
+    buffer = [BROADCAST_DELIVERED.format(
+      n_delivered=len(participants) - len(failed), n_failed=len(failed))]
+    for member in failed:
+      buffer.append(MEMBER_ERROR.format(member=member.mention))
+    await self.publish("\n".join(buffer))
+    await super().execute(args, msg)
 
 class SummonCmdRule(ProtectedWaitingChatCmdRule):
   def __init__(self, client):
@@ -240,168 +366,223 @@ class SummonCmdRule(ProtectedWaitingChatCmdRule):
     return await super().evaluate(cmd, args, msg) \
        and (len(args) == 0 or args[0] == "+")
        #and not self.client.is_lobby_phase()
+  async def resources(self, args, msg):
+    return [STRUCTURE], [member_key(member.id)
+      for member in self.client.get_participants()]
   async def execute(self, args, msg):
-    async with self.client.env_lock.w_locked():
+    async with self.locked(args, msg):
       do_all = len(args) == 1
-      participants = self.client.get_participants()
-      
+      presence = self.client.presence
+      waiting_room = self.client.get_waiting_room()
+
       buffer = []
-      for participant in participants:
-        if self.client.is_faraway(participant):
-          # Member isn't connected to this server
-          buffer.append(MEMBER_FARAWAY.format(member=participant.mention))
-          await self.whisper(participant,
-            COULDNT_SUMMON_IN_CHANNEL_BECAUSE_FARWAY.format(
-              channel=self.client.get_waiting_room().mention,
-              guild=self.client.guild.name))
-        elif self.client.is_waiting(participant):
-          # Member is already in the waiting-room
-          buffer.append(MEMBER_HERE.format(member=participant.mention))
-        else:
-          if participant.is_on_mobile():
-            # Usually we don't move members on mobile, as they'd get bugged
-            buffer.append(MEMBER_MOBILE.format(member=participant.mention))
-            if not do_all:
-              await self.whisper(participant,
-                COULDNT_SUMMON_IN_CHANNEL_BECAUSE_MOBILE.format(
-                  channel=self.client.get_waiting_room().mention,
-                  guild=self.client.guild.name))
-              continue
-          elif self.client.is_offline_or_invisible(participant):
-            # Usually we don't move members with invisible status, as they could be on mobile
-            buffer.append(MEMBER_INVISIBLE.format(member=participant.mention))
-            if not do_all:
-              await self.whisper(participant,
-                COULDNT_SUMMON_IN_CHANNEL_BECAUSE_INVISIBLE.format(
-                  channel=self.client.get_waiting_room().mention,
-                  guild=self.client.guild.name))
-              continue
-          elif self.client.is_busy(participant):
-            # Usually we don't move members in some known gaming channels
-            buffer.append(MEMBER_BUSY.format(member=participant.mention))
-            if not do_all:
-              await self.whisper(participant,
-                COULDNT_SUMMON_IN_CHANNEL_BECAUSE_BUSY.format(
-                  channel=self.client.get_waiting_room().mention,
-                  guild=self.client.guild.name))
-              continue
-          # member is ready to be summoned
-          await self.try_summon(participant, self.client.get_waiting_room(), buffer)
-      await self.publish("\n".join(buffer))
+      summons = []
+      whispers = []
+      for participant in presence.members([FARAWAY]):
+        # Member isn't connected to this server
+        buffer.append(MEMBER_FARAWAY.format(member=participant.mention))
+        whispers.append((participant,
+          COULDNT_SUMMON_IN_CHANNEL_BECAUSE_FARWAY.format(
+            channel=waiting_room.mention,
+            guild=self.client.guild.name)))
+      for participant in presence.members([WAITING]):
+        # Member is already in the waiting-room
+        buffer.append(MEMBER_HERE.format(member=participant.mention))
+      for places, devices, line, whisper in (
+          # Usually we don't move members on mobile, as they'd get bugged...
+          ([BUSY, ELSEWHERE], [MOBILE], MEMBER_MOBILE,
+            COULDNT_SUMMON_IN_CHANNEL_BECAUSE_MOBILE),
+          # ...members with invisible status, as they could be on mobile...
+          ([BUSY, ELSEWHERE], [INVISIBLE], MEMBER_INVISIBLE,
+            COULDNT_SUMMON_IN_CHANNEL_BECAUSE_INVISIBLE),
+          # ...and members in some known gaming channels
+          ([BUSY], [MOVABLE], MEMBER_BUSY,
+            COULDNT_SUMMON_IN_CHANNEL_BECAUSE_BUSY)):
+        for participant in presence.members(places, devices):
+          buffer.append(line.format(member=participant.mention))
+          if do_all:
+            summons.append((participant, waiting_room, len(buffer) - 1))
+          else:
+            whispers.append((participant, whisper.format(
+              channel=waiting_room.mention, guild=self.client.guild.name)))
+      # members ready to be summoned
+      for participant in presence.members([ELSEWHERE], [MOVABLE]):
+        summons.append((participant, waiting_room, None))
+      await self.summon_all(summons, buffer, whispers)
+    await self.whisper_all(whispers)
+    await self.publish("\n".join(buffer))
+    await super().execute(args, msg)
+
+class AutoSummonCmdRule(ProtectedWaitingChatCmdRule):
+  # AUTOSUMMON [minutes] arms the auto summoner, AUTOSUMMON STOP disarms it
+  def __init__(self, client):
+    super().__init__(client, CMD_AUTOSUMMON, 0, 1)
+  async def evaluate(self, cmd, args, msg):
+    return await super().evaluate(cmd, args, msg) \
+       and (len(args) == 0 or args[0] == CMD_STOP or args[0].isdigit())
+  async def execute(self, args, msg):
+    async with self.locked(args, msg):
+      summoner = self.client.auto_summoner
+      if args and args[0] == CMD_STOP:
+        if not summoner.disarm():
+          raise RuntimeError("Auto summon isn't armed")
+      else:
+        minutes = int(args[0]) if args else AUTO_SUMMON_MINUTES
+        n_movable = summoner.arm(minutes)
+        await self.publish(AUTO_SUMMON_ARMED.format(
+          channel=self.client.get_waiting_room().mention,
+          minutes=minutes, n_movable=n_movable))
       await super().execute(args, msg)
 
-class MuteCmdRule(ProtectedWaitingChatCmdRule):
+class ManagedChannelCmdRule(ProtectedWaitingChatCmdRule):
+  # Commands acting on the voice channel of their author
+  async def resources(self, args, msg):
+    member = await self.client.get_member(msg.author)
+    if member and member.voice and member.voice.channel:
+      return [STRUCTURE], [channel_key(member.voice.channel.id)]
+    return [STRUCTURE], []
+
+class MuteCmdRule(ManagedChannelCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_MUTE)
   async def execute(self, args, msg):
-    async with self.client.env_lock.w_locked():
+    async with self.locked(args, msg):
       affected_channel = await self.client.mute_channel_managed_by(msg.author)
       if affected_channel:
         await self.publish(MUTED_CHANNEL.format(channel=affected_channel.name))
       await super().execute(args, msg)
 
-class UnmuteCmdRule(ProtectedWaitingChatCmdRule):
+class UnmuteCmdRule(ManagedChannelCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_UNMUTE)
   async def execute(self, args, msg):
-    async with self.client.env_lock.w_locked():
+    async with self.locked(args, msg):
       affected_channel = await self.client.mute_channel_managed_by(msg.author, unmute=True)
       if affected_channel:
         await self.publish(UNMUTED_CHANNEL.format(channel=affected_channel.name))
       await super().execute(args, msg)
 
 class StartCmdRule(ProtectedWaitingChatCmdRule):
+  structural = True
   def __init__(self, client):
     super().__init__(client, CMD_START, 0, 1)
   async def evaluate(self, cmd, args, msg):
     return await super().evaluate(cmd, args, msg) \
        and (len(args) == 0 or args[0] == "+")
   async def execute(self, args, msg):
-    async with self.client.env_lock.w_locked():
+    async with self.locked(args, msg):
       if self.client.is_lobby_phase():
         raise RuntimeError("Lobbies already created")
       do_all = len(args) == 1
 
-      waiters = set(self.client.get_waiting_room().members)
-      participants = set(self.client.get_participants())
-      players = participants.intersection(waiters)
-      absents = participants.difference(waiters)
-
-      print('members:', len(self.client.guild.members))
-      print('waiters:', len(waiters))
-      print('participants:', len(participants))
-
-      players = list(players)
-      random.shuffle(players)
-      n_lobbies = (len(players) + LOBBY_CAPACITY - 1) // LOBBY_CAPACITY
-      lobbies = [[] for _ in range(n_lobbies)]
-      for p in range(len(players)):
-        lobby = lobbies[p % n_lobbies]
-        member = players[p]
-        lobby.append(member)
-      
+      presence = self.client.presence
+      players = presence.members([WAITING])
+      n_absents = presence.count() - len(players)
+
+      print('participants:', presence.count())
+      print('waiting:', len(players))
+
+      t0 = time.perf_counter()
+      lobbies = await self.client.make_lobbies(players)
+      timings = {'matchmaking': time.perf_counter() - t0}
+
       buffer = [PARTICIPANTS_MISSING_AND_IN_CHANNEL.format(
-          n_away=len(absents),
+          n_away=n_absents,
           channel=self.client.get_waiting_room().name,
           n_here=len(players))]
 
-      for l in range(n_lobbies):
-        players = lobbies[l]
-        lobby_channel = await self.client.create_lobby(l+1, players)
-        buffer.append(f'\n**Lobby {l+1}**: *{len(players)}*')
-        for member in players:
-          if member.is_on_mobile():
-            # We usually don't move members on mobile as they'd get bugged...
-            buffer.append(MEMBER_MOBILE.format(member=member.mention))
-            if not do_all:
-              await self.whisper(member,
-                COULDNT_SUMMON_IN_CHANNEL_BECAUSE_MOBILE.format(
-                  channel=lobby_channel.mention))
-              continue
-          elif self.client.is_offline_or_invisible(member):
-            # ...and invisible ones could be on mobile!
-            buffer.append(MEMBER_INVISIBLE.format(member=member.mention))
-            if not do_all:
-              await self.whisper(member,
-                COULDNT_SUMMON_IN_CHANNEL_BECAUSE_INVISIBLE.format(
-                  channel=lobby_channel.mention))
-              continue
-          else:
-            buffer.append(member.mention)
-          await self.try_summon(member, lobby_channel, buffer)
-      
-      await self.publish('\n'.join(buffer))
-      await super().execute(args, msg)
+      # Every lobby is created at once, and its players are moved as soon
+      # as its channel exists. A lobby failing stops the others before
+      # the locks are released.
+      whispers = []
+      results = await gather_or_cancel(*(self.start_lobby(l+1, lobby, do_all, whispers)
+        for l, lobby in enumerate(lobbies)))
+      for lines, lobby_timings in results:
+        buffer.extend(lines)
+        for stage, seconds in lobby_timings.items():
+          # the slowest lobby, as they all run at once
+          timings[stage] = max(timings.get(stage, 0), seconds)
+
+    # The DMs go out once the locks are released
+    t1 = time.perf_counter()
+    await self.whisper_all(whispers)
+    timings['whispers'] = time.perf_counter() - t1
+    timings['total'] = time.perf_counter() - t0
+    buffer.append(START_TIMINGS.format(timings=', '.join(
+      f'{stage} {seconds:.2f}s' for stage, seconds in timings.items())))
+    await self.publish('\n'.join(buffer))
+    await super().execute(args, msg)
+
+  async def start_lobby(self, index, players, do_all, whispers):
+    # Returns the lobby's lines of the report and its stage timings
+    lines = [f'\n**Lobby {index}**: *{len(players)}*']
+    timings = {}
+    async def move_players(lobby_channel):
+      summons = []
+      for member in players:
+        device = self.client.presence.device(member)
+        if device == MOBILE:
+          # We usually don't move members on mobile as they'd get bugged...
+          lines.append(MEMBER_MOBILE.format(member=member.mention))
+          if not do_all:
+            whispers.append((member,
+              COULDNT_SUMMON_IN_CHANNEL_BECAUSE_MOBILE.format(
+                channel=lobby_channel.mention)))
+            continue
+        elif device == INVISIBLE:
+          # ...and invisible ones could be on mobile!
+          lines.append(MEMBER_INVISIBLE.format(member=member.mention))
+          if not do_all:
+            whispers.append((member,
+              COULDNT_SUMMON_IN_CHANNEL_BECAUSE_INVISIBLE.format(
+                channel=lobby_channel.mention)))
+            continue
+        else:
+          lines.append(member.mention)
+        summons.append((member, lobby_channel, len(lines) - 1))
+      t0 = time.perf_counter()
+      await self.summon_all(summons, lines, whispers)
+      timings['moves'] = time.perf_counter() - t0
+    await self.client.create_lobby(index, players, timings, move_players)
+    return lines, timings
 
 class EndCmdRule(ProtectedWaitingChatCmdRule):
+  structural = True
   def __init__(self, client):
     super().__init__(client, CMD_END)
   async def execute(self, args, msg):
-    async with self.client.env_lock.w_locked():
+    async with self.locked(args, msg):
       if not self.client.is_lobby_phase():
         raise RuntimeError("There're no lobbies")
       await self.client.delete_lobbies()
       await super().execute(args, msg)
 
-class JoinCmdRule(WaitingChatCmdRule):
-  def __init__(self, client):
-    super().__init__(client, CMD_JOIN)
+class MembershipCmdRule(WaitingChatCmdRule):
+  # JOIN and QUIT, coalesced per user: superseded and dropped ones get no
+  # reaction
+  async def resources(self, args, msg):
+    return [STRUCTURE], [member_key(msg.author.id)]
   async def execute(self, args, msg):
-    async with self.client.env_lock.r_locked():
-      member = await self.client.get_member(msg.author)
-      if await self.client.give_participant_role(member):
-        await self.publish(MEMBER_JOINS.format(member=member.mention))
+    await self.client.coalescer.submit(msg.author.id,
+      lambda: self.execute_now(args, msg))
+  async def execute_now(self, args, msg):
+    async with self.locked(args, msg):
+      await self.apply(await self.client.get_member(msg.author))
       await super().execute(args, msg)
 
-class QuitCmdRule(WaitingChatCmdRule):
+class JoinCmdRule(MembershipCmdRule):
+  def __init__(self, client):
+    super().__init__(client, CMD_JOIN)
+  async def apply(self, member):
+    if await self.client.give_participant_role(member):
+      await self.publish(MEMBER_JOINS.format(member=member.mention))
+
+class QuitCmdRule(MembershipCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_QUIT)
-  async def execute(self, args, msg):
-    async with self.client.env_lock.r_locked():
-      member = await self.client.get_member(msg.author)
-      if await self.client.revoke_participant_role(member):
-        await self.publish(MEMBER_QUITS.format(member=member.mention))
-      await super().execute(args, msg)
+  async def apply(self, member):
+    if await self.client.revoke_participant_role(member):
+      await self.publish(MEMBER_QUITS.format(member=member.mention))
 
 class ListCmdRule(WaitingChatCmdRule):
   def __init__(self, client):
@@ -410,7 +591,7 @@ class ListCmdRule(WaitingChatCmdRule):
     return await super().evaluate(cmd, args, msg) \
        and (len(args) == 0 or args[0] == "+")
   async def execute(self, args, msg):
-    async with self.client.env_lock.r_locked():
+    async with self.locked(args, msg):
       participants = self.client.get_participants()
       buffer = [N_PARTICIPANTS.format(n=len(participants))]
       for member in participants:
@@ -423,6 +604,57 @@ class ListCmdRule(WaitingChatCmdRule):
       await self.publish("\n".join(buffer))
       await super().execute(args, msg)
 
+class StatusCmdRule(WaitingChatCmdRule):
+  def __init__(self, client):
+    super().__init__(client, CMD_STATUS)
+  async def execute(self, args, msg):
+    # Takes no lock, the counts being kept up to date by the presence index
+    presence = self.client.presence
+    await self.publish(PRESENCE_COUNTS.format(
+      n=presence.count(), **presence.counts()))
+    await super().execute(args, msg)
+
+class StatsCmdRule(ProtectedWaitingChatCmdRule):
+  def __init__(self, client):
+    super().__init__(client, CMD_STATS)
+  async def execute(self, args, msg):
+    # What the metrics endpoint serves, summed up
+    metrics = self.client.metrics
+    buffer = [STATS_COMMANDS]
+    for command in metrics.label_values('commands_total', 'command'):
+      execute = metrics.get_histogram('command_execute_seconds', command=command)
+      buffer.append(STATS_COMMAND.format(command=command,
+        n=metrics.get_count('commands_total', command=command),
+        n_failed=metrics.get_count('commands_total', command=command, outcome='error'),
+        execute_p50=seconds(execute.quantile(0.5)),
+        execute_p90=seconds(execute.quantile(0.9)),
+        lock_p90=seconds(metrics.get_histogram('command_lock_wait_seconds',
+          command=command).quantile(0.9))))
+    buffer.append(STATS_REQUESTS)
+    for operation in metrics.label_values('rest_requests_total', 'operation'):
+      request = metrics.get_histogram('rest_request_seconds', operation=operation)
+      n = metrics.get_count('rest_requests_total', operation=operation)
+      buffer.append(STATS_REQUEST.format(operation=operation, n=n,
+        n_failed=n - metrics.get_count('rest_requests_total',
+          operation=operation, status='ok'),
+        p50=seconds(request.quantile(0.5)), p90=seconds(request.quantile(0.9)),
+        wait_p90=seconds(metrics.get_histogram('rest_limiter_wait_seconds',
+          operation=operation).quantile(0.9))))
+    buffer.append(STATS_RATE_LIMITED.format(
+      n=metrics.get_count('rest_rate_limited_total'),
+      seconds=metrics.get_count('rest_retry_after_seconds_total')))
+    tracker = self.client.move_tracker
+    buffer.append(STATS_MOVES.format(n_confirmed=tracker.n_confirmed,
+      n_timed_out=tracker.n_timed_out, n_pending=len(tracker.expected)))
+    await self.publish("\n".join(buffer))
+    await super().execute(args, msg)
+
+def seconds(bound):
+  # Histogram quantiles are only known up to their bucket's bound
+  if bound == math.inf:
+    return f'>{METRICS_BUCKETS[-1]}s'
+  return f'≤{bound}s'
+
 class TerminateCmdRule(ProtectedCmdRule):
   def __init__(self, client):
     super().__init__(client, CMD_TERMINATE)
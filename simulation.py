@@ -0,0 +1,486 @@
+import asyncio
+import copy
+import itertools
+import logging
+import random
+from collections import Counter
+import discord
+from contextlib import asynccontextmanager
+from constants import ROUTE_MEMBER, ROUTE_MEMBER_ROLE, ROUTE_ROLES, ROUTE_CHANNELS, \
+  ROUTE_CHANNEL, ROUTE_PERMISSIONS, ROUTE_DM, ROUTE_MESSAGE, ROUTE_REACTION
+from metrics import Metrics
+
+# Lightweight stand-ins for the discord objects used by the benchmarks.
+# They only implement what the code paths under measure touch, and every
+# call that would hit the REST API goes through a Backend.
+# A TournamentClient linked to a Guild runs unmodified against it, from
+# on_ready on, getting the voice, presence, member, role and channel
+# events it would get from the gateway.
+# Classes the bot checks with isinstance extend the discord ones, setting
+# by hand what discord.py would read from gateway payloads.
+
+# Snowflakes a millisecond apart, as discord.py hashes them by timestamp
+ids = (ms << 22 for ms in itertools.count(180000000000))
+# Requests the client doesn't rate limit: fetching members, reading
+# messages, and voice connections going through the gateway
+ROUTE_MEMBERS = "GET /guilds/{guild_id}/members/{user_id}"
+ROUTE_HISTORY = "GET /channels/{channel_id}/messages"
+ROUTE_VOICE = "voice"
+EMBED_DESCRIPTION_LIMIT = 4096
+# Where discord.py logs the 429s it retries
+log = logging.getLogger('discord.http')
+undefined = object()
+
+class Response:
+  def __init__(self, status, reason):
+    self.status = status
+    self.reason = reason
+
+class Backend:
+  """ Stands in for Discord's REST API: every request takes `latency`
+      seconds and each route in `limits` answers 429 to the requests
+      beyond `rate` in the current window of `per` seconds of its major
+      parameter, the guild or channel the request is made in, which the
+      objects pass from their own IDs.
+      Rejected requests log a warning, sleep retry_after and retry, like
+      discord.py does, giving up with a 429 HTTPException after 5 tries.
+      Calls, 429s and failures are kept per route.
+  """
+
+  def __init__(self, latency=0.0, limits={}, failures={}):
+    self.latency = latency
+    self.limits = limits
+    self.failures = failures # route -> probability of a 4xx error
+    self.windows = {} # (route, major parameter) -> (start, count)
+    self.calls = Counter()
+    self.rate_limited = Counter()
+
+  def retry_after(self, route, major):
+    if route not in self.limits:
+      return 0
+    rate, per = self.limits[route]
+    now = asyncio.get_event_loop().time()
+    start, count = self.windows.get((route, major), (now, 0))
+    if now - start >= per:
+      start, count = now, 0
+    if count >= rate:
+      return start + per - now
+    self.windows[(route, major)] = (start, count + 1)
+    return 0
+
+  async def request(self, route, major=None):
+    for tries in range(5):
+      self.calls[route] += 1
+      await asyncio.sleep(self.latency / 2)
+      retry_after = self.retry_after(route, major)
+      await asyncio.sleep(self.latency / 2)
+      if not retry_after:
+        break
+      self.rate_limited[route] += 1
+      log.warning('We are being rate limited. Retrying in %.2f seconds. '
+        'Handled under the bucket "%s"', retry_after, bucket(route, major))
+      await asyncio.sleep(retry_after)
+    else:
+      raise discord.errors.HTTPException(Response(429, 'Too Many Requests'),
+        'You are being rate limited.')
+    if random.random() < self.failures.get(route, 0):
+      raise discord.errors.HTTPException(Response(400, 'Bad Request'),
+        'Target user is not connected to voice.')
+
+def bucket(route, major):
+  # discord.py's channel_id:guild_id:path
+  if '{guild_id}' in route:
+    return f'None:{major}:{route}'
+  if '{channel_id}' in route:
+    return f'{major}:None:{route}'
+  return f'None:None:{route}'
+
+class User(discord.User):
+  def __init__(self, id, name):
+    self.id = id
+    self.name = name
+    self.discriminator = '0000'
+    self.bot = False
+  def __str__(self):
+    return self.name
+  def __hash__(self):
+    return hash(self.id)
+
+class Member(User):
+  def __init__(self, id, name, backend=None, guild=None):
+    super().__init__(id, name)
+    self.guild = guild
+    self.roles = []
+    self.guild_permissions = Permissions()
+    self.backend = backend or Backend()
+    self.voice = None
+    self.status = discord.Status.online
+    self.mobile = False
+    self.dms_closed = False
+  def is_on_mobile(self):
+    return self.mobile
+  @property
+  def guild_id(self):
+    return self.guild.id if self.guild else None
+  async def create_dm(self):
+    await self.backend.request(ROUTE_DM)
+    return DMChannel(self)
+  async def move_to(self, channel):
+    await self.backend.request(ROUTE_MEMBER, self.guild_id)
+    if self.guild and random.random() < self.guild.lost_moves:
+      return
+    self.join_voice(channel)
+  def join_voice(self, channel):
+    # The member connecting to channel, or disconnecting with None
+    before = self.voice or VoiceState(None)
+    if self.voice and self.voice.channel:
+      self.voice.channel.voice_members.remove(self)
+    after = VoiceState(channel, self.voice.mute if self.voice else False)
+    # like discord.py, members out of voice have no voice state
+    self.voice = after if channel is not None else None
+    if channel is not None:
+      channel.voice_members.append(self)
+    if self.guild:
+      self.guild.dispatch('voice_state_update', self, before, after)
+  def snapshot(self):
+    before = copy.copy(self)
+    before.roles = list(self.roles)
+    return before
+  def updated(self, before):
+    if self.guild:
+      self.guild.dispatch('member_update', before, self)
+  async def add_roles(self, *roles):
+    await self.backend.request(ROUTE_MEMBER_ROLE, self.guild_id)
+    before = self.snapshot()
+    self.roles.extend(r for r in roles if r not in self.roles)
+    self.updated(before)
+  async def remove_roles(self, *roles):
+    await self.backend.request(ROUTE_MEMBER_ROLE, self.guild_id)
+    before = self.snapshot()
+    self.roles = [r for r in self.roles if r not in roles]
+    self.updated(before)
+  async def edit(self, roles=None, mute=None):
+    await self.backend.request(ROUTE_MEMBER, self.guild_id)
+    if roles is not None:
+      before = self.snapshot()
+      self.roles = [self.guild.default_role] + list(roles)
+      self.updated(before)
+    if mute is not None:
+      self.voice.mute = mute
+  def set_presence(self, status=None, mobile=None):
+    # What a member switching device or status looks like to discord.py 1.7
+    before = self.snapshot()
+    if status is not None:
+      self.status = status
+    if mobile is not None:
+      self.mobile = mobile
+    self.updated(before)
+
+class DMChannel(discord.DMChannel):
+  def __init__(self, recipient):
+    self.id = next(ids)
+    self.recipient = recipient
+    self.sent = []
+  @asynccontextmanager
+  async def typing(self):
+    yield
+  async def send(self, content=None, embed=None):
+    await self.recipient.backend.request(ROUTE_MESSAGE, self.id)
+    if self.recipient.dms_closed:
+      raise discord.errors.Forbidden(Response(403, 'Forbidden'),
+        'Cannot send messages to this user')
+    self.sent.append(content)
+
+class VoiceState:
+  def __init__(self, channel, mute=False):
+    self.channel = channel
+    self.mute = mute
+
+class Permissions:
+  def __init__(self, administrator=False, speak=True):
+    self.administrator = administrator
+    self.speak = speak
+
+class Role(discord.Role):
+  def __init__(self, id, name, guild=None):
+    self.id = id
+    self.name = name
+    self.guild = guild
+    self._permissions = 0
+    self.position = 0
+    self.managed = False
+    self.mentionable = False
+    self.hoist = False
+  @property
+  def members(self):
+    return [m for m in self.guild.members if self in m.roles]
+  async def delete(self):
+    await self.guild.backend.request(ROUTE_ROLES, self.guild.id)
+    self.guild.roles.remove(self)
+    del self.guild.roles_by_id[self.id]
+    self.guild.dispatch('guild_role_delete', self)
+  async def edit(self, name):
+    await self.guild.backend.request(ROUTE_ROLES, self.guild.id)
+    before = copy.copy(self)
+    self.name = name
+    self.guild.dispatch('guild_role_update', before, self)
+
+class GuildChannel:
+  def init_channel(self, id, name, guild, category, overwrites):
+    self.id = id
+    self.name = name
+    self.guild = guild
+    self.category = category
+    self.channel_overwrites = dict(overwrites or {})
+  def overwrites_for(self, obj):
+    return self.channel_overwrites.get(obj, discord.PermissionOverwrite())
+  def permissions_for(self, member):
+    # Only speak is resolved: role overwrites allowing it win over the ones
+    # denying it, and the member's own overwrite wins over both
+    speaks = [self.overwrites_for(role).speak for role in member.roles]
+    speak = True if True in speaks else False if False in speaks else True
+    if self.overwrites_for(member).speak is not None:
+      speak = self.overwrites_for(member).speak
+    return Permissions(speak=speak)
+  async def set_permissions(self, target, *, overwrite=undefined, **permissions):
+    await self.guild.backend.request(ROUTE_PERMISSIONS, self.id)
+    if overwrite is None and not permissions:
+      self.channel_overwrites.pop(target, None)
+    else:
+      current = self.overwrites_for(target)
+      current.update(**permissions)
+      self.channel_overwrites[target] = current
+  async def delete(self):
+    await self.guild.backend.request(ROUTE_CHANNEL, self.id)
+    self.guild.channels.remove(self)
+    del self.guild.channels_by_id[self.id]
+    self.guild.dispatch('guild_channel_delete', self)
+  async def edit(self, name=None, category=undefined):
+    await self.guild.backend.request(ROUTE_CHANNEL, self.id)
+    before = copy.copy(self)
+    self.name = name or self.name
+    if category is not undefined:
+      self.category = category
+    self.guild.dispatch('guild_channel_update', before, self)
+
+class TextChannel(GuildChannel, discord.TextChannel):
+  category = None
+  def __init__(self, id, name, guild=None, category=None, overwrites=None):
+    self.init_channel(id, name, guild, category, overwrites)
+    self.messages = [] # oldest first
+  @property
+  def overwrites(self):
+    return self.channel_overwrites
+  def post(self, author, content):
+    # A message sent by someone else, the bot only sees it
+    msg = Message(author, self, content)
+    self.messages.append(msg)
+    return msg
+  async def send(self, content=None, embed=None):
+    await self.guild.backend.request(ROUTE_MESSAGE, self.id)
+    if embed is not None and len(embed.description) > EMBED_DESCRIPTION_LIMIT:
+      raise discord.errors.HTTPException(Response(400, 'Bad Request'),
+        'Invalid Form Body: embed description is too long')
+    return self.post(self.guild.me, content or embed.description)
+  async def history(self, limit=100, after=None, oldest_first=None):
+    # Like discord.py, newest first unless reading after a message
+    if oldest_first is None:
+      oldest_first = after is not None
+    msgs = self.messages
+    if after is not None:
+      msgs = [m for m in msgs if m.id > after.id]
+    msgs = msgs[:limit] if oldest_first else msgs[::-1][:limit]
+    for i, msg in enumerate(msgs):
+      if i % 100 == 0:
+        await self.guild.backend.request(ROUTE_HISTORY, self.id)
+      yield msg
+  @asynccontextmanager
+  async def typing(self):
+    yield
+
+class VoiceChannel(GuildChannel, discord.VoiceChannel):
+  category = None
+  def __init__(self, id, name, guild=None, category=None, overwrites=None):
+    self.init_channel(id, name, guild, category, overwrites)
+    self.voice_members = []
+  @property
+  def overwrites(self):
+    return self.channel_overwrites
+  @property
+  def members(self):
+    return list(self.voice_members)
+  async def connect(self, reconnect=True):
+    await self.guild.backend.request(ROUTE_VOICE)
+    self.guild.voice_client = VoiceClient(self)
+    self.guild.me.voice = VoiceState(self)
+
+class VoiceClient:
+  def __init__(self, channel):
+    self.channel = channel
+  async def move_to(self, channel):
+    await channel.guild.backend.request(ROUTE_VOICE)
+    self.channel = channel
+    channel.guild.me.voice = VoiceState(channel)
+
+class CategoryChannel(GuildChannel):
+  def __init__(self, id, name, guild=None, overwrites=None):
+    self.init_channel(id, name, guild, None, overwrites)
+  def __str__(self):
+    return self.name
+  @property
+  def channels(self):
+    return [c for c in self.guild.channels if c.category == self]
+  @property
+  def voice_channels(self):
+    return [c for c in self.channels if isinstance(c, VoiceChannel)]
+
+class Guild:
+  def __init__(self, name, backend=None):
+    self.id = next(ids)
+    self.name = name
+    self.backend = backend or Backend()
+    self.me = User(next(ids), 'bot')
+    self.default_role = Role(self.id, '@everyone', self)
+    self.roles = [self.default_role]
+    self.channels = []
+    # discord.py looks roles and channels up by ID in dicts
+    self.roles_by_id = {self.id: self.default_role}
+    self.channels_by_id = {}
+    self.members = []
+    self.cached = {}
+    self.uncached = {}
+    self.voice_client = None
+    # Gateway events reach the clients after gateway_latency seconds, and
+    # a lost_moves share of the moves is accepted but never happens
+    self.clients = []
+    self.gateway_latency = (0.0, 0.0)
+    self.lost_moves = 0.0
+  def dispatch(self, event, *args):
+    loop = asyncio.get_event_loop()
+    for client in self.clients:
+      handler = getattr(client, 'on_' + event, None)
+      if handler:
+        loop.call_later(random.uniform(*self.gateway_latency),
+          asyncio.ensure_future, handler(*args))
+  def link(self, client):
+    # What logging in does for the client, its handlers getting the
+    # guild's events from now on. Then await client.on_ready().
+    client.guild = self
+    client._connection.user = self.me
+    self.clients.append(client)
+  def add_member(self, name=None, channel=None):
+    id = next(ids)
+    member = Member(id, name or f'member{id}', self.backend, self)
+    member.roles.append(self.default_role)
+    self.members.append(member)
+    self.cached[id] = member
+    if channel:
+      member.voice = VoiceState(channel)
+      channel.voice_members.append(member)
+    return member
+  def add_uncached_member(self):
+    # A member discord.py hasn't cached, as happens with large guilds
+    member = self.add_member()
+    self.members.remove(member)
+    del self.cached[member.id]
+    self.uncached[member.id] = member
+    return member
+  def get_member(self, id):
+    return self.cached.get(id)
+  def get_role(self, id):
+    return self.roles_by_id.get(id)
+  def get_channel(self, id):
+    return self.channels_by_id.get(id)
+  def add_role(self, name):
+    role = Role(next(ids), name, self)
+    self.roles.append(role)
+    self.roles_by_id[role.id] = role
+    self.dispatch('guild_role_create', role)
+    return role
+  def add_channel(self, channel):
+    self.channels.append(channel)
+    self.channels_by_id[channel.id] = channel
+    self.dispatch('guild_channel_create', channel)
+    return channel
+  async def fetch_member(self, id):
+    await self.backend.request(ROUTE_MEMBERS, self.id)
+    if id not in self.uncached:
+      raise discord.errors.NotFound(Response(404, 'Not Found'), 'Unknown Member')
+    return self.uncached[id]
+  async def query_members(self, query=None, *, limit=5, user_ids=None,
+      presences=False, cache=True):
+    # One gateway request, answered by a member chunk
+    await self.backend.request(ROUTE_MEMBERS, self.id)
+    found = [self.uncached.pop(id) for id in user_ids[:limit] if id in self.uncached]
+    if cache:
+      self.members.extend(found)
+      self.cached.update((m.id, m) for m in found)
+    return found
+  async def create_role(self, name):
+    await self.backend.request(ROUTE_ROLES, self.id)
+    return self.add_role(name)
+  async def create_category_channel(self, name, overwrites=None):
+    await self.backend.request(ROUTE_CHANNELS, self.id)
+    return self.add_channel(CategoryChannel(next(ids), name, self, overwrites))
+  async def create_voice_channel(self, name, overwrites=None, category=None):
+    await self.backend.request(ROUTE_CHANNELS, self.id)
+    return self.add_channel(VoiceChannel(next(ids), name, self, category, overwrites))
+  async def create_text_channel(self, name, overwrites=None, category=None,
+      reason=None, **options):
+    await self.backend.request(ROUTE_CHANNELS, self.id)
+    return self.add_channel(TextChannel(next(ids), name, self, category, overwrites))
+
+class Reaction:
+  def __init__(self, emoji, me):
+    self.emoji = emoji
+    self.me = me
+
+class Message:
+  def __init__(self, author, channel, content):
+    self.id = next(ids)
+    self.author = author
+    self.channel = channel
+    self.content = content
+    self.reactions = []
+  async def add_reaction(self, emoji):
+    if isinstance(self.channel, DMChannel):
+      backend = self.channel.recipient.backend
+    else:
+      backend = self.channel.guild.backend
+    await backend.request(ROUTE_REACTION, self.channel.id)
+    self.reactions.append(Reaction(emoji, True))
+
+class SimulatedClient:
+  def __init__(self, n_members=1000):
+    self.user = User(0, 'bot')
+    self.metrics = Metrics(port=None)
+    self.members = {id: Member(id, f'member{id}')
+        for id in range(1, n_members + 1)}
+  async def get_member(self, user):
+    return self.members.get(user.id)
+  def get_manager_role(self):
+    return None
+  def get_waiting_chat(self):
+    return None
+
+CHATTER = [
+  "gg",
+  "anyone up for a game?",
+  "i was in electrical the whole time",
+  "red is sus",
+  "when does the next round start",
+  "lol",
+]
+
+def message_stream(client, n_messages, command_ratio, commands):
+  # Mostly chatter, with some commands sent where they aren't accepted
+  channel = TextChannel(1, "general")
+  authors = list(client.members.values())
+  messages = []
+  for _ in range(n_messages):
+    if random.random() < command_ratio:
+      content = random.choice(commands)
+    else:
+      content = random.choice(CHATTER)
+    messages.append(Message(random.choice(authors), channel, content))
+  return messages
@@ -0,0 +1,27 @@
+from collections import deque
+
+def percentile(values, p):
+  values = sorted(values)
+  if not values:
+    return 0.0
+  return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+class Samples:
+  """ Keeps the last `size` measures of something, to report percentiles
+      without growing forever.
+  """
+
+  def __init__(self, size=1000):
+    self.values = deque(maxlen=size)
+    self.count = 0
+
+  def add(self, value):
+    self.values.append(value)
+    self.count += 1
+
+  def percentiles(self, ps=(50, 90, 99)):
+    return {p: percentile(self.values, p) for p in ps}
+
+  def __str__(self):
+    return ', '.join(f'p{p} {v:.2f}s' for p, v in self.percentiles().items()) \
+      + f' ({self.count} samples)'
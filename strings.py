@@ -2,8 +2,10 @@ MEMBER_JOINS = "{member} joins the tournament"
 MEMBER_QUITS = "{member} quits the tournament"
 MEMBER_BANNED = "{member} banned from tournament"
 MEMBER_UNBANNED = "{member} unbanned from tournament"
+MEMBER_RATED = "{member} rated {rating:g}"
 
 PARTICIPANTS_MISSING_AND_IN_CHANNEL = "Participants missing: {n_away}\nParticipants in {channel}: {n_here}"
+START_TIMINGS = "\n*Timings: {timings}*"
 MEMBER_INVISIBLE = "{member} 👻"
 MEMBER_MOBILE = "{member} 📱"
 MEMBER_ERROR = "{member} ❌"
@@ -21,8 +23,19 @@ COULDNT_SUMMON_IN_CHANNEL_BECAUSE_BUSY = COULDNT_SUMMON_IN_CHANNEL \
 COULDNT_SUMMON_IN_CHANNEL_BECAUSE_FARWAY = COULDNT_SUMMON_IN_CHANNEL \
     + "non eri connesso a {guild} :("
 
+BROADCAST_DELIVERED = "Broadcast delivered to {n_delivered} participants, failed for {n_failed}"
+
 N_PARTICIPANTS = "{n} participants:"
 N_SPECTATORS = "{n} just listening:"
+AUTO_SUMMON_ARMED = "Moving participants to {channel} as soon as they can be moved, for {minutes} minutes: {n_movable} right now"
+AUTO_SUMMON_ENDED = "Auto summon ended: {n_moved} moved, {n_failed} failed"
+PRESENCE_COUNTS = "{n} participants: {waiting} here, {movable} movable, {busy} busy playing, {mobile} 📱, {invisible} 👻, {faraway} far away"
+STATS_COMMANDS = "**Commands**"
+STATS_COMMAND = "{command}: {n} run, {n_failed} failed, took {execute_p50} (p50) {execute_p90} (p90), waited {lock_p90} (p90) for locks"
+STATS_REQUESTS = "**Discord requests**"
+STATS_REQUEST = "{operation}: {n} sent, {n_failed} failed, took {p50} (p50) {p90} (p90), waited {wait_p90} (p90) for the rate limiter"
+STATS_RATE_LIMITED = "{n} rate limited by Discord, {seconds:.1f} seconds waited"
+STATS_MOVES = "{n_confirmed} moves confirmed by the gateway, {n_timed_out} timed out, {n_pending} pending"
 MUTED_CHANNEL = "Muted {channel}"
 UNMUTED_CHANNEL = "Unmuted {channel}"
 
@@ -32,16 +45,21 @@ CMD_PROMOTE = "PROMOTE"
 CMD_DEMOTE = "DEMOTE"
 CMD_BRING = "BRING"
 CMD_ASSIGN = "ASSIGN"
+CMD_RATE = "RATE"
 CMD_KICK = "KICK"
 CMD_BAN = "BAN"
 CMD_UNBAN = "UNBAN"
 CMD_BROADCAST = "BROADCAST"
 CMD_SUMMON = "SUMMON"
+CMD_AUTOSUMMON = "AUTOSUMMON"
 CMD_MUTE = "MUTE"
 CMD_UNMUTE = "UNMUTE"
 CMD_START = "START"
 CMD_END = "END"
+CMD_STOP = "STOP"
 CMD_JOIN = "JOIN"
 CMD_QUIT = "QUIT"
 CMD_LIST = "LIST"
+CMD_STATUS = "STATUS"
+CMD_STATS = "STATS"
 CMD_TERMINATE = "TERMINATE"
\ No newline at end of file
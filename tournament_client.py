@@ -1,7 +1,18 @@
 import time
+import sys
+import asyncio
+import heapq
+from traceback import print_exc
 import discord
 #import nacl
-from asyncioext import RWLock
+from locks import LockManager, STRUCTURE, member_key
+from asyncioext import gather_or_cancel
+from coalescer import Coalescer
+from matchmaking import Matchmaker
+from presence import PresenceIndex
+from autosummon import AutoSummoner
+from publisher import Publisher
+from metrics import rate_limit_counter
 from base_client import BaseClient
 from constants import *
 from rules import *
@@ -10,71 +21,210 @@ import database
 
 class TournamentClient(BaseClient):
   
+  rules = (
+    TerminateCmdRule,
+    LogDirectMessageRule,
+    JoinCmdRule,
+    QuitCmdRule,
+    ListCmdRule,
+    StatusCmdRule,
+    StatsCmdRule,
+    StartCmdRule,
+    AssignCmdRule,
+    RateCmdRule,
+    EndCmdRule,
+    SummonCmdRule,
+    AutoSummonCmdRule,
+    BroadcastCmdRule,
+    MuteCmdRule,
+    UnmuteCmdRule,
+    BringCmdRule,
+    KickCmdRule,
+    PromoteCmdRule,
+    DemoteCmdRule,
+    BanCmdRule,
+    UnbanCmdRule,
+    PrepareCmdRule,
+    CleanCmdRule,
+  )
+
+  # Attributes caching the roles and channels the tournament finds by
+  # name, with that name
+  named_channels = {
+    'category_channel': CATEGORY_CHANNEL_NAME,
+    'waiting_chat': WAITING_CHAT_NAME,
+    'waiting_room': WAITING_ROOM_NAME,
+    'chill_room': CHILL_ROOM_NAME,
+  }
+  named_roles = {
+    'manager_role': MANAGER_ROLE_NAME,
+    'participant_role': PARTICIPANT_ROLE_NAME,
+    'banned_role': BANNED_ROLE_NAME,
+    'verified_role': VERIFIED_ROLE_NAME,
+  }
+  # The ones searched in the tournament category only
+  in_category = ('waiting_chat', 'waiting_room')
+  
   def __init__(self, guild_name):
     intents = discord.Intents.default()
     intents.presences = True # to know who is on mobile
     intents.members = True # to access Role.members and VoiceChannel.members
     super().__init__(guild_name=guild_name, intents=intents)
-    self.env_lock = RWLock()
+    self.locks = LockManager()
+    self.coalescer = Coalescer()
+    self.matchmaker = Matchmaker()
+    self.lobby_strategy = LOBBY_STRATEGY
+    self.warm_start = WARM_START
+    self.checkpoint = None # ID of the last waiting chat message handled
+    self.saved_checkpoint = None
+    self.saving_checkpoint = None # task saving the checkpoint later
+    self.in_flight = set() # IDs of the waiting chat messages being handled
+    self.handled = [] # heap of the IDs handled past the checkpoint
+    self.presence = PresenceIndex(self)
+    self.auto_summoner = AutoSummoner(self)
+    self.publisher = Publisher(self)
     self.reset()
-    self.processor = RuleProcessor(
-      TerminateCmdRule(self),
-      LogDirectMessageRule(self),
-      JoinCmdRule(self),
-      QuitCmdRule(self),
-      ListCmdRule(self),
-      StartCmdRule(self),
-      AssignCmdRule(self),
-      EndCmdRule(self),
-      SummonCmdRule(self),
-      BroadcastCmdRule(self),
-      MuteCmdRule(self),
-      UnmuteCmdRule(self),
-      BringCmdRule(self),
-      KickCmdRule(self),
-      PromoteCmdRule(self),
-      DemoteCmdRule(self),
-      BanCmdRule(self),
-      UnbanCmdRule(self),
-      PrepareCmdRule(self),
-      CleanCmdRule(self),
-    )
+    self.processor = RuleProcessor(*(rule(self) for rule in self.rules))
   
   def reset(self):
     self.category_channel = None
     self.waiting_chat = None
     self.waiting_room = None
-    self.lobbies = None
+    self.lobbies = None # lobby index -> voice channel
+    self.lobby_roles = None # lobby index -> role
     self.manager_role = None
     self.participant_role = None
     self.banned_role = None
     self.chill_room = None
     self.verified_role = None
+    self.missing = set() # attributes known to have nothing to cache
+    self.presence.invalidate()
   
   async def on_ready(self):
+    await self.metrics.serve()
+    rate_limit_counter.register(self.guild.id, self.metrics)
     # Cache members for later use
     print('Fetching guild members...')
     t0 = time.time()
     #members = await self.guild.fetch_members(limit=50000).flatten() # too expensive
-    members = [await self.get_member(id)
-        for id in await database.get_participants_ids(self.guild.name)]
+    ids = await database.get_participants_ids(self.guild.name)
+    print(f'{len(ids)} participant IDs read in {(time.time()-t0):.2f} seconds')
+    t0 = time.time()
+    members = await self.hydrate_members(ids)
     print(f'{len(members)} members fetched in {(time.time()-t0):.2f} seconds')
+    t0 = time.time()
+    if self.warm_start:
+      await self.load_snapshot()
     if PREPARE_ON_READY:
       await self.prepare()
     else:
       permissions.get_category_overwrites(self)
       permissions.get_chat_overwrites(self)
       permissions.get_room_overwrites(self)
+    await self.save_snapshot()
+    print(f'Prepared in {(time.time()-t0):.2f} seconds')
+    t0 = time.time()
     await self.execute_old_commands()
+    print(f'Old commands executed in {(time.time()-t0):.2f} seconds')
   
+  async def load_snapshot(self):
+    # Looks up by ID what the last run found, leaving what was deleted or
+    # renamed since to the getters, which search it by name
+    snapshot = await database.get_snapshot(self.guild.name)
+    if not snapshot:
+      return
+    stale = []
+    for attr, name in self.named_channels.items():
+      found = self.resolve(self.guild.get_channel, snapshot.get(attr), name)
+      setattr(self, attr, found)
+      if snapshot.get(attr) and not found: stale.append(attr)
+    for attr, name in self.named_roles.items():
+      found = self.resolve(self.guild.get_role, snapshot.get(attr), name)
+      setattr(self, attr, found)
+      if snapshot.get(attr) and not found: stale.append(attr)
+    self.lobbies = self.resolve_lobbies(self.guild.get_channel,
+      snapshot.get('lobbies', {}), LOBBY_NAME_PREFIX)
+    if self.lobbies is None: stale.append('lobbies')
+    self.lobby_roles = self.resolve_lobbies(self.guild.get_role,
+      snapshot.get('lobby_roles', {}), LOBBY_ROLE_PREFIX)
+    if self.lobby_roles is None: stale.append('lobby_roles')
+    if stale:
+      print(f'Stale snapshot entries searched by name: {", ".join(stale)}')
+    if snapshot.get('lobby_phase'):
+      print(f'Resuming the lobby phase with {len(self.get_lobbies())} lobbies')
+
+  def resolve(self, get, id, name):
+    found = get(id) if id else None
+    return found if found and found.name == name else None
+
+  def resolve_lobbies(self, get, ids, prefix):
+    # None if any of them is stale, so that they're all searched again
+    lobbies = {}
+    for index, id in ids.items():
+      lobbies[index] = self.resolve(get, id, prefix + index)
+      if lobbies[index] is None:
+        return None
+    return lobbies
+
+  async def save_snapshot(self):
+    snapshot = {}
+    for attr in (*self.named_channels, *self.named_roles):
+      if getattr(self, attr):
+        snapshot[attr] = getattr(self, attr).id
+    snapshot['lobbies'] = {index: lobby.id
+      for index, lobby in self.get_lobby_channels().items()}
+    snapshot['lobby_roles'] = {index: role.id
+      for index, role in self.get_lobby_roles().items()}
+    snapshot['lobby_phase'] = self.is_lobby_phase()
+    await database.put_snapshot(self.guild.name, snapshot)
+
   async def connect_to_waiting_room(self):
     if self.get_waiting_room():
       await self.connect_to(self.waiting_room)
   
   async def on_message(self, msg):
-    await self.processor.run(msg)
+    in_chat = msg.channel == self.get_waiting_chat()
+    if in_chat:
+      self.in_flight.add(msg.id)
+    try:
+      await self.processor.run(msg)
+    finally:
+      if in_chat:
+        self.in_flight.discard(msg.id)
+        await self.on_handled(msg.id)
+
+  async def on_handled(self, msg_id):
+    # The checkpoint only moves past messages once every older one is
+    # handled too, so a restart replays the commands still running
+    heapq.heappush(self.handled, msg_id)
+    oldest = min(self.in_flight, default=None)
+    checkpoint = None
+    while self.handled and (oldest is None or self.handled[0] < oldest):
+      checkpoint = heapq.heappop(self.handled)
+    if checkpoint is not None:
+      await self.advance_checkpoint(checkpoint)
+
+  async def advance_checkpoint(self, msg_id):
+    if self.checkpoint is None or msg_id > self.checkpoint:
+      self.checkpoint = msg_id
+      if self.saving_checkpoint is None:
+        self.saving_checkpoint = asyncio.ensure_future(self.save_checkpoint_later())
+
+  async def save_checkpoint_later(self):
+    await asyncio.sleep(CHECKPOINT_SECONDS)
+    await self.save_checkpoint()
+
+  async def save_checkpoint(self):
+    if self.saving_checkpoint and self.saving_checkpoint is not asyncio.current_task():
+      self.saving_checkpoint.cancel()
+    self.saving_checkpoint = None
+    if self.checkpoint != self.saved_checkpoint:
+      self.saved_checkpoint = self.checkpoint
+      await database.put_checkpoint(self.guild.name, self.checkpoint)
   
   async def on_voice_state_update(self, member, voice_state1, voice_state2):
+    await super().on_voice_state_update(member, voice_state1, voice_state2)
+    self.presence.update(member)
     if voice_state1.channel != voice_state2.channel:
       waiting_room = self.get_waiting_room()
       if waiting_room:
@@ -86,15 +236,80 @@ class TournamentClient(BaseClient):
 
   async def execute_old_commands(self):
     if self.get_waiting_chat():
-      already_done = set()
-      async for msg in self.get_waiting_chat().history(limit=10000):
-        if msg.author.id == self.user.id:
-          break
-        if discord.utils.get(msg.reactions, me=True):
-          break
-        if not msg.author in already_done:
-          if await RuleProcessor(JoinCmdRule(self), QuitCmdRule(self)).run(msg):
-            already_done.add(msg.author)
+      msgs, last_id = await self.read_backlog()
+      await self.replay_backlog(msgs)
+      if last_id is not None:
+        # Like a handled message, so live ones still running hold it back
+        await self.on_handled(last_id)
+        await self.save_checkpoint()
+
+  async def read_backlog(self):
+    # Last JOIN or QUIT of each author since the bot last answered, as
+    # the ones before it don't change the outcome. Returns them with the
+    # ID of the newest message read.
+    checkpoint = await database.get_checkpoint(self.guild.name)
+    if checkpoint is None:
+      return await self.scan_backlog()
+    backlog = {}
+    last_id = checkpoint
+    async for msg in self.get_waiting_chat().history(
+        limit=None, after=discord.Object(id=checkpoint), oldest_first=True):
+      last_id = msg.id
+      if msg.author.id == self.user.id:
+        continue
+      if discord.utils.get(msg.reactions, me=True):
+        # answered already, so are the commands of its author before it
+        backlog.pop(msg.author.id, None)
+      elif parse_command(msg.content) in ((CMD_JOIN, []), (CMD_QUIT, [])):
+        backlog.pop(msg.author.id, None)
+        backlog[msg.author.id] = msg
+    return list(backlog.values()), last_id
+
+  async def scan_backlog(self):
+    # Without a checkpoint, reads backwards until the bot's last answer
+    backlog = {}
+    last_id = None
+    async for msg in self.get_waiting_chat().history(limit=10000):
+      if last_id is None:
+        last_id = msg.id
+      if msg.author.id == self.user.id:
+        break
+      if discord.utils.get(msg.reactions, me=True):
+        break
+      if msg.author.id not in backlog:
+        if parse_command(msg.content) in ((CMD_JOIN, []), (CMD_QUIT, [])):
+          backlog[msg.author.id] = msg
+    return list(backlog.values()), last_id
+
+  async def replay_backlog(self, msgs):
+    # Applies the net effect of the backlog all at once, then publishes a
+    # single summary of it
+    semaphore = asyncio.Semaphore(REPLAY_CONCURRENCY)
+    buffer = []
+    async def replay(msg):
+      async with semaphore, self.locks.locked('replay',
+          reads=[STRUCTURE], writes=[member_key(msg.author.id)]):
+        try:
+          member = await self.get_member(msg.author)
+          if member is None:
+            return
+          if parse_command(msg.content)[0] == CMD_JOIN:
+            if await self.give_participant_role(member):
+              buffer.append(MEMBER_JOINS.format(member=member.mention))
+          elif await self.revoke_participant_role(member):
+            buffer.append(MEMBER_QUITS.format(member=member.mention))
+          await self.react(msg, OK_REACTION)
+        except Exception:
+          print(f"Error while replaying {msg.content} of {msg.author}", file=sys.stderr)
+          print_exc(file=sys.stdout)
+          await self.react(msg, KO_REACTION)
+    await asyncio.gather(*(replay(msg) for msg in msgs))
+    if buffer:
+      await self.publish("\n".join(buffer))
+    print(f'{len(msgs)} old commands replayed, {len(buffer)} changes')
+
+  async def publish(self, embed): # embed can be a string
+    await self.publisher.publish(embed)
   
   async def prepare(self):
     if not self.get_manager_role():
@@ -123,45 +338,111 @@ class TournamentClient(BaseClient):
         overwrites=permissions.get_room_overwrites(self))
     await self.connect_to_waiting_room()
   
-  async def create_lobby(self, index, members):
+  async def make_lobbies(self, players):
+    # Deals players into lobbies with the matchmaker, remembering who
+    # plays with whom for the next rounds
+    history = await database.get_lobby_history(self.guild.name)
+    lobbies = await self.matchmaker.make_lobbies(players,
+      await database.get_ratings(self.guild.name), history)
+    history.append([[member.id for member in lobby] for lobby in lobbies])
+    await database.put_lobby_history(self.guild.name,
+      history[-MATCHMAKING_HISTORY:])
+    return lobbies
+
+  async def rate(self, member, rating):
+    ratings = await database.get_ratings(self.guild.name)
+    ratings[str(member.id)] = rating
+    await database.put_ratings(self.guild.name, ratings)
+
+  async def create_lobby(self, index, members, timings=None, then=None):
+    # The members get the lobby role while the channel is created, and
+    # then(lobby), if given, runs once both are done, so members moved in
+    # already have their role and their mute isn't refreshed again.
+    # timings, if given, gets the seconds spent on each stage.
+    timings = {} if timings is None else timings
+    async def timed(stage, aw):
+      t0 = time.perf_counter()
+      try:
+        return await aw
+      finally:
+        timings[stage] = time.perf_counter() - t0
     index = str(index)
-    lobby_role = await self.create_role(LOBBY_ROLE_PREFIX + index)
-    for member in members:
-      await self.give_lobby_role(member, lobby_role)
-    lobby = await self.create_voice_channel(
-      name=LOBBY_NAME_PREFIX + index,
-      category=self.get_tournament_category(),
-      overwrites=permissions.get_lobby_overwrites(self, lobby_role))
+    stages = []
+    if self.lobby_strategy == LOBBY_STRATEGY_ROLE:
+      lobby_role = await timed('role',
+        self.create_role(LOBBY_ROLE_PREFIX + index))
+      stages.append(timed('grants', asyncio.gather(
+        *(self.give_lobby_role(member, lobby_role) for member in members))))
+      overwrites = permissions.get_lobby_overwrites(self, lobby_role=lobby_role)
+    else:
+      for member in members:
+        if self.get_participant_role() not in member.roles:
+          raise ValueError(f"{member} is not a participant")
+      overwrites = permissions.get_lobby_overwrites(self, players=members)
+    async def open_lobby():
+      lobby = await timed('channel', self.create_voice_channel(
+        name=LOBBY_NAME_PREFIX + index,
+        category=self.get_tournament_category(),
+        overwrites=overwrites))
+      self.get_lobby_channels()[index] = lobby
+      if self.lobby_strategy == LOBBY_STRATEGY_ROLE:
+        self.get_lobby_roles()[index] = lobby_role
+      await self.save_snapshot()
+      return lobby
+    # a failed grant stops the channel, and the other way round
+    lobby, *_ = await gather_or_cancel(open_lobby(), *stages)
+    if then:
+      await then(lobby)
     return lobby
 
   async def give_lobby_role(self, member, index_or_role):
     if isinstance(index_or_role, int):
       index_or_role = str(index_or_role)
     if isinstance(index_or_role, str):
-      role = self.get_role(LOBBY_ROLE_PREFIX + index_or_role)
+      if self.lobby_strategy == LOBBY_STRATEGY_ROLE:
+        lobby = self.get_lobby_roles().get(index_or_role)
+      else:
+        lobby = self.get_lobby_channels().get(index_or_role)
     elif isinstance(index_or_role, discord.Role) and \
          LOBBY_ROLE_PREFIX in index_or_role.name:
-      role = index_or_role
-    if role is None:
+      lobby = index_or_role
+    if lobby is None:
       raise ValueError(f"{index_or_role} is not a lobby index nor a lobby role")
     elif self.get_participant_role() not in member.roles:
       raise ValueError(f"{member} is not a participant")
-    return await self.give_role(member, role)
+    if isinstance(lobby, discord.Role):
+      return await self.give_role(member, lobby)
+    return await self.set_channel_permissions(lobby, member,
+      view_channel=True)
   
   async def revoke_lobby_role(self, member):
-    lobby_role = discord.utils.find(
-        lambda r: LOBBY_ROLE_PREFIX in r.name, member.roles)
-    return await self.revoke_role(member, lobby_role)
+    # Works whatever the strategy the lobbies were created with
+    revoked = await self.revoke_role(member, self.get_lobby_role_of(member))
+    return await self.revoke_lobby_overwrites(member) or revoked
+
+  async def revoke_lobby_overwrites(self, member):
+    revoked = False
+    for lobby in self.get_lobbies():
+      if member in lobby.overwrites:
+        revoked = await self.clear_channel_permissions(lobby, member) or revoked
+    return revoked
+
+  def get_lobby_role_of(self, member):
+    lobby_roles = self.get_lobby_roles()
+    if not lobby_roles:
+      return None
+    lobby_roles = set(lobby_roles.values())
+    return discord.utils.find(lambda r: r in lobby_roles, member.roles)
 
   async def delete_lobbies(self, backup_channel=None):
-    if self.get_tournament_category():
-      if not backup_channel: backup_channel = self.get_waiting_room()
-      for channel in self.category_channel.voice_channels:
-        if LOBBY_NAME_PREFIX in channel.name:
-          await self.delete_channel(channel, backup_channel)
-    for role in self.guild.roles:
-      if LOBBY_ROLE_PREFIX in role.name:
-        await self.delete_if_exists(role)
+    if not backup_channel: backup_channel = self.get_waiting_room()
+    for channel in self.get_lobbies():
+      await self.delete_channel(channel, backup_channel)
+    for role in list(self.get_lobby_roles().values()):
+      await self.delete_if_exists(role)
+    self.lobbies = {}
+    self.lobby_roles = {}
+    await self.save_snapshot()
   
   async def clean(self):
     if self.get_participant_role():
@@ -178,24 +459,32 @@ class TournamentClient(BaseClient):
         await self.delete_if_exists(channel)
       await self.delete_if_exists(self.category_channel)
     self.reset()
+    await self.save_snapshot()
   
+  def cached(self, attr):
+    # Searches by name only the first time, and again after the events
+    # invalidate what was found, or not found
+    if getattr(self, attr) is None and attr not in self.missing:
+      setattr(self, attr, self.find(attr))
+      if getattr(self, attr) is None:
+        self.missing.add(attr)
+    return getattr(self, attr)
+
+  def find(self, attr):
+    if attr in self.named_roles:
+      return self.get_role(self.named_roles[attr])
+    if attr in self.in_category:
+      return self.get_tournament_channel(self.named_channels[attr])
+    return discord.utils.get(self.guild.channels, name=self.named_channels[attr])
+
   def get_verified_role(self):
-    if not self.verified_role:
-      self.verified_role = self.get_role(VERIFIED_ROLE_NAME)
-    return self.verified_role
+    return self.cached('verified_role')
 
   def get_chill_room(self):
-    if not self.chill_room:
-      self.chill_room = discord.utils.get(
-        self.guild.channels, name=CHILL_ROOM_NAME)
-    return self.chill_room
+    return self.cached('chill_room')
   
   def get_tournament_category(self):
-    if not self.category_channel:
-      self.category_channel = discord.utils.get(
-        self.guild.channels,
-        name=CATEGORY_CHANNEL_NAME)
-    return self.category_channel
+    return self.cached('category_channel')
   
   def get_tournament_channel(self, name):
     category_channel = self.get_tournament_category()
@@ -203,29 +492,98 @@ class TournamentClient(BaseClient):
       return discord.utils.get(category_channel.channels, name=name)
 
   def get_waiting_room(self):
-    if not self.waiting_room:
-      self.waiting_room = self.get_tournament_channel(WAITING_ROOM_NAME)
-    return self.waiting_room
+    return self.cached('waiting_room')
   
   def get_waiting_chat(self):
-    if not self.waiting_chat:
-      self.waiting_chat = self.get_tournament_channel(WAITING_CHAT_NAME)
-    return self.waiting_chat
+    return self.cached('waiting_chat')
   
   def get_manager_role(self):
-    if not self.manager_role:
-      self.manager_role = self.get_role(MANAGER_ROLE_NAME)
-    return self.manager_role
+    return self.cached('manager_role')
   
   def get_participant_role(self):
-    if not self.participant_role:
-      self.participant_role = self.get_role(PARTICIPANT_ROLE_NAME)
-    return self.participant_role
+    return self.cached('participant_role')
   
   def get_banned_role(self):
-    if not self.banned_role:
-      self.banned_role = self.get_role(BANNED_ROLE_NAME)
-    return self.banned_role
+    return self.cached('banned_role')
+
+  async def on_member_update(self, before, after):
+    self.presence.update(after)
+
+  async def on_presence_update(self, before, after):
+    # discord.py 2 reports status changes apart from on_member_update
+    self.presence.update(after)
+
+  async def on_member_remove(self, member):
+    # Members banned from the guild are removed from it too
+    if member.guild == self.guild:
+      self.presence.discard(member)
+
+  async def on_guild_role_create(self, role):
+    self.presence.on_structure_change(role)
+    self.index(role, self.named_roles, self.lobby_roles, LOBBY_ROLE_PREFIX)
+
+  async def on_guild_role_delete(self, role):
+    self.presence.on_structure_change(role)
+    self.unindex(role, self.named_roles, self.lobby_roles)
+
+  async def on_guild_role_update(self, before, after):
+    if before.name != after.name:
+      self.presence.on_structure_change(before)
+      self.presence.on_structure_change(after)
+      self.unindex(before, self.named_roles, self.lobby_roles)
+      self.index(after, self.named_roles, self.lobby_roles, LOBBY_ROLE_PREFIX)
+
+  async def on_guild_channel_create(self, channel):
+    self.presence.on_structure_change(channel)
+    self.index(channel, self.named_channels, self.lobbies, LOBBY_NAME_PREFIX)
+
+  async def on_guild_channel_delete(self, channel):
+    self.presence.on_structure_change(channel)
+    self.unindex(channel, self.named_channels, self.lobbies)
+
+  async def on_guild_channel_update(self, before, after):
+    if before.category != after.category:
+      # its members may have entered or left a protected category
+      self.presence.invalidate()
+    if before.name != after.name or before.category != after.category:
+      self.presence.on_structure_change(before)
+      self.presence.on_structure_change(after)
+      self.unindex(before, self.named_channels, self.lobbies)
+      self.index(after, self.named_channels, self.lobbies, LOBBY_NAME_PREFIX)
+
+  def index(self, obj, named, lobbies, lobby_prefix):
+    # Caches obj if it's one of the tournament's, so that the getters
+    # don't need to search for it
+    if self.guild is None or obj.guild != self.guild:
+      return
+    for attr, name in named.items():
+      if obj.name == name and getattr(self, attr) is None and \
+          (attr not in self.in_category or self.is_in_category(obj)):
+        setattr(self, attr, obj)
+        self.missing.discard(attr)
+        if attr == 'category_channel':
+          self.missing.difference_update(self.in_category)
+    if lobbies is not None and obj.name.startswith(lobby_prefix) and \
+        (isinstance(obj, discord.Role) or
+         isinstance(obj, discord.VoiceChannel) and self.is_in_category(obj)):
+      lobbies[obj.name[len(lobby_prefix):]] = obj
+
+  def is_in_category(self, channel):
+    return self.category_channel is not None and \
+      channel.category == self.category_channel
+
+  def unindex(self, obj, named, lobbies):
+    # Forgets obj, the getters searching again for another one
+    if self.guild is None or obj.guild != self.guild:
+      return
+    for attr in named:
+      if getattr(self, attr) is not None and getattr(self, attr).id == obj.id:
+        setattr(self, attr, None)
+        self.missing.discard(attr)
+    if lobbies is not None:
+      for index, lobby in list(lobbies.items()):
+        if lobby.id == obj.id:
+          del lobbies[index]
   
   async def give_participant_role(self, member):
     if self.get_banned_role() in member.roles:
@@ -239,31 +597,46 @@ class TournamentClient(BaseClient):
     return await self.give_role(member, self.get_manager_role())
   
   async def give_banned_role(self, member):
-    if await self.give_role(member, self.get_banned_role()):
-      await self.revoke_manager_role(member, move_to_waiting=False)
-      await self.revoke_participant_role(member, move_to_waiting=False)
-      await self.move_member(member,
-          at=self.get_tournament_category(),
-          to=self.get_chill_room(),
-          force_mobile=True)
-      return True
-    return False
+    edit = self.edit_roles(member)
+    edit.add(self.get_banned_role())
+    if not edit.added:
+      return False
+    edit.remove(self.get_manager_role())
+    self.edit_participant_out(edit)
+    await edit.commit()
+    await self.on_participant_out(edit)
+    await self.move_member(member,
+        at=self.get_tournament_category(),
+        to=self.get_chill_room(),
+        force_mobile=True)
+    return True
 
   async def revoke_participant_role(self, member, move_to_waiting=True):
-    if await self.revoke_role(member, self.get_participant_role()):
-      await database.del_participant_id(self.guild.name, member.id)
-      for role in member.roles:
-        if LOBBY_ROLE_PREFIX in role.name:
-          await self.revoke_role(member, role)
-          break
-      if move_to_waiting and self.get_manager_role() not in member.roles:
+    edit = self.edit_roles(member)
+    self.edit_participant_out(edit)
+    if await edit.commit():
+      await self.on_participant_out(edit)
+      if move_to_waiting and not edit.has(self.get_manager_role()):
         await self.maybe_move_from_lobby_to_waiting(member)
       return True
     return False
 
+  def edit_participant_out(self, edit):
+    if self.get_participant_role() in edit.member.roles:
+      edit.remove(self.get_participant_role())
+      edit.remove(self.get_lobby_role_of(edit.member))
+
+  async def on_participant_out(self, edit):
+    # What follows a committed edit_participant_out
+    if self.get_participant_role() in edit.removed:
+      await database.del_participant_id(self.guild.name, edit.member.id)
+      await self.revoke_lobby_overwrites(edit.member)
+
   async def revoke_manager_role(self, member, move_to_waiting=True):
-    if await self.revoke_role(member, self.get_manager_role()):
-      if move_to_waiting and self.get_participant_role() not in member.roles:
+    edit = self.edit_roles(member)
+    edit.remove(self.get_manager_role())
+    if await edit.commit():
+      if move_to_waiting and not edit.has(self.get_participant_role()):
         await self.maybe_move_from_lobby_to_waiting(member)
       return True
     return False
@@ -278,6 +651,25 @@ class TournamentClient(BaseClient):
           to=self.get_waiting_room(),
           force_mobile=True)
   
+  def get_lobbies(self):
+    return list(self.get_lobby_channels().values())
+
+  def get_lobby_channels(self):
+    if self.lobbies is None:
+      category_channel = self.get_tournament_category()
+      if not category_channel:
+        return {}
+      self.lobbies = {c.name[len(LOBBY_NAME_PREFIX):]: c
+        for c in category_channel.voice_channels
+        if c.name.startswith(LOBBY_NAME_PREFIX)}
+    return self.lobbies
+
+  def get_lobby_roles(self):
+    if self.lobby_roles is None:
+      self.lobby_roles = {r.name[len(LOBBY_ROLE_PREFIX):]: r
+        for r in self.guild.roles if r.name.startswith(LOBBY_ROLE_PREFIX)}
+    return self.lobby_roles
+  
   def get_managers(self):
     return self.get_manager_role().members
   
@@ -290,6 +682,7 @@ class TournamentClient(BaseClient):
 
   def is_busy(self, member):
     return member.voice and member.voice.channel \
+       and member.voice.channel.category \
        and member.voice.channel.category.name in MOVE_PROTECTED_CATEGORIES
   
   async def mute_channel_managed_by(self, user, unmute=False):
@@ -301,7 +694,19 @@ class TournamentClient(BaseClient):
             channel, self.get_participant_role(), speak=unmute):
           return channel
   
+  async def close(self):
+    print(f'Lock metrics per command:\n{self.locks.stats()}')
+    print(f'JOIN and QUIT: {self.coalescer.stats()}')
+    await self.publisher.flush()
+    print(f'Announcements: {self.publisher.stats()}')
+    print(f'Moves: {self.move_tracker.stats()}')
+    self.metrics.close()
+    if self.guild:
+      rate_limit_counter.unregister(self.guild.id)
+    self.matchmaker.close()
+    await self.save_checkpoint()
+    await database.flush()
+    await super().close()
+  
   def is_lobby_phase(self):
-    return bool(discord.utils.find(
-      lambda c: LOBBY_NAME_PREFIX in c.name,
-      self.get_tournament_category().voice_channels))
\ No newline at end of file
+    return bool(self.get_lobbies())
\ No newline at end of file